@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# decodes long recordings, or directories of recordings, on every core
+# run ./batch.py <file or directory> [<file or directory> ...]; wav files and raw audio are decoded as audio, and
+# files with an extension in recordings.IQ_EXTENSIONS as raw IQ samples from the radio
+# recordings are split at the pauses between transmissions and the segments are decoded by a pool of
+# processes; raw IQ is first turned into audio by the same pool, in blocks
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from math import ceil, gcd
+from multiprocessing import Pool
+import transmitter
+import receiver
+import recordings
+from shared import *
+
+BATCH_PROCESSES = None  # worker processes, None for one per core
+SILENCE_BLOCK = 0.01  # seconds of audio in each step of the envelope used to find pauses
+SPLIT_PAUSE = 0.8  # shortest silence a recording is split at, as a fraction of INTER_TRANSMISSION_PAUSE
+SEGMENT_OVERLAP = 0.5  # seconds of audio either side of a split that are decoded with both segments
+ENVELOPE_CHUNK = 1 << 22  # audio samples read at once when finding pauses
+IQ_BLOCK_SECONDS = 10  # seconds of radio samples turned into audio by each task
+IQ_WARMUP_SECONDS = 0.01  # seconds of radio samples before each block that settle the filters
+
+
+# set up a worker process with the modem settings of the parent
+def init_worker(modem):
+    MODEM.update(modem)
+
+
+# get the envelope of an audio recording: the average absolute value of every SILENCE_BLOCK seconds
+def get_envelope(recording):
+    block = max(1, round(SILENCE_BLOCK * MODEM.sample_rate))
+    envelope = [np.zeros(0)]
+    for samples in recording.chunks(max(1, ENVELOPE_CHUNK // block) * block):
+        samples = np.asarray(samples[:len(samples) // block * block], dtype=np.float32)
+        envelope.append(np.abs(samples).reshape(-1, block).mean(axis=1))
+    return np.concatenate(envelope)
+
+
+# split an audio recording into segments at the pauses between transmissions, returns a list of (start, end) samples
+# the envelope is split into quiet and loud blocks like symbol energies are, and every quiet run at least
+# SPLIT_PAUSE of a pause long is split in the middle; segments reach SEGMENT_OVERLAP seconds past each split,
+# so a packet next to a split is whole in at least one segment even if it trails off into the pause
+def split_at_pauses(recording):
+    block = max(1, round(SILENCE_BLOCK * MODEM.sample_rate))
+    envelope = get_envelope(recording)
+    splits = []
+    if len(envelope) > 0 and envelope.min() < envelope.max():
+        quiet = envelope <= receiver.get_threshold(envelope)
+        min_blocks = SPLIT_PAUSE * transmitter.INTER_TRANSMISSION_PAUSE / SILENCE_BLOCK
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], quiet.astype(np.int8), [0]])))
+        splits = [(start + end) // 2 * block for start, end in edges.reshape(-1, 2).tolist()
+                  if end - start >= min_blocks and start > 0 and end < len(envelope)]
+
+    overlap = round(SEGMENT_OVERLAP * MODEM.sample_rate)
+    return [(max(start - overlap, 0), min(end + overlap, len(recording)))
+            for start, end in zip([0] + splits, splits + [len(recording)]) if end > start]
+
+
+# find the segments of a recording, returns (sample rate, length in samples, segments)
+def split_recording(filename):
+    recording = recordings.open_recording(filename)
+    return recording.sample_rate, len(recording), split_at_pauses(recording)
+
+
+# decode the packets in a segment of a recording
+# returns a list of (start sample, packet info, soft bits), with starts counted from the start of the recording
+def decode_segment(task):
+    filename, start, end = task
+    audio = recordings.open_recording(filename).view(start, end)
+    return [(start + i, info_dict, soft_bits) for i, info_dict, soft_bits in receiver.demodulate_all_packets(audio)]
+
+
+# merge the packets found in the segments of a recording, in order of arrival
+# neighbouring segments overlap, so a packet near a split can be found by both: packets from the same source
+# with the same sequence number that start within a symbol of each other are the same packet
+def merge_packets(segment_packets):
+    merged = []
+    last_start = {}  # start of the last packet kept for each (source ip, sequence number)
+    for start, info_dict, soft_bits in sorted((packet for packets in segment_packets for packet in packets),
+                                              key=lambda packet: packet[0]):
+        key = (info_dict['source_ip'], info_dict['sn'])
+        if key in last_start and start - last_start[key] <= MODEM.samples_per_symbol:
+            continue
+        last_start[key] = start
+        merged.append((start, info_dict, soft_bits))
+    return merged
+
+
+# get the number of radio samples that make a whole number of audio samples, and that number of audio samples
+# blocks of radio samples that start at a multiple of it line up with the audio of the whole capture
+def get_iq_alignment():
+    dec_rate, sample_rate = receiver.get_fm_sample_rate()
+    divisor = gcd(MODEM.sample_rate, sample_rate)
+    return dec_rate * sample_rate // divisor, MODEM.sample_rate // divisor
+
+
+# get the number of audio samples the receive chain makes from n radio samples
+def get_iq_audio_length(n):
+    dec_rate, sample_rate = receiver.get_fm_sample_rate()
+    n = -(-n // dec_rate)  # samples of the FM channel
+    return -(-n * MODEM.sample_rate // sample_rate)
+
+
+# turn the radio samples start to end of a raw IQ recording into audio, writing it to its place in the audio file
+# the filters are settled on the radio samples before the block, so the audio of consecutive blocks joins up as
+# if the whole capture had been processed at once
+def convert_iq_block(task):
+    filename, dtype, start, end, audio_filename = task
+    radio_alignment, audio_alignment = get_iq_alignment()
+    warmup = min(start, ceil(IQ_WARMUP_SECONDS * receiver.RADIO_SAMPLE_RATE / radio_alignment) * radio_alignment)
+
+    samples = recordings.open_iq(filename, dtype).read(start - warmup, end)
+    stages = receiver.build_radio_stages(in_place=True)  # the block was read for this task alone
+    stages[0].seek(start - warmup)
+    audio = receiver.ReceivePipeline(stages).process(samples)[warmup // radio_alignment * audio_alignment:]
+
+    output = np.memmap(audio_filename, dtype=np.float32, mode='r+')
+    first = start // radio_alignment * audio_alignment
+    output[first:first + len(audio)] = audio
+    output.flush()
+
+
+# create the audio file for a raw IQ recording, returns the tasks that fill it in
+def get_iq_tasks(filename, dtype, audio_filename):
+    n = len(recordings.open_iq(filename, dtype))
+    with open(audio_filename, 'wb') as f:
+        f.truncate(get_iq_audio_length(n) * 4)
+
+    radio_alignment, _ = get_iq_alignment()
+    block = max(1, round(IQ_BLOCK_SECONDS * receiver.RADIO_SAMPLE_RATE / radio_alignment)) * radio_alignment
+    return [(filename, dtype, start, min(start + block, n), audio_filename) for start in range(0, n, block)]
+
+
+# find the recordings among the paths, looking through directories
+def find_recordings(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                filenames += [os.path.join(directory, name) for name in sorted(names)]
+        else:
+            filenames.append(path)
+    return [filename for filename in filenames if recordings.is_recording(filename)]
+
+
+# decode recordings with a pool of processes
+# returns a list of (filename, seconds of audio, packets) in the order of the recordings, where packets is a
+# list of (start sample, packet info, soft bits) in order of arrival, as from receiver.demodulate_all_packets
+def decode_recordings(filenames, processes=BATCH_PROCESSES):
+    with tempfile.TemporaryDirectory() as directory, \
+            Pool(processes, init_worker, (MODEM,)) as pool:
+        # raw IQ is turned into audio first
+        audio_filenames = []
+        tasks = []
+        for i, filename in enumerate(filenames):
+            dtype = recordings.IQ_EXTENSIONS.get(os.path.splitext(filename)[1])
+            if dtype is None:
+                audio_filenames.append(filename)
+            else:
+                audio_filenames.append(os.path.join(directory, str(i) + '.f32'))
+                tasks += get_iq_tasks(filename, dtype, audio_filenames[-1])
+        if tasks:
+            print("Converting IQ to audio...", end='', flush=True)
+            pool.map(convert_iq_block, tasks)
+            print("done")
+
+        print("Splitting recordings at pauses...", end='', flush=True)
+        segments = []
+        lengths = []
+        for i, (rate, length, spans) in enumerate(pool.map(split_recording, audio_filenames)):
+            if rate != MODEM.sample_rate:
+                print("WARNING: " + filenames[i] + " does not have sample rate of " + str(MODEM.sample_rate) + "Hz")
+            lengths.append(length / rate)
+            segments += [(i, start, end) for start, end in spans]
+        print("done")
+
+        print("Decoding " + str(len(segments)) + " segments...", end='', flush=True)
+        found = [[] for _ in filenames]
+        tasks = [(audio_filenames[i], start, end) for i, start, end in segments]
+        for (i, _, _), packets in zip(segments, pool.imap(decode_segment, tasks)):
+            found[i].append(packets)
+        print("done")
+
+    return [(filename, length, merge_packets(packets)) for filename, length, packets in zip(filenames, lengths, found)]
+
+
+if __name__ == "__main__":
+    filenames = find_recordings(sys.argv[1:])
+    start = time.perf_counter()
+    results = decode_recordings(filenames)
+    elapsed = time.perf_counter() - start
+
+    for filename, length, packets in results:
+        print("== " + filename + " ==")
+        for info_dict in receiver.combine_repetitions(packets):
+            receiver.show_packet(info_dict)
+
+    seconds = sum(length for _, length, _ in results)
+    print("Decoded " + str(sum(len(packets) for _, _, packets in results)) + " packets from " +
+          str(len(results)) + " recordings (" + str(round(seconds, 1)) + " s of audio) in " +
+          str(round(elapsed, 1)) + " s, " + str(round(seconds / elapsed, 1)) + "x real time")
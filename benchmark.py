@@ -0,0 +1,1003 @@
+#!/usr/bin/env python3
+
+# benchmarks for the modem
+# run ./benchmark.py <name> [<name> ...] to run specific benchmarks, or no names to run all of them
+import asyncio
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy.signal as signal
+from scipy.io.wavfile import read
+import transmitter
+import receiver
+import fec
+import batch
+import channel
+import dnsserver
+import recordings
+import timing
+import zones
+from dsp import NCO, PolyphaseResampler
+from shared import *
+
+try:
+    from bitstring import BitArray
+except ImportError:  # only needed to compare against the old packet code
+    BitArray = None
+
+BENCHMARK_SOURCE_IP = '10.0.0.1'
+
+
+# build a random message of the given length that can be sent by sender.py
+def random_message(length, seed=0):
+    rng = np.random.default_rng(seed)
+    return bytes(rng.integers(32, 127, length, dtype=np.uint8))
+
+
+# build the audio for a single packet carrying the message
+def build_packet_audio(message, sequence_number=1):
+    packet = transmitter.build_packet(BENCHMARK_SOURCE_IP, TRANSMITTER_ADDR, sequence_number,
+                                      get_hash(message), message)
+    return np.concatenate(transmitter.build_transmission(packet))
+
+
+# print a table with a header row
+def print_table(header, rows):
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+# compare the throughput of on/off keying against each M-FSK mode
+def bench_modulation_modes(message_length=64, noise=0.0):
+    rng = np.random.default_rng(1)
+    message = random_message(message_length)
+    default_bits = MODEM.modulation_bits
+    rows = []
+
+    for bits_per_symbol in sorted(MODEM.pilot_tones):
+        MODEM.modulation_bits = bits_per_symbol
+        start = time.perf_counter()
+        audio = build_packet_audio(message)
+        build_time = time.perf_counter() - start
+        airtime = len(audio) / MODEM.sample_rate
+
+        audio = audio + rng.normal(0, noise, len(audio)).astype(np.float32)
+        start = time.perf_counter()
+        info = receiver.decode_audio(audio)
+        decode_time = time.perf_counter() - start
+
+        mode = 'OOK' if bits_per_symbol == 1 else str(2 ** bits_per_symbol) + '-FSK'
+        rows.append([mode, round(airtime, 1), round(message_length * 8 / airtime, 2),
+                     round(build_time, 3), round(decode_time, 3), info['data'] == message])
+
+    MODEM.modulation_bits = default_bits
+    print_table(['mode', 'airtime (s)', 'goodput (bit/s)', 'build (s)', 'decode (s)', 'decoded'], rows)
+
+
+# decode packet bits received through a binary symmetric channel, returns True if the message is intact
+def decode_packet_bits(bits, message, rate):
+    try:
+        if rate is not None:
+            bits = receiver.decode_fec(bits, rate)
+        info = receiver.get_packet_info(receiver.rebuild_packet(list(bits)))
+    except ValueError:
+        return False  # the data length was corrupted
+    return is_intact(info, message)
+
+
+# check that the packet info holds the message and a matching checksum
+def is_intact(info, message):
+    checksum = receiver.get_checksum_hex_from_bytes(get_hash(info['data']))
+    return info['data'] == message and checksum == info['checksum']
+
+
+# compare the goodput of repeating uncoded packets against single coded packets at several bit error rates
+def bench_fec(message_length=32, trials=20, error_rates=(0, 0.001, 0.01, 0.03, 0.05)):
+    rng = np.random.default_rng(2)
+    message = random_message(message_length)
+    packet = transmitter.build_packet(BENCHMARK_SOURCE_IP, TRANSMITTER_ADDR, 1, get_hash(message), message)
+    symbol_duration = MODEM.symbol_duration
+    pause = transmitter.get_pause_samples() / MODEM.sample_rate
+    default_rate = MODEM.fec_rate
+
+    # (name, code rate, repetitions)
+    schemes = [('uncoded x1', None, 1), ('uncoded x' + str(transmitter.PACKET_REPETITIONS), None,
+                                         transmitter.PACKET_REPETITIONS)]
+    schemes += [('rate ' + rate + ' x1', rate, 1) for rate in fec.PUNCTURE_PATTERNS]
+
+    rows = []
+    for name, rate, repetitions in schemes:
+        MODEM.fec_rate = rate
+        bits = transmitter.get_packet_bits(packet)
+        airtime = repetitions * len(bits) * symbol_duration + (repetitions - 1) * pause
+        row = [name, round(airtime, 1)]
+
+        for error_rate in error_rates:
+            delivered = 0
+            for trial in range(trials):
+                # the message gets through if any repetition decodes cleanly
+                for repetition in range(repetitions):
+                    received = bits ^ (rng.random(len(bits)) < error_rate)
+                    if decode_packet_bits(received, message, rate):
+                        delivered += 1
+                        break
+            row.append(round(delivered / trials * message_length * 8 / airtime, 3))
+        rows.append(row)
+
+    MODEM.fec_rate = default_rate
+    print("goodput (bit/s) by bit error rate, " + str(message_length) + " byte message")
+    print_table(['scheme', 'airtime (s)'] + ['BER ' + str(rate) for rate in error_rates], rows)
+
+
+# send packets through the file mode loopback at the current modem settings
+# (transmitter.save_transmission_data -> wav file -> receiver.load_wav -> receiver.decode_audio), with white noise
+# of standard deviation noise added to the loaded audio; returns True if the message decodes intact
+def run_file_loopback(packets, message, noise, rng):
+    transmitter.save_transmission_data(transmitter.build_multiple_transmissions(packets))
+    audio = receiver.load_wav(WAV_FILENAME)
+    audio = audio + rng.normal(0, noise, len(audio)).astype(np.float32)
+    try:
+        return is_intact(receiver.decode_audio(audio), message)
+    except ValueError:
+        return False
+
+
+# try a modulation mode at the symbol rate of samples_per_symbol samples through the file mode loopback
+# returns 'decoded', 'failed', or 'above Nyquist' if the mode's tones do not fit at that rate
+def try_symbol_rate(bits_per_symbol, samples_per_symbol, packets, message, noise, rng):
+    try:
+        MODEM.set_symbol_rate(MODEM.sample_rate / samples_per_symbol)
+    except ValueError:
+        return 'above Nyquist'
+    return 'decoded' if run_file_loopback(packets, message, noise, rng) else 'failed'
+
+
+# find the fastest symbol rate of every modulation mode that still decodes cleanly through the file mode loopback
+# the rate is doubled from start_rate until decoding fails (or the mode's tones no longer fit below half the
+# sample rate), then the limit is narrowed down to a whole number of samples per symbol
+# noise (standard deviation of white noise added to the loaded audio) makes the sweep stricter
+def bench_symbol_rates(message_length=32, start_rate=20 / 3, noise=0.0):
+    rng = np.random.default_rng(3)
+    message = random_message(message_length)
+    packets = transmitter.build_message_packets(BENCHMARK_SOURCE_IP, message)[:1]
+    default_rate = MODEM.symbol_rate
+    default_bits = MODEM.modulation_bits
+    sweep = []
+    limits = []
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for bits_per_symbol in sorted(MODEM.pilot_tones):
+                MODEM.set_symbol_rate(start_rate)
+                MODEM.modulation_bits = bits_per_symbol
+                mode = 'OOK' if bits_per_symbol == 1 else str(2 ** bits_per_symbol) + '-FSK'
+
+                # double the rate until it fails, or there is only one sample per symbol left
+                good = None
+                bad = None
+                samples_per_symbol = MODEM.samples_per_symbol
+                while True:
+                    result = try_symbol_rate(bits_per_symbol, samples_per_symbol, packets, message, noise, rng)
+                    sweep.append([mode, round(MODEM.sample_rate / samples_per_symbol, 2), samples_per_symbol, result])
+                    if result != 'decoded':
+                        bad = (samples_per_symbol, result)
+                        break
+                    good = samples_per_symbol
+                    if samples_per_symbol == 1:
+                        break
+                    samples_per_symbol = max(1, samples_per_symbol // 2)
+
+                # narrow the limit down between the last rate that decoded and the first that did not
+                while good is not None and bad is not None and good - bad[0] > 1:
+                    middle = (good + bad[0]) // 2
+                    result = try_symbol_rate(bits_per_symbol, middle, packets, message, noise, rng)
+                    if result == 'decoded':
+                        good = middle
+                    else:
+                        bad = (middle, result)
+
+                if good is None:
+                    limits.append([mode, '-', '-', '-', bad[1] + ' at the start rate'])
+                    continue
+                fastest = MODEM.sample_rate / good
+                airtime = receiver.count_packet_symbols(message_length, bits_per_symbol) / fastest
+                limits.append([mode, round(fastest, 2), good, round(message_length * 8 / airtime, 1),
+                               'one sample per symbol' if bad is None else bad[1] + ' at ' +
+                               str(round(MODEM.sample_rate / bad[0], 2)) + ' symbols/s'])
+        finally:
+            os.chdir(cwd)
+            MODEM.modulation_bits = 1
+            MODEM.set_symbol_rate(default_rate)
+            MODEM.modulation_bits = default_bits
+
+    print_table(['mode', 'symbol rate (Hz)', 'samples/symbol', 'result'], sweep)
+    print()
+    print("fastest clean symbol rate of each mode, " + str(message_length) + " byte message")
+    print_table(['mode', 'symbol rate (Hz)', 'samples/symbol', 'goodput (bit/s)', 'limited by'], limits)
+
+
+# compare decoding only the first copy of a message against combining all its repetitions at several noise
+# levels (standard deviation of white noise added to audio with tones of amplitude 1)
+def bench_repetitions(message_length=32, trials=3, noise_levels=(0.5, 0.7, 0.85), symbol_rate=500):
+    rng = np.random.default_rng(5)
+    message = random_message(message_length)
+    packets = transmitter.build_message_packets(BENCHMARK_SOURCE_IP, message)
+    default_rate = MODEM.symbol_rate
+    default_pause = transmitter.INTER_TRANSMISSION_PAUSE
+    rows = []
+
+    MODEM.set_symbol_rate(symbol_rate)
+    transmitter.INTER_TRANSMISSION_PAUSE = 0.2
+    try:
+        audio = np.concatenate(list(transmitter.iter_transmission_audio(
+            transmitter.build_multiple_transmissions(packets))))
+
+        for noise in noise_levels:
+            delivered = {'first copy': 0, 'majority': 0, 'soft': 0}
+            combined = []
+            for trial in range(trials):
+                received = (audio + rng.normal(0, noise, len(audio))).astype(np.float32)
+                try:
+                    delivered['first copy'] += is_intact(receiver.decode_audio(received), message)
+                except ValueError:
+                    pass  # the data length was corrupted
+                for method in ('majority', 'soft'):
+                    results = [info for info in receiver.decode_repetitions(received, method) if is_intact(info, message)]
+                    delivered[method] += bool(results)
+                    combined += [info['combined'] for info in results if method == 'soft']
+            rows.append([noise] + [str(delivered[name]) + '/' + str(trials) for name in delivered] +
+                        [round(np.mean(combined), 1) if combined else '-'])
+
+        # consecutive messages that differ in a single character must not be combined as repetitions
+        near_messages = [b'meet at the north gate at 10pm', b'meet at the north gate at 11pm']
+        near_packets = [packet for near_message in near_messages
+                        for packet in transmitter.build_message_packets(BENCHMARK_SOURCE_IP, near_message)]
+        results = receiver.decode_repetitions(np.concatenate(list(transmitter.iter_transmission_audio(
+            transmitter.build_multiple_transmissions(near_packets)))))
+        kept_apart = ([info['data'] for info in results] == near_messages and
+                      all(info['heard'] == [str(i + 1) for i in range(len(packets))] for info in results))
+    finally:
+        MODEM.set_symbol_rate(default_rate)
+        transmitter.INTER_TRANSMISSION_PAUSE = default_pause
+
+    print(str(len(packets)) + " repetitions at " + str(symbol_rate) + " symbols/s, messages delivered")
+    print_table(['noise', 'first copy', 'majority', 'soft', 'repetitions combined (soft)'], rows)
+    print("consecutive near-identical messages kept apart: " + str(kept_apart))
+
+
+# compare decoding a directory of captures one after another in this process against the batch decoder with
+# 1, 2, 4... worker processes (up to one per core); the batch decoder should scale close to linearly with cores
+def bench_batch(captures=8, message_length=32, symbol_rate=500):
+    default_rate = MODEM.symbol_rate
+    rows = []
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        MODEM.set_symbol_rate(symbol_rate)
+        try:
+            filenames = []
+            for i in range(captures):
+                packets = transmitter.build_message_packets(BENCHMARK_SOURCE_IP, random_message(message_length, i))
+                transmitter.save_transmission_data(transmitter.build_multiple_transmissions(packets))
+                filenames.append('capture' + str(i) + '.wav')
+                os.rename(WAV_FILENAME, filenames[-1])
+
+            start = time.perf_counter()
+            found = sum(len(receiver.demodulate_all_packets(receiver.load_wav(filename))) for filename in filenames)
+            sequential = time.perf_counter() - start
+            seconds = sum(len(receiver.load_wav(filename)) for filename in filenames) / MODEM.sample_rate
+            rows.append(['sequential', 1, found, round(sequential, 2), round(seconds / sequential, 1), 1.0])
+
+            processes = 1
+            while processes <= os.cpu_count():
+                start = time.perf_counter()
+                results = batch.decode_recordings(filenames, processes)
+                elapsed = time.perf_counter() - start
+                found = sum(len(packets) for _, _, packets in results)
+                rows.append(['batch', processes, found, round(elapsed, 2), round(seconds / elapsed, 1),
+                             round(sequential / elapsed, 2)])
+                processes *= 2
+        finally:
+            os.chdir(cwd)
+            MODEM.set_symbol_rate(default_rate)
+
+    print(str(captures) + " captures, " + str(round(seconds, 1)) + " s of audio at " + str(symbol_rate) +
+          " symbols/s, " + str(os.cpu_count()) + " cores")
+    print_table(['decoder', 'processes', 'packets', 'time (s)', 'x real time', 'speedup'], rows)
+
+
+# the packet code before Packet: build the packet field by field, and parse it back with bitstring
+def legacy_build_packet(source_ip, transmitter_ip, sequence_number, checksum, data):
+    return (PREAMBLE + bytes_from_ip(source_ip) + bytes_from_ip(transmitter_ip) +
+            sequence_number.to_bytes(1, byteorder='big') + len(data).to_bytes(2, byteorder='big') + b'\x00' +
+            checksum + data)
+
+
+def legacy_get_packet_info(bits):
+    data = np.asarray(bits, dtype=np.uint8).tolist()
+    fields = [BitArray(data[start:end]).bytes for start, end in
+              [(0, 32), (32, 64), (64, 96), (96, 104), (104, 120), (120, 128), (128, 256)]]
+    length = BitArray(data[104:120]).int
+    packet = b''.join(fields) + BitArray(data[256:256 + length * 8]).bytes
+
+    checksum = BitArray(bytes(''.join(chr(byte) for byte in packet[16:32]), 'utf-8')).hex
+    return {'source_ip': ip_from_bytes(packet[4:8]), 'transmitter_ip': ip_from_bytes(packet[8:12]),
+            'sn': str(BitArray(packet[12:13]).int), 'data_length': str(BitArray(packet[13:15]).int),
+            'checksum': checksum, 'data': packet[32:]}
+
+
+# check that the packet info parsed from the bits of a packet holds the fields the packet was built from
+def is_round_trip(info, fields):
+    source_ip, transmitter_ip, sequence_number, checksum, data = fields
+    return (info['source_ip'] == source_ip and info['transmitter_ip'] == transmitter_ip and
+            info['sn'] == str(sequence_number) and info['checksum'] == checksum.hex() and info['data'] == data)
+
+
+# packets per second turned into bits for the modulator (pack) and rebuilt from demodulated bits into packet info
+# (unpack), with Packet compared to the old bitstring code; every packet must round trip exactly
+def bench_packets(message_length=64, count=20000):
+    rng = np.random.default_rng(7)
+    messages = [bytes(rng.integers(0, 256, message_length, dtype=np.uint8)) for i in range(100)]
+    fields = [(BENCHMARK_SOURCE_IP, TRANSMITTER_ADDR, i % 256, get_hash(message), message)
+              for i, message in enumerate(messages)]
+
+    codecs = [('Packet', transmitter.build_packet, lambda bits: receiver.get_packet_info(receiver.rebuild_packet(bits)))]
+    if BitArray is not None:
+        codecs.append(('bitstring', legacy_build_packet, legacy_get_packet_info))
+
+    rows = []
+    for name, build, parse in codecs:
+        start = time.perf_counter()
+        for i in range(count):
+            bits = np.unpackbits(np.frombuffer(build(*fields[i % len(fields)]), dtype=np.uint8))
+        pack_rate = count / (time.perf_counter() - start)
+
+        packet_bits = [np.unpackbits(np.frombuffer(build(*packet), dtype=np.uint8)) for packet in fields]
+        start = time.perf_counter()
+        for i in range(count):
+            info = parse(packet_bits[i % len(fields)])
+        unpack_rate = count / (time.perf_counter() - start)
+
+        # sequence numbers over 127 and checksums with bytes of 0x80 and over must survive too
+        intact = all(is_round_trip(parse(bits), packet) for bits, packet in zip(packet_bits, fields))
+        rows.append([name, round(pack_rate), round(unpack_rate), intact])
+
+    print(str(message_length) + " byte messages")
+    print_table(['codec', 'pack (packets/s)', 'unpack (packets/s)', 'round trip'], rows)
+
+
+# get the memory used by this process (its resident set size) in bytes, or None where it cannot be read
+def get_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# write a wav file of seconds of noise in blocks, like the transmitter does
+def write_noise_wav(filename, seconds, block_seconds=10):
+    rng = np.random.default_rng(6)
+    num_samples = int(seconds * MODEM.sample_rate)
+    with open(filename, 'wb') as f:
+        transmitter.write_wav_header(f, num_samples)
+        for start in range(0, num_samples, block_seconds * MODEM.sample_rate):
+            block = min(block_seconds * MODEM.sample_rate, num_samples - start)
+            rng.normal(0, 0.1, block).astype(np.float32).tofile(f)
+
+
+# read every sample of a recording with a reader, returns (seconds taken, largest growth of the memory used)
+# reader returns an iterable of chunks of samples
+def measure_reader(reader):
+    baseline = get_rss()
+    peak = 0
+    start = time.perf_counter()
+    for chunk in reader():
+        np.abs(chunk).sum()
+        if baseline is not None:
+            peak = max(peak, get_rss() - baseline)
+    return time.perf_counter() - start, peak if baseline is not None else None
+
+
+# compare the memory used to read wav files and raw IQ of increasing length whole (scipy.io.wavfile.read, as
+# load_wav did) against reading them in chunks from the memory mapped readers in recordings.py, which should use
+# the same memory however long the file is
+def bench_readers(durations=(60, 240, 960), chunk_size=1 << 16):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for seconds in durations:
+            wav_filename = os.path.join(directory, 'noise.wav')
+            write_noise_wav(wav_filename, seconds)
+            readers = [
+                ('wav (read whole)', lambda: [read(wav_filename)[1]]),
+                ('wav (chunks)', lambda: recordings.open_wav(wav_filename).chunks(chunk_size)),
+            ]
+
+            # rtl_sdr bytes for a tenth of the time, which is about as large
+            iq_filename = os.path.join(directory, 'noise.cu8')
+            with open(iq_filename, 'wb') as f:
+                for i in range(seconds // 10):
+                    np.random.default_rng(i).integers(0, 256, 2 * receiver.RADIO_SAMPLE_RATE, dtype=np.uint8).tofile(f)
+            readers.append(('IQ bytes (chunks)', lambda: recordings.open_iq(iq_filename, 'uint8').chunks(chunk_size)))
+
+            for name, reader in readers:
+                elapsed, peak = measure_reader(reader)
+                size = os.path.getsize(wav_filename if name.startswith('wav') else iq_filename)
+                rows.append([name, round(size / 1e6, 1), round(elapsed, 3), round(size / elapsed / 1e6),
+                             round(peak / 1e6, 1) if peak is not None else 'n/a'])
+            os.remove(wav_filename)
+            os.remove(iq_filename)
+
+    print("chunks of " + str(chunk_size) + " samples")
+    print_table(['reader', 'file (MB)', 'time (s)', 'MB/s', 'peak memory growth (MB)'], rows)
+
+
+# the receive chain before the polyphase resamplers: signal.decimate twice, then an FFT resample
+def legacy_audio_from_radio(radio_samples):
+    dec_rate, sample_rate = receiver.get_fm_sample_rate()
+    samples = signal.decimate(receiver.mix_data_down(radio_samples), dec_rate)
+    demodulated = np.angle(samples[1:] * np.conj(samples[:-1]))
+    x = np.exp(-1 / (sample_rate * 75e-6))
+    demodulated = signal.lfilter([1 - x], [1, -x], demodulated)
+
+    dec_audio = int(sample_rate / MODEM.sample_rate)
+    mono = signal.decimate(demodulated, dec_audio)
+    return signal.resample(mono, int(len(mono) / (sample_rate / dec_audio) * MODEM.sample_rate))
+
+
+# compare the batch and streaming receive chains against the old decimate + FFT resample chain
+# on random radio samples, the cost of each chain does not depend on what was received
+def bench_multirate(seconds=2, repeats=3):
+    rng = np.random.default_rng(4)
+    radio_samples = (rng.normal(size=(seconds * receiver.RADIO_SAMPLE_RATE, 2)) @ [1, 1j]).astype(np.complex64)
+
+    # receive the same samples in chunks, as the radio would deliver them
+    def stream(samples):
+        stages = receiver.ReceivePipeline(receiver.build_radio_stages(in_place=True))
+        chunk_size = receiver.RADIO_CHUNK_SIZE
+        return np.concatenate([stages.process(samples[i:i + chunk_size])
+                               for i in range(0, len(samples), chunk_size)])
+
+    chains = [
+        ('decimate + FFT resample', legacy_audio_from_radio),
+        ('polyphase (batch)', lambda samples: receiver.get_audio_from_radio(samples, in_place=True)[0]),
+        ('polyphase (streaming)', stream),
+    ]
+
+    rows = []
+    for name, chain in chains:
+        times = []
+        for i in range(repeats):
+            samples = radio_samples.copy()  # the chains mix the samples down in place
+            start = time.perf_counter()
+            audio = chain(samples)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        rows.append([name, len(audio), round(best, 3), round(len(radio_samples) / best / 1e6, 2),
+                     round(seconds / best, 1)])
+
+    print(str(seconds) + " s of radio samples at " + str(receiver.RADIO_SAMPLE_RATE) + " Hz")
+    print_table(['chain', 'audio samples', 'time (s)', 'Msamples/s', 'x real time'], rows)
+
+
+# count the bits of the sent packet that differ in the received packet info (bytes missing from either count as
+# 8 errors each), returns (bit errors, bits sent)
+def count_bit_errors(packet, info):
+    received = Packet(info['source_ip'], info['transmitter_ip'], int(info['sn']), bytes.fromhex(info['checksum']),
+                      info['data']).pack()
+    n = min(len(packet), len(received))
+    errors = np.unpackbits(np.bitwise_xor(np.frombuffer(packet[:n], dtype=np.uint8),
+                                          np.frombuffer(received[:n], dtype=np.uint8))).sum()
+    return int(errors) + 8 * abs(len(packet) - len(received)), 8 * len(packet)
+
+
+# send messages end to end through a simulated radio link: transmitter audio is FM modulated into IQ samples
+# (channel.simulate_channel) and decoded by the full receive chain (receiver.get_audio_from_radio ->
+# receiver.decode_audio); conditions are (name, snr in dB or None, frequency error in Hz)
+def bench_loopback(message_lengths=(16, 64, 256), trials=2, symbol_rate=500, offset=0.1,
+                   conditions=(('clean', None, 0), ('SNR -8 dB', -8, 0), ('SNR -11 dB', -11, 0),
+                               ('20 kHz error', 20, 20000), ('35 kHz error', 20, 35000))):
+    rng = np.random.default_rng(6)
+    default_rate = MODEM.symbol_rate
+    recorder = timing.enable(timing.StageSummary())  # collects the stage timings instead of printing progress
+    rows = []
+
+    MODEM.set_symbol_rate(symbol_rate)
+    try:
+        for message_length in message_lengths:
+            message = random_message(message_length)
+            start = time.perf_counter()
+            packet = transmitter.build_packet(BENCHMARK_SOURCE_IP, TRANSMITTER_ADDR, 1, get_hash(message), message)
+            audio = np.concatenate(transmitter.build_transmission(packet))
+            build_time = time.perf_counter() - start
+            airtime = len(audio) / MODEM.sample_rate
+
+            for name, snr, frequency_error in conditions:
+                decode_time = 0.0
+                captured = 0.0
+                delivered = 0
+                errors = 0
+                bits = 0
+                for trial in range(trials):
+                    radio_samples = channel.simulate_channel(audio, offset, snr, frequency_error, rng)
+                    captured += len(radio_samples) / receiver.RADIO_SAMPLE_RATE
+                    start = time.perf_counter()
+                    try:
+                        info = receiver.decode_audio(receiver.get_audio_from_radio(radio_samples)[0])
+                    except ValueError:
+                        info = None  # the data length was corrupted
+                    decode_time += time.perf_counter() - start
+
+                    if info is not None:
+                        delivered += is_intact(info, message)
+                        packet_errors, packet_bits = count_bit_errors(packet, info)
+                        errors += packet_errors
+                        bits += packet_bits
+
+                rows.append([name, message_length, round(airtime, 2), round(build_time, 4),
+                             round(decode_time / trials, 3), round(decode_time / captured, 3),
+                             '%.2e' % (errors / bits) if bits else '-', str(delivered) + '/' + str(trials),
+                             round(delivered * message_length * 8 / (trials * airtime), 1)])
+    finally:
+        MODEM.set_symbol_rate(default_rate)
+        timing.disable()
+
+    print(str(symbol_rate) + " symbols/s, " + str(offset) + " s of carrier before each packet, " + str(trials) +
+          " trials per row")
+    print_table(['channel', 'message (B)', 'airtime (s)', 'build (s)', 'decode (s)', 'RTF', 'BER', 'delivered',
+                 'goodput (bit/s)'], rows)
+    print()
+    recorder.show()
+
+
+# compare turning a capture holding several stations into audio with one chain per station (mixing each station
+# down and decimating it, as get_audio_samples does) against the channelizer of receiver.MultiChannelPipeline,
+# and check that every station's packet is decoded
+def bench_channels(station_counts=(1, 2, 3, 5), seconds=2, symbol_rate=500, snr=0, repeats=3):
+    rng = np.random.default_rng(7)
+    frequencies = [receiver.STATION_FREQ + offset for offset in (0, -200000, -400000, 200000, -600000)]
+    default_rate = MODEM.symbol_rate
+    chunk_size = receiver.RADIO_CHUNK_SIZE
+    rows = []
+
+    # one packet per station, each starting a little later
+    MODEM.set_symbol_rate(symbol_rate)
+    try:
+        messages = [random_message(16, seed=i) for i in range(len(frequencies))]
+        radio_samples = np.zeros(seconds * receiver.RADIO_SAMPLE_RATE, dtype=np.complex64)
+        for i, (frequency, message) in enumerate(zip(frequencies, messages)):
+            samples = channel.simulate_channel(build_packet_audio(message), 0.1 * (i + 1), None,
+                                               frequency - receiver.STATION_FREQ)[:len(radio_samples)]
+            radio_samples[:len(samples)] += samples
+        channel.add_noise(radio_samples, snr, rng)
+
+        def separate_chains(stations):
+            chains = [receiver.ReceivePipeline([NCO(receiver.CENTER_FREQ - frequency, receiver.RADIO_SAMPLE_RATE),
+                                                PolyphaseResampler(1, receiver.get_fm_sample_rate()[0])] +
+                                               receiver.build_fm_stages()) for frequency in stations]
+            for i in range(0, len(radio_samples), chunk_size):
+                for chain in chains:
+                    chain.process(radio_samples[i:i + chunk_size])
+
+        def channelizer(stations):
+            pipeline = receiver.MultiChannelPipeline(stations)
+            chains = [receiver.ReceivePipeline(receiver.build_fm_stages()) for _ in stations]
+            for i in range(0, len(radio_samples), chunk_size):
+                for chain, samples in zip(chains, pipeline.channelizer.process(radio_samples[i:i + chunk_size])):
+                    chain.process(samples)
+
+        times = {}
+        for count in station_counts:
+            stations = frequencies[:count]
+            for name, method in (('separate', separate_chains), ('channelizer', channelizer)):
+                best = None
+                for repeat in range(repeats):
+                    start = time.perf_counter()
+                    method(stations)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times[(name, count)] = best
+
+            # decode the whole capture to check every station's packet gets through the channelizer
+            pipeline = receiver.MultiChannelPipeline(stations)
+            decoded = set()
+            for i in range(0, len(radio_samples), chunk_size):
+                decoded.update(info['frequency'] for info in pipeline.process(radio_samples[i:i + chunk_size])
+                               if info['data'] == messages[frequencies.index(info['frequency'])])
+
+            rows.append([count, round(times[('separate', count)], 3), round(seconds / times[('separate', count)], 1),
+                         round(times[('channelizer', count)], 3), round(seconds / times[('channelizer', count)], 1),
+                         round(times[('separate', count)] / times[('channelizer', count)], 1),
+                         str(len(decoded)) + '/' + str(count)])
+    finally:
+        MODEM.set_symbol_rate(default_rate)
+
+    print(str(seconds) + " s of radio samples holding stations 200 kHz apart at an SNR of " + str(snr) +
+          " dB, turned into audio")
+    print_table(['stations', 'separate (s)', 'x real time', 'channelizer (s)', 'x real time', 'speedup', 'decoded'],
+                rows)
+    first, last = station_counts[0], station_counts[-1]
+    for name in ('separate', 'channelizer'):
+        marginal = (times[(name, last)] - times[(name, first)]) / (last - first) / seconds
+        print("cost of each extra station, " + name + ": " + str(round(marginal, 4)) + " s per s of signal")
+
+
+# compare the receive chain in single precision (complex64/float32) against double precision
+# (complex128/float64): packets sent through the simulated radio link must decode to the same bits in both, and
+# a long capture shows the memory and time each takes
+def bench_precision(message_length=64, snrs=(None, -4, -8, -10), symbol_rate=500, seconds=20):
+    rng = np.random.default_rng(8)
+    default_rate = MODEM.symbol_rate
+    default_dtype = receiver.RADIO_DTYPE
+    timing.enable(timing.StageSummary())  # collects the stage timings instead of printing progress
+    rows = []
+
+    MODEM.set_symbol_rate(symbol_rate)
+    try:
+        message = random_message(message_length)
+        audio = build_packet_audio(message)
+        for snr in snrs:
+            radio_samples = channel.simulate_channel(audio, 0.1, snr, 0, rng)
+            received = {}
+            for dtype in (np.complex128, np.complex64):
+                receiver.RADIO_DTYPE = dtype
+                received[dtype] = receiver.demodulate_all_packets(receiver.get_audio_from_radio(radio_samples)[0])
+
+            single, double = received[np.complex64], received[np.complex128]
+            same = len(single) == len(double) and all(
+                a[0] == b[0] and a[1] == b[1] and np.array_equal(a[2] >= 0.5, b[2] >= 0.5)
+                for a, b in zip(single, double))
+            difference = max((np.max(np.abs(a[2] - b[2])) for a, b in zip(single, double)), default=0)
+            rows.append(['none' if snr is None else snr, len(double), sum(is_intact(info, message)
+                                                                           for _, info, _ in double),
+                         same, '%.1e' % difference])
+    finally:
+        MODEM.set_symbol_rate(default_rate)
+    print(str(message_length) + " byte message through the simulated radio link")
+    print_table(['SNR (dB)', 'packets found', 'intact', 'same bits', 'largest soft bit difference'], rows)
+    print()
+
+    radio_samples = (rng.normal(size=(seconds * receiver.RADIO_SAMPLE_RATE, 2)) @ [1, 1j]).astype(np.complex64)
+    rows = []
+    stages = {}
+    try:
+        for dtype in (np.complex128, np.complex64):
+            receiver.RADIO_DTYPE = dtype
+            samples = radio_samples.copy()  # the chain mixes the samples down in place
+            tracemalloc.start()
+            receiver.get_audio_from_radio(samples, in_place=True)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            samples = radio_samples.copy()
+            recorder = timing.enable(timing.StageSummary())
+            start = time.perf_counter()
+            receiver.get_audio_from_radio(samples, in_place=True)
+            elapsed = time.perf_counter() - start
+            stages[dtype] = {stats['stage']: stats['seconds'] for stats in recorder.summary()}
+            rows.append([np.dtype(dtype).name, round(peak / 2 ** 20), round(elapsed, 2),
+                         round(len(samples) / elapsed / 1e6, 1), round(seconds / elapsed, 1)])
+    finally:
+        receiver.RADIO_DTYPE = default_dtype
+        timing.disable()
+
+    print(str(seconds) + " s of radio samples (" + str(round(radio_samples.nbytes / 2 ** 20)) +
+          " MB of complex64) through get_audio_from_radio")
+    print_table(['precision', 'peak memory (MB)', 'time (s)', 'Msamples/s', 'x real time'], rows)
+    print_table(['stage', 'complex128 (s)', 'complex64 (s)', 'speedup'],
+                [[name, round(stages[np.complex128][name], 3), round(stages[np.complex64][name], 3),
+                  round(stages[np.complex128][name] / stages[np.complex64][name], 1)] for name in stages[np.complex64]])
+
+
+# build a DNS query for the record of a name of the given type (A by default)
+def build_dns_query(name, transaction_id=0x1234, record_type=zones.TYPE_A):
+    question = b''.join(bytes([len(part)]) + part.encode() for part in name.split('.')) + b'\x00'
+    return (struct.pack('!HHHHHH', transaction_id, 0x0100, 1, 0, 0, 0) + question +
+            struct.pack('!HH', record_type, zones.CLASS_IN))
+
+
+# the DNS response code before zones: every name gets an A record for HTTP_ADDR, with the name decoded and encoded
+# again character by character and the flags built as bit strings
+def legacy_build_response(request):
+    name = dnsserver.get_domain_name(request[12:-4])
+    opcode = ''.join(str(request[2] & (1 << bit)) for bit in range(1, 5))
+    flags = int('1' + opcode + '100', 2).to_bytes(1, byteorder='big') + int('00000000', 2).to_bytes(1, byteorder='big')
+    header = request[:2] + flags + b'\x00\x01\x00\x01\x00\x00\x00\x00'
+
+    question = b''
+    for part in name.split('.'):
+        question += bytes([len(part)])
+        for char in part:
+            question += ord(char).to_bytes(1, byteorder='big')
+    question += b'\x00\x01\x00\x01'
+
+    body = b'\xc0\x0c' + question[-4:-2] + question[-2:] + dnsserver.TTL.to_bytes(4, byteorder='big') + b'\x00\x04'
+    return header + question + body + bytes_from_ip(HTTP_ADDR)
+
+
+# the old DNS server loop: one request at a time, printing every request
+def legacy_dns_server(addr, port):
+    sys.stdout = open(os.devnull, 'w')
+    sock = dnsserver.setup(addr, port)
+    while True:
+        request, addr = sock.recvfrom(512)
+        print("Processing request for: " + dnsserver.get_domain_name(request[12:-4]))
+        sock.sendto(legacy_build_response(request), addr)
+
+
+# get a free UDP port on the loopback address
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# measure the queries per second a DNS server on the port answers, keeping window queries in flight
+# returns (queries answered per second, share of queries lost)
+def measure_dns_server(port, seconds=2, window=32):
+    query = build_dns_query('example.com')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.1)
+        for attempt in range(50):  # wait for the server to start
+            sock.sendto(query, ('127.0.0.1', port))
+            try:
+                sock.recv(512)
+                break
+            except socket.timeout:
+                pass
+
+        sent = 0
+        answered = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for i in range(window):
+                sock.sendto(query, ('127.0.0.1', port))
+            sent += window
+            for i in range(window):
+                try:
+                    sock.recv(512)
+                    answered += 1
+                except socket.timeout:
+                    break
+        elapsed = time.perf_counter() - start
+    return answered / elapsed, 1 - answered / sent
+
+
+# compare the queries per second answered by the old blocking DNS server loop against the asyncio server with
+# 1, 2, 4... worker processes (up to one per core)
+def bench_dns(seconds=2, window=32):
+    servers = [('blocking loop', legacy_dns_server, ()), ('asyncio, 1 worker', dnsserver.run_worker, ())]
+    workers = 2
+    while workers <= (os.cpu_count() or 1):
+        servers.append(('asyncio, ' + str(workers) + ' workers', dnsserver.run_workers, (workers,)))
+        workers *= 2
+
+    rows = []
+    for name, target, args in servers:
+        port = get_free_port()
+        server = multiprocessing.Process(target=target, args=('127.0.0.1', port) + args)
+        server.start()
+        try:
+            rate, lost = measure_dns_server(port, seconds, window)
+        finally:
+            server.terminate()
+            server.join()
+        rows.append([name, round(rate), str(round(lost * 100, 1)) + '%'])
+
+    print(str(window) + " queries in flight, " + str(os.cpu_count()) + " core(s)")
+    print_table(['server', 'queries/s', 'lost'], rows)
+
+
+# measure the responses per second answer builds for the queries, going through them repeats times
+def measure_responses(answer, queries, repeats):
+    start = time.perf_counter()
+    for i in range(repeats):
+        for query in queries:
+            answer(query)
+    return len(queries) * repeats / (time.perf_counter() - start)
+
+
+# compare the responses per second built for every query (by the old code and from the default zone) against those
+# answered from the response cache, for queries that ask for one name, for names asked with a skewed popularity,
+# and for more names than the cache keeps
+def bench_dns_cache(count=20000, repeats=3):
+    rng = np.random.default_rng(0)
+    zone = dnsserver.build_default_zone()
+    names = ['host' + str(i) + '.example.com' for i in range(2 * dnsserver.RESPONSE_CACHE_SIZE)]
+    mixes = [
+        ('1 name', [0] * count),
+        ('1000 names, skewed', np.minimum(rng.zipf(1.2, count), 1000) - 1),
+        (str(len(names)) + ' names, uniform', rng.integers(0, len(names), count)),
+    ]
+
+    rows = []
+    for mix, indices in mixes:
+        queries = [build_dns_query(names[i], int(rng.integers(0, 1 << 16))) for i in indices]
+        cache = dnsserver.ResponseCache(zone)
+        assert all(cache.get_response(query) == legacy_build_response(query) for query in queries[:1000])
+        cache = dnsserver.ResponseCache(zone)
+        legacy = measure_responses(legacy_build_response, queries, repeats)
+        built = measure_responses(lambda query: dnsserver.build_response(query, zone), queries, repeats)
+        cached = measure_responses(cache.get_response, queries, repeats)
+        rows.append([mix, round(legacy), round(built), round(cached), round(cached / legacy, 1),
+                     str(round(cache.hits / (cache.hits + cache.misses) * 100, 1)) + '%'])
+
+    print(str(dnsserver.RESPONSE_CACHE_SIZE) + " responses cached")
+    print_table(['queries', 'old code/s', 'zone/s', 'cached/s', 'speedup', 'hit rate'], rows)
+
+
+# write a zone file of count records: mostly A records, then AAAA, CNAME and TXT records, with a wildcard every
+# 1000 records; returns the names of each kind, as (A, CNAME, names matching a wildcard)
+def write_zone_file(filename, count, rng):
+    lines = ['$ORIGIN bench.example.', '$TTL 1h', '@ IN NS ns1', 'ns1 IN A 10.0.0.53']
+    hosts, aliases, wildcards = [], [], []
+    for i in range(count - 2):
+        kind = i % 10
+        if i % 1000 == 999:
+            lines.append('*.wild' + str(i) + ' A 10.1.' + str(i % 256) + '.1')
+            wildcards.append('w' + str(i) + '.wild' + str(i) + '.bench.example')
+        elif kind < 6:
+            address = rng.integers(0, 256, 4)
+            lines.append('host' + str(i) + ' 300 IN A ' + '.'.join(str(byte) for byte in address))
+            hosts.append('host' + str(i) + '.bench.example')
+        elif kind < 8:
+            address = '2001:db8::' + format(i >> 16, 'x') + ':' + format(i & 0xFFFF, 'x')
+            lines.append('host' + str(i - 2) + ' AAAA ' + address)
+        elif kind < 9:
+            lines.append('alias' + str(i) + ' CNAME host' + str(i - 8))
+            aliases.append('alias' + str(i) + '.bench.example')
+        else:
+            lines.append('txt' + str(i) + ' TXT "v=spf1 ip4:10.0.0.0/8 -all" ; record ' + str(i))
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return hosts, aliases, wildcards
+
+
+# microseconds each response takes to build from the zone, going through the queries
+def measure_lookups(zone, queries):
+    start = time.perf_counter()
+    for query in queries:
+        dnsserver.build_response(query, zone)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+# the time and memory large zones take to load, and the time a response takes to build from them for names with
+# records, names behind CNAMEs, names matching wildcards and missing names; then how long queries wait while the
+# largest zone is reloaded
+def bench_zones(sizes=(10000, 100000, 1000000), count=20000):
+    rng = np.random.default_rng(9)
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            filename = os.path.join(directory, 'zone' + str(size))
+            hosts, aliases, wildcards = write_zone_file(filename, size, rng)
+
+            baseline = get_rss()
+            start = time.perf_counter()
+            zone = zones.load_zone(filename)
+            load_time = time.perf_counter() - start
+            memory = get_rss() - baseline if baseline is not None else None
+
+            kinds = [hosts, aliases, wildcards, ['missing' + str(i) + '.bench.example' for i in range(count)]]
+            latencies = []
+            for names in kinds:
+                queries = [build_dns_query(names[i]) for i in rng.integers(0, len(names), count)]
+                latencies.append(round(measure_lookups(zone, queries), 2))
+            rows.append([len(zone), round(load_time, 2), round(len(zone) / load_time),
+                         '-' if memory is None else round(memory / len(zone))] + latencies)
+
+        print("response time in microseconds")
+        print_table(['records', 'load (s)', 'records/s', 'bytes/record', 'A', 'CNAME', 'wildcard', 'missing'], rows)
+        print("relative names follow $ORIGIN: " + str(check_zone_origins()))
+
+        # answer queries while the largest zone reloads, in a thread and in another process as the server does
+        queries = [build_dns_query(hosts[i]) for i in rng.integers(0, len(hosts), count)]
+        rows = []
+        for name, reload in (('thread', reload_in_thread), ('process', dnsserver.load_zone_in_process)):
+            start = time.perf_counter()
+            answered, longest, reloaded = asyncio.run(answer_while_reloading(reload, filename, zone, queries))
+            rows.append([name, round(time.perf_counter() - start, 2), answered, round(longest * 1000, 1),
+                         reloaded.records == zone.records and reloaded.names == zone.names])
+        print()
+        print("while reloading " + str(len(zone)) + " records")
+        print_table(['reload in', 'time (s)', 'responses', 'longest wait (ms)', 'same zone'], rows)
+
+
+# load a zone file in a thread of the default executor, as the server did before loading it in another process
+async def reload_in_thread(filename):
+    return await asyncio.get_running_loop().run_in_executor(None, zones.load_zone, filename)
+
+
+# answer queries from zone, dnsserver.READ_BATCH at a time like a worker, until reload(filename) has loaded the zone
+# again; returns the number of responses, the longest wait between two of them in seconds and the reloaded zone
+async def answer_while_reloading(reload, filename, zone, queries):
+    task = asyncio.ensure_future(reload(filename))
+    answered = 0
+    longest = 0
+    last = time.perf_counter()
+    while not task.done():
+        for i in range(dnsserver.READ_BATCH):
+            dnsserver.build_response(queries[answered % len(queries)], zone)
+            answered += 1
+            now = time.perf_counter()
+            longest = max(longest, now - last)
+            last = now
+        await asyncio.sleep(0)
+    return answered, longest, task.result()
+
+
+# check that relative names repeated across $ORIGIN lines land under the origin in force on their line
+def check_zone_origins():
+    zone = zones.parse_zone(['$ORIGIN a.example.', 'www 60 IN A 192.0.2.1', '$ORIGIN b.example.',
+                             'www 60 IN A 192.0.2.2', ' 60 IN A 192.0.2.3'])
+    answers = [zone.lookup(zones.encode_name(name), zones.TYPE_A.to_bytes(2, byteorder='big'))[1]
+               for name in ('www.a.example.', 'www.b.example.')]
+    return answers == [1, 2]
+
+
+# show where the time goes in the receive chain, and what timing the stages costs
+def bench_stages(seconds=2, repeats=5):
+    rng = np.random.default_rng(5)
+    radio_samples = (rng.normal(size=(seconds * receiver.RADIO_SAMPLE_RATE, 2)) @ [1, 1j]).astype(np.complex64)
+
+    def stream(samples):
+        stages = receiver.ReceivePipeline(receiver.build_radio_stages(in_place=True))
+        chunk_size = receiver.RADIO_CHUNK_SIZE
+        for i in range(0, len(samples), chunk_size):
+            stages.process(samples[i:i + chunk_size])
+
+    stream(radio_samples.copy())  # warm up, so the first setting is not slowed by it
+
+    rows = []
+    for setting in (None, 'summary'):
+        times = []
+        for i in range(repeats):
+            samples = radio_samples.copy()  # the chain mixes the samples down in place
+            recorder = timing.configure(setting)
+            start = time.perf_counter()
+            stream(samples)
+            times.append(time.perf_counter() - start)
+        timing.disable()
+        rows.append([setting or 'disabled', round(min(times), 3), round(seconds / min(times), 1)])
+
+    print(str(seconds) + " s of radio samples at " + str(receiver.RADIO_SAMPLE_RATE) + " Hz, streamed in chunks of " +
+          str(receiver.RADIO_CHUNK_SIZE))
+    print_table(['timing', 'time (s)', 'x real time'], rows)
+    print()
+    recorder.show()
+
+
+BENCHMARKS = {
+    'modes': bench_modulation_modes,
+    'fec': bench_fec,
+    'symbol-rates': bench_symbol_rates,
+    'repetitions': bench_repetitions,
+    'packets': bench_packets,
+    'batch': bench_batch,
+    'readers': bench_readers,
+    'loopback': bench_loopback,
+    'multirate': bench_multirate,
+    'precision': bench_precision,
+    'channels': bench_channels,
+    'stages': bench_stages,
+    'dns': bench_dns,
+    'dns-cache': bench_dns_cache,
+    'zones': bench_zones,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print("== " + name + " ==")
+        BENCHMARKS[name]()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# simulates the radio link, so the receive chain can be exercised without an RTL-SDR or an FM transmitter
+# transmitter audio is broadcast as a mono FM station would be (pre-emphasis, then frequency modulation) and
+# turned into the complex IQ samples the radio would capture at RADIO_SAMPLE_RATE, with the station at
+# OFFSET_FREQ from the centre frequency plus any tuning error, and white noise on top
+import numpy as np
+from dsp import NCO, PolyphaseResampler
+import receiver
+from shared import *
+
+FM_DEVIATION = 75000  # Hz, peak frequency deviation of broadcast FM
+CHANNEL_TAIL = 0.05  # seconds of silent carrier after the audio, so the receive filters can flush the end
+
+
+# boost the treble of audio at sample_rate with a 75us pre-emphasis filter, the inverse of the receiver's
+# de-emphasis filter
+def apply_pre_emphasis(audio, sample_rate):
+    x = np.exp(-1 / (sample_rate * 75e-6))
+    output = np.empty(len(audio))
+    output[0] = audio[0]
+    output[1:] = audio[1:] - x * audio[:-1]
+    return output / (1 - x)
+
+
+# frequency modulate audio at RADIO_SAMPLE_RATE, returns complex64 baseband samples; audio of 1 deviates the
+# carrier by deviation Hz
+def fm_modulate(audio, deviation=FM_DEVIATION):
+    phase = np.cumsum(audio) * (2 * np.pi * deviation / receiver.RADIO_SAMPLE_RATE)
+    return np.exp(1j * phase).astype(np.complex64)
+
+
+# broadcast audio at the transmission sample rate and capture it, returns complex64 IQ samples at
+# RADIO_SAMPLE_RATE
+# offset is the seconds of silent carrier captured before the audio starts, snr the ratio (in dB) of the
+# signal's power to the noise's over the whole captured band (None for no noise), and frequency_error the Hz
+# the station is off from where the receiver expects it
+def simulate_channel(audio, offset=0.0, snr=None, frequency_error=0.0, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    dec_rate, fm_sample_rate = receiver.get_fm_sample_rate()
+    audio = np.concatenate([np.zeros(round(offset * MODEM.sample_rate)), np.asarray(audio, dtype=np.float64),
+                            np.zeros(round(CHANNEL_TAIL * MODEM.sample_rate))])
+
+    # pre-emphasis at the rate of the receiver's de-emphasis, limited to full deviation like a broadcast
+    audio = PolyphaseResampler(fm_sample_rate, MODEM.sample_rate).process(audio)
+    audio = apply_pre_emphasis(audio, fm_sample_rate)
+    audio /= max(np.max(np.abs(audio)), 1e-12)
+
+    samples = fm_modulate(PolyphaseResampler(dec_rate, 1).process(audio))
+    samples = NCO(receiver.OFFSET_FREQ + frequency_error, receiver.RADIO_SAMPLE_RATE, in_place=True).process(samples)
+    if snr is not None:
+        add_noise(samples, snr, rng)
+    return samples
+
+
+# add white noise to complex64 IQ samples in place, snr being the ratio (in dB) of the power of a carrier (1) to
+# the noise's over the whole captured band
+def add_noise(samples, snr, rng):
+    scale = np.sqrt(10 ** (-snr / 10) / 2)  # per component
+    samples += (rng.normal(0, scale, (len(samples), 2)) @ [1, 1j]).astype(np.complex64)
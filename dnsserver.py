@@ -1,150 +1,449 @@
-#!/usr/bin/env python3
-
-from socket import *
-from shared import *
-
-TTL = 3600  # arbitrary value for ttl field
-
-
-# setup udp server
-def setup():
-    addr = '127.0.0.1'
-    port = 53
-    sock = socket(AF_INET, SOCK_DGRAM)
-    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    sock.bind((addr, port))
-
-    return sock
-
-
-# get the flags from the DNS request for the response
-def getflags(flag_bytes):
-    byte1 = bytes(flag_bytes[:1])
-    # byte2 = bytes(flag_bytes[1:])
-
-    qr = '1'  # this is a response
-
-    opcode = ''
-    for bit in range(1, 5):
-        opcode += str(ord(byte1) & (1 << bit))
-
-    aa = '1'  # this is an authoritative answer
-    tc = '0'  # this is not truncated
-    rd = '0'  # recursion is not supported
-    ra = '0'  # recursion is not supported
-    z = '000'  # reserved
-    rcode = '0000'  # assume all queries are successful
-
-    # build response bytes
-    rbyte1 = int(qr + opcode + aa + tc + rd, 2).to_bytes(1, byteorder='big')
-    rbyte2 = int(ra + z + rcode, 2).to_bytes(1, byteorder='big')
-
-    return rbyte1 + rbyte2
-
-
-# get the domain name for the request
-def get_domain_name(domain_name_bytes):
-    expected_length = 0
-    part = ''
-    domain = []
-    length_mode = True
-
-    for byte in domain_name_bytes:
-        if length_mode:
-            expected_length = byte
-            length_mode = False
-        else:
-            if byte == 0:
-                domain.append(part)
-                break
-
-            part += chr(byte)
-            if len(part) == expected_length:
-                domain.append(part + '.')
-                part = ''
-                length_mode = True
-
-    return ''.join(domain)
-
-
-# turn HTTP_ADDR into a byte string
-def get_rdata():
-    return bytes_from_ip(HTTP_ADDR)
-
-
-# build the body of the response
-def build_body(record_type, record_class):
-    offset = b'\xc0\x0c'  # offset of 12
-    record_ttl = TTL.to_bytes(4, byteorder='big')  # arbitrary value
-    rdlength = b'\x00\x04'  # 4 bytes in the record
-    rdata = get_rdata()
-
-    return offset + record_type + record_class + record_ttl + rdlength + rdata
-
-
-# build the question for the response
-def build_question(domain_name_str):
-    domain_bytes = b''
-
-    # build bytes for the domain name
-    for part in domain_name_str.split('.'):
-        domain_bytes += bytes([len(part)])
-
-        for char in part:
-            domain_bytes += ord(char).to_bytes(1, byteorder='big')
-
-    # record type information
-    record_type = b'\x00\x01'  # for A record type
-    class_type = b'\x00\x01'  # for IN class type
-
-    return domain_bytes + record_type + class_type
-
-
-# build the response header
-def build_header(header_data):
-    # transaction id
-    transaction_id = header_data[:2]  # first 2 bytes
-
-    # flags
-    flags = getflags(header_data[2:4])
-
-    # question count
-    qdcount = b'\x00\x01'
-
-    # answer count
-    ancount = b'\x00\x01'
-
-    # nameserver count
-    nscount = b'\x00\x00'
-
-    # additional records
-    arcount = b'\x00\x00'
-
-    return transaction_id + flags + qdcount + ancount + nscount + arcount
-
-
-# build the response
-def build_response(request):
-    name = get_domain_name(request[12:-4])
-    print("Processing request for: " + name)
-
-    header = build_header(request[:12])
-    question = build_question(name)
-    body = build_body(question[-4:-2], question[-2:])
-
-    return header + question + body
-
-
-if __name__ == "__main__":
-    sock = setup()
-
-    # listen for connections until SIGTERM is received
-    print("DNS server started. Use ^C to exit")
-
-    while True:
-        # get DNS request, 512 byte packets use UDP
-        request, addr = sock.recvfrom(512)
-
-        # build & send response
-        response = build_response(request)
-        sock.sendto(response, addr)
+#!/usr/bin/env python3
+
+# run ./dnsserver.py [<address> [<port> [<workers> [<zone file>]]]] to answer on an address other than
+# DNS_ADDR:DNS_PORT, with several worker processes sharing the port, or from the records of a zone file
+# (see zones.py) rather than with HTTP_ADDR for every name; send SIGHUP to reload the zone file
+import asyncio
+import os
+import signal
+import struct
+import sys
+from collections import OrderedDict
+from multiprocessing import Pipe, Process
+from time import monotonic
+from socket import *
+import zones
+from shared import *
+
+TTL = 3600  # seconds, ttl of the records answering every name while there is no zone file
+ZONE_FILE = None  # zone file to answer from, None to answer every name with HTTP_ADDR
+ZONE_CHECK_INTERVAL = 5  # seconds between checks of whether the zone file changed, None to only reload on SIGHUP
+ZONE_RELOAD_CHUNK = 10000  # records or names handed over at a time by the process reloading a zone
+DNS_WORKERS = 1  # processes answering queries; several share the port with SO_REUSEPORT
+MAX_REQUEST_SIZE = 512  # bytes, DNS requests over UDP are at most 512 bytes
+MAX_RESPONSE_SIZE = 512  # bytes, larger responses are truncated to their question, so clients ask over TCP
+LOG_INTERVAL = 1  # seconds between the log lines of a worker
+READ_BATCH = 64  # requests answered each time the socket is readable before other events get a turn
+RESPONSE_CACHE_SIZE = 4096  # responses kept by each worker, for the most recently asked questions
+
+# the header of a response after its transaction id: flags, and the number of questions, answers, name servers and
+# additional records
+HEADER = struct.Struct('!BBHHHH')
+FLAG_QR = 0x80  # a response
+OPCODE_MASK = 0x78  # the kind of request, 0 for a standard query
+FLAG_AA = 0x04  # an authoritative answer
+FLAG_TC = 0x02  # truncated
+CLASS_IN = zones.CLASS_IN.to_bytes(2, byteorder='big')
+
+
+# setup udp server
+# with reuse_port, several sockets (e.g. one per worker process) can be bound to the same address and port, and
+# the kernel spreads the requests between them
+def setup(addr=DNS_ADDR, port=DNS_PORT, reuse_port=False):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        if 'SO_REUSEPORT' not in globals():  # not every system has it
+            raise RuntimeError("SO_REUSEPORT is needed to run several workers on this system")
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((addr, port))
+
+    return sock
+
+
+# get the domain name for the request
+def get_domain_name(domain_name_bytes):
+    expected_length = 0
+    part = ''
+    domain = []
+    length_mode = True
+
+    for byte in domain_name_bytes:
+        if length_mode:
+            expected_length = byte
+            length_mode = False
+        else:
+            if byte == 0:
+                domain.append(part)
+                break
+
+            part += chr(byte)
+            if len(part) == expected_length:
+                domain.append(part + '.')
+                part = ''
+                length_mode = True
+
+    return ''.join(domain)
+
+
+# get the question of a request (the name, type and class of its first question) as it is on the wire
+# raises ValueError if the request ends before the question does
+def get_question(request):
+    end = 12
+    while True:
+        if end >= len(request):
+            raise ValueError("request ends inside the question")
+        length = request[end]
+        if length == 0:
+            break
+        if length > 63:
+            raise ValueError("question name has a compressed or invalid label")
+        end += length + 1
+
+    end += 5  # the root label, type and class
+    if end > len(request):
+        raise ValueError("request ends inside the question")
+    return bytes(request[12:end])
+
+
+# build a zone that answers every name with an A record for HTTP_ADDR
+def build_default_zone():
+    zone = zones.Zone()
+    zone.add(b'\x01*' + zones.ROOT, zones.TYPE_A, TTL, bytes_from_ip(HTTP_ADDR))
+    return zone
+
+
+# load the zone to answer from: the records of filename, or the default zone if it is None
+def load_zone(filename=ZONE_FILE):
+    if filename is None:
+        return build_default_zone()
+
+    print("Loading zone from " + filename + "...", end='', flush=True)
+    zone = zones.load_zone(filename)
+    print("done, " + describe_zone(zone))
+    return zone
+
+
+# describe the records of a zone for messages
+def describe_zone(zone):
+    skipped = ''.join(", skipped " + str(count) + " " + name + " records" for name, count in zone.skipped.items())
+    return str(len(zone)) + " records" + skipped
+
+
+# keeps the responses to recently asked questions of a zone, so each question is only answered from the zone once
+# the response to a standard query only depends on the request through its transaction id and its question, so
+# the rest of the response is kept per question (the name, type and class as they are on the wire) and the
+# transaction id is patched in for every request; the least recently asked questions are dropped once there are
+# more than max_entries, and responses are rebuilt once the smallest TTL of their records has passed
+# a cache belongs to one zone: a reloaded zone starts with an empty cache
+class ResponseCache:
+    def __init__(self, zone, max_entries=RESPONSE_CACHE_SIZE):
+        self.zone = zone
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # question -> (expiry time, response from the flags on)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # get the response to a request; raises ValueError for requests that cannot be answered
+    def get_response(self, request):
+        if len(request) > 2 and request[2] & OPCODE_MASK:
+            return build_response(request, self.zone)[0]  # not a standard query, and not worth keeping
+
+        question = get_question(request)
+        entry = self.entries.get(question)
+        now = monotonic()
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(question)
+            self.hits += 1
+            return request[:2] + entry[1]
+
+        self.misses += 1
+        response, ttl = build_response(request, self.zone)
+        self.entries[question] = (now + ttl, response[2:])
+        self.entries.move_to_end(question)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return response
+
+
+# build the response to a request from the records of a zone
+# the response is authoritative, and neither recursion nor requests other than standard queries are supported
+# returns (response, seconds the response stays valid); raises ValueError for requests that cannot be answered
+def build_response(request, zone):
+    if len(request) < 12:
+        raise ValueError("request is too short")
+    opcode = request[2] & OPCODE_MASK
+    if opcode:
+        return request[:2] + bytes([FLAG_QR | opcode | FLAG_AA, zones.RCODE_NOTIMP]) + bytes(8), 0
+
+    question = get_question(request)
+    if question[-2:] == CLASS_IN:
+        rcode, count, answers, ttl = zone.lookup(question[:-4], question[-4:-2])
+    else:
+        rcode, count, answers, ttl = zones.RCODE_REFUSED, 0, b'', zone.negative_ttl
+
+    response = request[:2] + HEADER.pack(FLAG_QR | FLAG_AA, rcode, 1, count, 0, 0) + question + answers
+    if len(response) > MAX_RESPONSE_SIZE:
+        response = request[:2] + HEADER.pack(FLAG_QR | FLAG_AA | FLAG_TC, rcode, 1, 0, 0, 0) + question
+    return response, ttl
+
+
+# prints at most one message every interval seconds, counting the messages that were dropped in between
+# check ready() before building a message, so messages that would be dropped cost nothing to make
+class RateLimitedLog:
+    def __init__(self, interval=LOG_INTERVAL):
+        self.interval = interval
+        self.last = None  # time of the last message printed
+        self.dropped = 0
+
+    # check whether a message would be printed now, counting it as dropped if not
+    def ready(self):
+        if self.last is not None and monotonic() - self.last < self.interval:
+            self.dropped += 1
+            return False
+        return True
+
+    def log(self, message):
+        if self.dropped:
+            message += " (" + str(self.dropped) + " more messages)"
+        print(message, flush=True)
+        self.last = monotonic()
+        self.dropped = 0
+
+
+# answers DNS requests arriving on a non-blocking UDP socket, from the asyncio event loop
+# whenever the socket is readable, the requests waiting on it are answered in a batch of up to READ_BATCH, which
+# saves a trip through the event loop for every request; a request that cannot be answered is dropped, and only
+# delays the requests behind it by the time it took to look at
+# the worker counts its requests, and logs them no more than once every LOG_INTERVAL
+class DNSWorker:
+    def __init__(self, sock, zone, worker_id=0, log_interval=LOG_INTERVAL):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.worker_id = worker_id
+        self.cache = ResponseCache(zone)
+        self.cache_hits = 0  # of the caches of zones that were replaced
+        self.cache_misses = 0
+        self.log = RateLimitedLog(log_interval)
+        self.started = monotonic()
+        self.requests = 0
+        self.responses = 0
+        self.errors = 0
+
+    # answer the requests waiting on the socket
+    def read_ready(self):
+        for _ in range(READ_BATCH):
+            try:
+                request, addr = self.sock.recvfrom(MAX_REQUEST_SIZE + 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.errors += 1  # e.g. an earlier response could not be delivered
+                continue
+
+            self.requests += 1
+            response = self.answer(request, addr)
+            if response is None:
+                self.errors += 1
+                continue
+            try:
+                self.sock.sendto(response, addr)
+                self.responses += 1
+            except OSError:
+                self.errors += 1  # e.g. the send buffer is full; the client will ask again
+
+    # build the response to a request, returns None if it cannot be answered
+    def answer(self, request, addr):
+        if len(request) > MAX_REQUEST_SIZE or len(request) > 2 and request[2] & 0x80:
+            return None  # too long for DNS over UDP, or a response rather than a query
+
+        try:
+            response = self.cache.get_response(request)
+        except (ValueError, IndexError):
+            if self.log.ready():
+                self.log.log("Worker " + str(self.worker_id) + ": dropped malformed request from " + addr[0])
+            return None
+
+        if self.log.ready():
+            self.log.log("Worker " + str(self.worker_id) + ": processing request for: " +
+                         get_domain_name(request[12:-4]) + " (" + str(self.requests) + " requests)")
+        return response
+
+    # answer from another zone from now on, e.g. once the zone file was reloaded
+    def set_zone(self, zone):
+        self.cache_hits += self.cache.hits
+        self.cache_misses += self.cache.misses
+        self.cache = ResponseCache(zone)
+
+    # get the counters of the worker
+    def stats(self):
+        elapsed = monotonic() - self.started
+        return {
+            'worker': self.worker_id,
+            'requests': self.requests,
+            'responses': self.responses,
+            'errors': self.errors,
+            'requests_per_second': self.requests / elapsed if elapsed > 0 else 0.0,
+            'cache_hits': self.cache_hits + self.cache.hits,
+            'cache_misses': self.cache_misses + self.cache.misses,
+        }
+
+
+# get the time a file was last changed, None if it cannot be read
+def get_modified_time(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+# load a zone file in a process of its own and send it over connection: the zone's counters, then its records and
+# names a chunk at a time, then None; if the file cannot be loaded, the error is sent instead
+# the chunks are lists of bytes rather than of (key, records) tuples, which the garbage collector would have to
+# go through, holding up requests, once there are enough of them
+def send_zone(filename, connection):
+    # the signal handlers of the worker were inherited, leave ^C and SIGTERM to stop this process
+    signal.set_wakeup_fd(-1)
+    for signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signal_number, signal.SIG_DFL)
+
+    try:
+        zone = zones.load_zone(filename)
+    except (OSError, ValueError) as e:
+        connection.send(e)
+        return
+    connection.send((zone.count, zone.skipped, zone.negative_ttl))
+    keys = list(zone.records)
+    records = list(zone.records.values())
+    for i in range(0, len(keys), ZONE_RELOAD_CHUNK):
+        connection.send((keys[i:i + ZONE_RELOAD_CHUNK], records[i:i + ZONE_RELOAD_CHUNK]))
+    names = list(zone.names)
+    for i in range(0, len(names), ZONE_RELOAD_CHUNK):
+        connection.send((names[i:i + ZONE_RELOAD_CHUNK], None))
+    connection.send(None)
+
+
+# load a zone file in another process (see send_zone), so parsing it does not hold up the requests of this one
+# the zone comes back in chunks, each read in a thread and added to the new zone between requests; a single
+# pickled zone of a million records would hold the interpreter for as long as it takes to unpickle
+async def load_zone_in_process(filename):
+    loop = asyncio.get_running_loop()
+    connection, child_connection = Pipe(duplex=False)
+    loader = Process(target=send_zone, args=(filename, child_connection), daemon=True)
+    loader.start()
+    child_connection.close()
+    try:
+        message = await loop.run_in_executor(None, connection.recv)
+        if isinstance(message, Exception):
+            raise message
+        zone = zones.Zone()
+        zone.count, zone.skipped, zone.negative_ttl = message
+        while True:
+            message = await loop.run_in_executor(None, connection.recv)
+            if message is None:
+                return zone
+            keys, records = message
+            if records is None:
+                zone.names.update(dict.fromkeys(keys))
+            else:
+                zone.records.update(zip(keys, records))
+    except EOFError:
+        raise OSError("the process loading " + filename + " exited before sending the zone") from None
+    finally:
+        if loader.is_alive():
+            loader.terminate()
+        await loop.run_in_executor(None, loader.join)
+        connection.close()
+
+
+# reload the zone a worker answers from whenever its file changes, or reload is set (on SIGHUP)
+# the zone is loaded in another process and swapped in once it is complete, so requests are answered from the old
+# zone (and its cache) until then rather than waiting; a zone file that cannot be loaded leaves the old zone in place
+async def watch_zone(worker, filename, reload):
+    modified = get_modified_time(filename)
+    while True:
+        try:
+            await asyncio.wait_for(reload.wait(), ZONE_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            if get_modified_time(filename) == modified:
+                continue
+        reload.clear()
+        modified = get_modified_time(filename)
+
+        start = monotonic()
+        try:
+            zone = await load_zone_in_process(filename)
+        except (OSError, ValueError) as e:
+            print("Worker " + str(worker.worker_id) + ": kept the old zone, " + str(e), flush=True)
+            continue
+        worker.set_zone(zone)
+        print("Worker " + str(worker.worker_id) + ": reloaded " + filename + " in " +
+              str(round(monotonic() - start, 2)) + " s, " + describe_zone(zone), flush=True)
+
+
+# answer requests on the given address until SIGINT (^C) or SIGTERM is received
+# the records come from zone, or are loaded from zone_file (see load_zone), which is reloaded when it changes
+async def serve(addr=DNS_ADDR, port=DNS_PORT, worker_id=0, reuse_port=False, zone_file=ZONE_FILE, zone=None):
+    loop = asyncio.get_running_loop()
+    sock = setup(addr, port, reuse_port)
+    worker = DNSWorker(sock, load_zone(zone_file) if zone is None else zone, worker_id)
+    loop.add_reader(sock.fileno(), worker.read_ready)
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    reload = asyncio.Event()
+    loop.add_signal_handler(signal.SIGHUP, reload.set)
+    watcher = None if zone_file is None else asyncio.create_task(watch_zone(worker, zone_file, reload))
+    try:
+        await stop.wait()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        loop.remove_reader(sock.fileno())
+        sock.close()
+        stats = worker.stats()
+        print("Worker " + str(worker_id) + ": " + str(stats['requests']) + " requests, " +
+              str(stats['responses']) + " responses, " + str(stats['errors']) + " errors, " +
+              str(round(stats['requests_per_second'])) + " requests/s, " + str(stats['cache_hits']) +
+              " cache hits, " + str(stats['cache_misses']) + " cache misses", flush=True)
+
+
+# run a worker until it is stopped (see serve)
+def run_worker(addr, port, worker_id=0, reuse_port=False, zone_file=ZONE_FILE, zone=None):
+    asyncio.run(serve(addr, port, worker_id, reuse_port, zone_file, zone))
+
+
+# pass a signal on to processes
+def forward_signal(signal_number, processes):
+    for process in processes:
+        if process.pid is not None:
+            os.kill(process.pid, signal_number)
+
+
+# answer requests with the given number of worker processes, which share the port, until ^C is pressed
+# the zone is loaded once and handed to the workers, and SIGHUP is passed on to them to reload it
+def run_workers(addr=DNS_ADDR, port=DNS_PORT, workers=DNS_WORKERS, zone_file=ZONE_FILE):
+    if workers == 1:
+        run_worker(addr, port, zone_file=zone_file)
+        return
+
+    setup(addr, port, reuse_port=True).close()  # fail here, not in every worker, if the port cannot be shared
+    zone = load_zone(zone_file)
+    processes = [Process(target=run_worker, args=(addr, port, i, True, zone_file, zone)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGHUP, lambda signal_number, frame: forward_signal(signal_number, processes))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # stop every worker, which prints its counters, whether or not it got the ^C as well
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    addr = sys.argv[1] if len(sys.argv) > 1 else DNS_ADDR
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DNS_PORT
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else DNS_WORKERS
+    zone_file = sys.argv[4] if len(sys.argv) > 4 else ZONE_FILE
+
+    # listen for requests until SIGTERM is received
+    print("DNS server started on " + addr + ":" + str(port) + " with " + str(workers) + " worker(s). Use ^C to exit")
+    run_workers(addr, port, workers, zone_file)
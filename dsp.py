@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# stateful DSP stages for the receive chain
+# every stage has a process() method that takes the next chunk of samples and returns the output for
+# that chunk; state is carried across calls, so feeding a signal in chunks gives the same result as
+# feeding it all at once
+# stages work in the precision of the samples they are first given: complex64 and float32 samples stay
+# single precision through the chain, so no stage moves more bytes than it needs to
+import numpy as np
+import scipy.signal as signal
+from numpy.lib.stride_tricks import sliding_window_view
+from math import gcd
+
+MAX_NCO_PERIOD = 1 << 20  # longest oscillator period kept in a table, in samples
+
+
+# numerically controlled oscillator: shifts the frequency of complex samples, keeping the phase
+# continuous across chunks
+# when the frequency is a whole number of Hz, the oscillator repeats every sample_rate / gcd(frequency,
+# sample_rate) samples and is read from a precomputed table of one period; otherwise the phase is
+# accumulated per chunk; the oscillator is made in dtype (complex64 or complex128)
+class NCO:
+    def __init__(self, frequency, sample_rate, in_place=False, dtype=np.complex64):
+        self.step = 2 * np.pi * frequency / sample_rate  # phase advance per sample
+        self.in_place = in_place  # multiply chunks of dtype in place instead of returning new arrays
+        self.dtype = np.dtype(dtype)
+        self.phase = 0.0
+        self.position = 0  # position in the table of the next sample
+        self.table = None
+        self.period = None
+
+        if float(frequency).is_integer() and float(sample_rate).is_integer():
+            period = int(sample_rate) // gcd(abs(int(frequency)), int(sample_rate))
+            if period <= MAX_NCO_PERIOD:
+                self.period = period
+                self.table = np.exp(1j * self.step * np.arange(period)).astype(self.dtype)
+
+    # get the oscillator for the next n samples
+    def next(self, n):
+        if self.table is None:
+            oscillator = np.exp(1j * (self.phase + self.step * np.arange(n))).astype(self.dtype)
+            self.phase = (self.phase + self.step * n) % (2 * np.pi)
+            return oscillator
+
+        # extend the table with whole periods so any n samples can be read as one slice
+        if len(self.table) < self.position + n:
+            self.table = np.tile(self.table[:self.period], -(-(n + self.period) // self.period))
+        oscillator = self.table[self.position:self.position + n]
+        self.position = (self.position + n) % self.period
+        return oscillator
+
+    # move the oscillator to the given sample of the signal, e.g. to mix a block from the middle of a capture
+    def seek(self, sample):
+        if self.table is None:
+            self.phase = self.step * sample % (2 * np.pi)
+        else:
+            self.position = sample % self.period
+
+    def process(self, samples):
+        oscillator = self.next(len(samples))
+        if self.in_place and samples.dtype == self.dtype and samples.flags.writeable:
+            samples *= oscillator
+            return samples
+        return samples * oscillator
+
+
+# FM demodulates complex samples with a polar discriminator
+class Discriminator:
+    def __init__(self):
+        self.last = None  # last sample of the previous chunk
+
+    def process(self, samples):
+        if len(samples) == 0:
+            return np.zeros(0, dtype=samples.real.dtype)
+
+        previous = np.empty_like(samples)
+        previous[1:] = samples[:-1]
+        previous[0] = samples[0] if self.last is None else self.last
+        self.last = samples[-1]
+        np.conjugate(previous, out=previous)
+        previous *= samples
+        return np.angle(previous)
+
+
+# FM de-emphasis filter with a 75us time constant
+class DeEmphasis:
+    def __init__(self, sample_rate):
+        d = sample_rate * 75e-6  # number of samples to hit -3dB point
+        x = np.exp(-1 / d)  # decay between each sample
+        self.b = np.array([1 - x])
+        self.a = np.array([1, -x])
+        self.zi = None
+
+    def process(self, samples):
+        if self.zi is None:
+            dtype = np.result_type(samples, np.float32)
+            self.b = self.b.astype(dtype)
+            self.a = self.a.astype(dtype)
+            self.zi = np.zeros(1, dtype=dtype)
+
+        output, self.zi = signal.lfilter(self.b, self.a, samples, zi=self.zi)
+        return output
+
+
+# anti-aliasing FIR filters for rational resampling, keyed by (up, down, dtype)
+_resampler_taps = {}
+
+
+# get the FIR filter used to resample by up / down, designing it only once per configuration
+# (the same Kaiser window design as scipy.signal.resample_poly)
+def get_resampler_taps(up, down, dtype=np.float64):
+    key = (up, down, np.dtype(dtype))
+    if key not in _resampler_taps:
+        max_rate = max(up, down)
+        half_length = 10 * max_rate
+        taps = signal.firwin(2 * half_length + 1, 1 / max_rate, window=('kaiser', 5.0)) * up
+        _resampler_taps[key] = taps.astype(dtype)
+    return _resampler_taps[key]
+
+
+# changes the sample rate by up / down with a polyphase FIR filter (decimates when up is 1)
+# scipy's upfirdn only evaluates the filter phases that produce output samples; the last input samples
+# are kept between chunks, and the filter is causal, so the output is delayed by half the filter length
+class PolyphaseResampler:
+    def __init__(self, up, down):
+        divisor = gcd(up, down)
+        self.up = up // divisor
+        self.down = down // divisor
+        self.filter = get_resampler_taps(self.up, self.down)
+
+        # input samples each output depends on, plus slack to start every chunk on a multiple of down
+        self.history_length = -(-len(self.filter) // self.up) - 1 + self.down - 1
+        self.history = None
+        self.consumed = 0  # input samples processed so far
+        self.produced = 0  # output samples produced so far
+
+    def process(self, samples):
+        if self.history is None:
+            dtype = np.result_type(samples, np.float32)
+            self.filter = get_resampler_taps(self.up, self.down, np.finfo(dtype).dtype)
+            self.history = np.zeros(self.history_length, dtype=dtype)
+
+        extended = np.concatenate([self.history, samples])
+        first = self.consumed - self.history_length  # input index of extended[0]
+        self.history = extended[len(extended) - self.history_length:]
+        self.consumed += len(samples)
+
+        # filter from an input index that is a multiple of down, so output k lines up with output
+        # (start // down) * up + k of the whole signal
+        skip = -first % self.down
+        start = (first + skip) // self.down * self.up
+        end = (self.consumed * self.up - 1) // self.down + 1  # outputs whose last input has arrived
+        output = self.filter_samples(extended[skip:])
+        output = output[self.produced - start:end - start]
+        self.produced = end
+        return output
+
+    # upfirdn is much faster on real samples, so complex samples are filtered as two real signals
+    def filter_samples(self, samples):
+        if np.iscomplexobj(samples):
+            real = self.filter_samples(samples.real)
+            output = np.empty(len(real), dtype=np.result_type(real, np.complex64))
+            output.real = real
+            output.imag = self.filter_samples(samples.imag)
+            return output
+        return signal.upfirdn(self.filter, samples, self.up, self.down)
+
+
+# splits complex samples into several channels with a polyphase DFT filter bank, decimating each by decimation
+# the filter bank has a bin every spacing Hz (sample_rate must be a multiple of spacing), and every channel is
+# centred on one of them, at its offset (in Hz) from the centre of the samples; each bin is the low-pass filter
+# of PolyphaseResampler(1, decimation) shifted to its frequency, evaluated only for the samples kept, so the
+# output of each channel matches mixing it down with an NCO and decimating it with PolyphaseResampler
+# the bins are finely spaced to fit the station grid, so a full FFT for every output sample would cost more
+# than filtering; instead only the selected bins are evaluated, as a single matrix product of the windows of
+# input samples with the filter of every channel, which shares the windowing and makes each channel cheap
+class Channelizer:
+    def __init__(self, offsets, sample_rate, decimation, spacing):
+        if sample_rate % spacing != 0:
+            raise ValueError("the sample rate must be a multiple of the channel spacing")
+        if any(offset % spacing != 0 or abs(offset) >= sample_rate / 2 for offset in offsets):
+            raise ValueError("channel offsets must be multiples of the channel spacing within the samples")
+        bins = int(sample_rate // spacing)
+        channels = np.array([int(offset // spacing) % bins for offset in offsets])
+        self.decimation = decimation
+
+        # the filter of every channel, in the order of the samples of a window (oldest first)
+        taps = get_resampler_taps(1, decimation)[::-1]
+        age = np.arange(len(taps) - 1, -1, -1)  # samples before the newest sample of the window
+        filters = taps[:, None] * np.exp(2j * np.pi * np.outer(age, channels) / bins)
+
+        # complex samples are multiplied as interleaved real and imaginary parts, as one real matrix product
+        # giving the real parts of every channel, then their imaginary parts
+        self.filters = np.zeros((2 * len(taps), 2 * len(channels)), dtype=np.float32)
+        self.filters[0::2, :len(channels)] = filters.real
+        self.filters[1::2, :len(channels)] = -filters.imag
+        self.filters[0::2, len(channels):] = filters.imag
+        self.filters[1::2, len(channels):] = filters.real
+
+        # the bins turn as the newest sample of the window advances by decimation, so each channel is turned back
+        # by a table of phases, which repeats after a whole number of turns
+        period = bins // gcd(decimation, bins)
+        self.rotations = np.exp(-2j * np.pi * np.outer(np.arange(period) * decimation, channels) / bins)
+        self.rotations = self.rotations.astype(np.complex64)
+
+        self.history = np.zeros(len(taps) - 1, dtype=np.complex64)
+        self.consumed = 0  # input samples processed so far
+        self.produced = 0  # output samples of each channel produced so far
+
+    # returns a (channels x samples) array of the output of every channel
+    def process(self, samples):
+        extended = np.concatenate([self.history, np.asarray(samples, dtype=np.complex64)])
+        start = self.produced * self.decimation - self.consumed  # window of the next output within the new samples
+        self.consumed += len(samples)
+        end = -(-self.consumed // self.decimation)  # outputs whose newest sample has arrived
+        self.history = extended[len(extended) - len(self.history):]
+
+        n = end - self.produced
+        if n == 0:
+            return np.zeros((len(self.rotations[0]), 0), dtype=np.complex64)
+        interleaved = extended.view(np.float32)
+        windows = sliding_window_view(interleaved, len(self.filters))[2 * start::2 * self.decimation][:n]
+        output = np.ascontiguousarray(windows) @ self.filters
+        channels = len(self.rotations[0])
+        output = output[:, :channels] + 1j * output[:, channels:]
+        output *= self.rotations[(self.produced + np.arange(n)) % len(self.rotations)]
+        self.produced = end
+        return np.ascontiguousarray(output.T)
+
+
+# scales samples so their recent peak is 1, which keeps the audio at the level the demodulator expects
+class AutomaticGain:
+    def __init__(self, decay=0.999, in_place=False):
+        self.decay = decay  # per chunk
+        self.in_place = in_place  # scale floating point chunks in place instead of returning new arrays
+        self.peak = 0.0
+
+    def process(self, samples):
+        if len(samples) == 0:
+            return samples
+
+        self.peak = max(self.peak * self.decay, float(np.max(np.abs(samples))))
+        if self.peak == 0:
+            return samples
+        if self.in_place and samples.dtype.kind == 'f' and samples.flags.writeable:
+            samples *= 1 / self.peak
+            return samples
+        return samples / self.peak
+
+
+# growable buffer of samples that supports appending at the end and consuming from the front
+class SampleBuffer:
+    def __init__(self, dtype=np.float32, capacity=1 << 16):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    # get a view of the buffered samples
+    def view(self):
+        return self.data[self.start:self.end]
+
+    def append(self, samples):
+        n = len(samples)
+        if self.end + n > len(self.data):
+            # move the samples to the front, growing the buffer if it would be more than half full
+            size = len(self) + n
+            capacity = len(self.data)
+            while capacity < 2 * size:
+                capacity *= 2
+
+            data = self.data if capacity == len(self.data) else np.zeros(capacity, dtype=self.data.dtype)
+            data[:len(self)] = self.view()
+            self.data = data
+            self.end = len(self)
+            self.start = 0
+
+        self.data[self.end:self.end + n] = samples
+        self.end += n
+
+    # drop n samples from the front
+    def consume(self, n):
+        self.start += min(n, len(self))
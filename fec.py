@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# forward error correction for packets
+# bits are protected with a K=7 convolutional code (generators 171, 133 octal), punctured to the
+# configured rate and block interleaved so bursts of errors are spread across the code
+import numpy as np
+
+CONSTRAINT_LENGTH = 7
+GENERATORS = (0o171, 0o133)
+INTERLEAVER_DEPTH = 16  # rows of the block interleaver
+
+# puncturing patterns for each code rate, one row per generator (1 = coded bit is sent)
+PUNCTURE_PATTERNS = {
+    '1/2': np.array([[1], [1]], dtype=bool),
+    '2/3': np.array([[1, 1], [1, 0]], dtype=bool),
+    '3/4': np.array([[1, 1, 0], [1, 0, 1]], dtype=bool),
+}
+
+NUM_STATES = 1 << (CONSTRAINT_LENGTH - 1)
+
+
+# get the taps of a generator polynomial, with taps[0] applied to the newest input bit
+def get_taps(generator):
+    return np.array([(generator >> (CONSTRAINT_LENGTH - 1 - i)) & 1 for i in range(CONSTRAINT_LENGTH)], dtype=np.uint8)
+
+
+# get the coded bits produced by every (state, input bit) pair
+# a state holds the previous 6 input bits, with bit 0 being the most recent
+def get_trellis_outputs():
+    outputs = np.zeros((NUM_STATES, 2, len(GENERATORS)), dtype=np.float32)
+    for state in range(NUM_STATES):
+        for bit in range(2):
+            register = [bit] + [(state >> i) & 1 for i in range(CONSTRAINT_LENGTH - 1)]
+            for j, generator in enumerate(GENERATORS):
+                outputs[state, bit, j] = np.dot(get_taps(generator), register) & 1
+    return outputs
+
+
+TRELLIS_OUTPUTS = get_trellis_outputs()
+
+
+# convolutionally encode the bits, flushing the encoder back to state 0 at the end
+# returns one row of coded bits per generator
+def conv_encode(bits):
+    bits = np.concatenate([np.asarray(bits, dtype=np.uint8), np.zeros(CONSTRAINT_LENGTH - 1, dtype=np.uint8)])
+    return np.stack([np.convolve(bits, get_taps(g))[:len(bits)] & 1 for g in GENERATORS]).astype(np.uint8)
+
+
+# decode (generators x steps) received values with the Viterbi algorithm
+# values are soft decisions between 0 and 1 (hard bits work too, 0.5 marks a punctured bit)
+# returns the num_bits decoded input bits
+def viterbi_decode(received, num_bits):
+    steps = received.shape[1]
+    states = np.arange(NUM_STATES)
+    inputs = states & 1  # the input bit that leads into each state
+
+    # each state can be reached from two predecessors, which differ in their oldest bit
+    predecessors = np.stack([states >> 1, (states >> 1) | (NUM_STATES >> 1)])
+    expected = TRELLIS_OUTPUTS[predecessors, inputs]  # (2, states, generators)
+
+    metrics = np.full(NUM_STATES, np.inf, dtype=np.float32)
+    metrics[0] = 0
+    decisions = np.zeros((steps, NUM_STATES), dtype=np.uint8)
+
+    for t in range(steps):
+        branch = np.abs(expected - received[:, t]).sum(axis=2)
+        candidates = metrics[predecessors] + branch
+        decisions[t] = candidates[1] < candidates[0]
+        metrics = candidates.min(axis=0)
+
+    # trace back from state 0, where the flushed encoder finished
+    bits = np.zeros(steps, dtype=np.uint8)
+    state = 0
+    for t in range(steps - 1, -1, -1):
+        bits[t] = state & 1
+        state = predecessors[decisions[t, state], state]
+
+    return bits[:num_bits]
+
+
+# remove the coded bits that are not sent at the given rate, returns the bits in transmission order
+def puncture(coded, rate):
+    pattern = PUNCTURE_PATTERNS[rate]
+    mask = np.tile(pattern, (1, -(-coded.shape[1] // pattern.shape[1])))[:, :coded.shape[1]]
+    return coded.T[mask.T]
+
+
+# put received values back in place of the coded bits, marking punctured bits with 0.5
+def depuncture(received, rate, steps):
+    pattern = PUNCTURE_PATTERNS[rate]
+    mask = np.tile(pattern, (1, -(-steps // pattern.shape[1])))[:, :steps]
+    coded = np.full((steps, len(GENERATORS)), 0.5, dtype=np.float32)
+    coded[mask.T] = received
+    return coded.T
+
+
+# get the order in which a block of n bits is sent by the block interleaver
+# bits are written row by row into INTERLEAVER_DEPTH rows and read column by column
+def get_interleaver_order(n):
+    columns = -(-n // INTERLEAVER_DEPTH)
+    order = np.arange(INTERLEAVER_DEPTH * columns).reshape(INTERLEAVER_DEPTH, columns).T.reshape(-1)
+    return order[order < n]
+
+
+# get the number of bits sent for a block of num_bits bits at the given rate
+def get_coded_length(num_bits, rate):
+    steps = num_bits + CONSTRAINT_LENGTH - 1
+    pattern = PUNCTURE_PATTERNS[rate]
+    mask = np.tile(pattern, (1, -(-steps // pattern.shape[1])))[:, :steps]
+    return int(mask.sum())
+
+
+# encode a block of bits for transmission
+def encode_block(bits, rate):
+    sent = puncture(conv_encode(bits), rate)
+    return sent[get_interleaver_order(len(sent))]
+
+
+# decode a block of num_bits bits from the received values (hard bits or soft decisions)
+def decode_block(received, num_bits, rate):
+    n = get_coded_length(num_bits, rate)
+    received = np.asarray(received[:n], dtype=np.float32)
+    if len(received) < n:
+        # missing values carry no information
+        received = np.concatenate([received, np.full(n - len(received), 0.5, dtype=np.float32)])
+
+    sent = np.empty(n, dtype=np.float32)
+    sent[get_interleaver_order(n)] = received
+
+    steps = num_bits + CONSTRAINT_LENGTH - 1
+    return viterbi_decode(depuncture(sent, rate, steps), num_bits)
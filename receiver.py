@@ -1,28 +1,54 @@
 #!/usr/bin/env python3
 
 # TODO organize imports
-from transmitter import INTER_TRANSMISSION_PAUSE, TONE_DURATION, AUDIO_SAMPLE_RATE, AUDIO_SAMPLES_PER_TONE, get_hash
-from rtlsdr import RtlSdr
+from transmitter import get_hash
+from transmitter import get_mfsk_tones
+from transmitter import get_symbol_table
+import fec
+import threading
 import numpy as np
 import scipy.signal as signal
-from scipy.io.wavfile import read
-from bitstring import BitArray
+from scipy.fft import rfft, ifft
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
 import hashlib
+import time
 from math import ceil
-import asyncio
+import timing
+from dsp import NCO, PolyphaseResampler, Channelizer, Discriminator, DeEmphasis, AutomaticGain, SampleBuffer
+from recordings import open_wav, open_iq, open_recording
 from shared import *
 
+try:
+    from rtlsdr import RtlSdr
+except ImportError:  # only needed to receive from the radio; file mode works without it
+    RtlSdr = None
+
 # constants
 STATION_FREQ = int(87.7e6)  # in Hz
 OFFSET_FREQ = 250000  # offset to capture at, see https://witestlab.poly.edu/blog/capture-and-decode-fm-radio/
 CENTER_FREQ = STATION_FREQ - OFFSET_FREQ
+STATION_FREQS = [STATION_FREQ]  # stations decoded when streaming from the radio, all within the capture
+CHANNEL_SPACING = 10000  # Hz, stations must be a multiple of this from CENTER_FREQ to be decoded together
 RADIO_SAMPLE_RATE = int(1140000)
-TRANSMISSION_AUDIO_SAMPLE_RATE = AUDIO_SAMPLE_RATE
-THRESHOLD = 0.1
+RADIO_DTYPE = np.complex64  # precision of the receive chain: np.complex64 (single) or np.complex128 (double)
+FM_BROADCAST_WIDTH = 200000  # Hz
+SYNC_THRESHOLD = 0.4  # normalized preamble correlation (0 to 1) needed to detect a packet
+SYNC_FFT_LENGTH = 1 << 21  # length of the FFTs correlating blocks of audio against the preamble
+TONE_BLOCK_SAMPLES = 1 << 20  # audio samples processed at once when iterating over tones
+RADIO_READ_SIZE = 8192  # recommendation from https://github.com/roger-/pyrtlsdr/issues/56
+RADIO_CHUNK_SIZE = 8192  # radio samples processed at a time when streaming
+AUDIO_CHUNK_SIZE = 4096  # audio samples replayed at a time when streaming from a wav file
+MAX_PREAMBLE_ERRORS = 4  # bits of a received preamble that can differ from PREAMBLE
+STAGE_TIMING = None  # None prints progress, 'summary' shows the time spent in each stage, 'json' logs it to stderr
+COMBINING = 'soft'  # how repetitions of a packet are combined: 'soft' sums soft bits, 'majority' votes on bits
+SAME_MESSAGE_DISAGREEMENT = 0.25  # share of checksum bits on which repetitions of a message can differ
 
 
 # configure sdr device
 def setup():
+    if RtlSdr is None:
+        raise RuntimeError("pyrtlsdr is required to receive from the radio")
+
     sdr = RtlSdr()
     sdr.sample_rate = RADIO_SAMPLE_RATE
     sdr.center_freq = CENTER_FREQ
@@ -31,118 +57,198 @@ def setup():
     return sdr
 
 
-# asynchronously stream audio samples from the radio
-audio_samples = []
-async def streaming():
-    sdr = setup()
-
-    async for samples in sdr.stream():
-        d = filter_and_downsample(samples)
-        d2 = apply_polar_discriminator(d)
-        audio_samples.append(d2)
-        print(d2)
-
-    # to stop streaming:
-    await sdr.stop()
-
-    # done
-    sdr.close()
+# mix the data down, shifting the FM signal at OFFSET_FREQ to 0Hz
+# the samples are left as they are, unless in_place is set by a caller that owns them: samples of RADIO_DTYPE
+# are then mixed in place; pass the same nco to mix consecutive chunks of a capture
+def mix_data_down(samples, nco=None, in_place=False):
+    with timing.Stage('mix_data_down', None, samples, RADIO_SAMPLE_RATE) as stage:
+        if nco is None:
+            nco = NCO(-OFFSET_FREQ, RADIO_SAMPLE_RATE, in_place=in_place, dtype=RADIO_DTYPE)
+        return stage.output(nco.process(samples))
 
 
-# mix the data down
-def mix_data_down(samples):
-    # generate a digital complex exponential with the same length as samples
-    # and phase -OFFSET_FREQ / RADIO_SAMPLE_RATE
-    cpl_exp = np.exp(-1.0j * 2.0 * np.pi * OFFSET_FREQ / RADIO_SAMPLE_RATE * np.arange(len(samples)))
-    return samples * cpl_exp
+# get the decimation factor and sample rate used to focus on the FM signal
+def get_fm_sample_rate():
+    dec_rate = int(RADIO_SAMPLE_RATE / FM_BROADCAST_WIDTH)
+    return dec_rate, RADIO_SAMPLE_RATE // dec_rate
 
 
 # filter & downsample the signal to focus only the FM signal
-def filter_and_downsample(samples):
-    print("Focusing on FM signal...", end='', flush=True)
-    fm_broadcast_width = 200000  # Hz
-    dec_rate = int(RADIO_SAMPLE_RATE / fm_broadcast_width)
-    output = signal.decimate(samples, dec_rate)
-    new_sample_rate = RADIO_SAMPLE_RATE / dec_rate  # calculate new sampling rate
-    print("done")
+# pass the same resampler to filter consecutive chunks of a capture
+def filter_and_downsample(samples, resampler=None):
+    with timing.Stage('filter_and_downsample', "Focusing on FM signal", samples, RADIO_SAMPLE_RATE) as stage:
+        dec_rate, new_sample_rate = get_fm_sample_rate()
+        if resampler is None:
+            resampler = PolyphaseResampler(1, dec_rate)
+        output = stage.output(resampler.process(samples))
 
     return output, new_sample_rate  # return as tuple
 
 
 # demodulate using a polar discriminator
 def apply_polar_discriminator(samples):
-    print("Applying polar discriminator...", end='', flush=True)
-    y = samples[1:] * np.conj(samples[:-1])
-    x = np.angle(y)
-    print("done")
+    sample_rate = get_fm_sample_rate()[1]
+    with timing.Stage('apply_polar_discriminator', "Applying polar discriminator", samples, sample_rate) as stage:
+        y = np.conj(samples[:-1])
+        y *= samples[1:]
+        x = stage.output(np.angle(y))
     return x
 
 
 # apply de-emphasis filter
 def apply_de_emphasis_filter(demodulated_samples, sample_rate):
-    print("Applying de-emphasis filter...", end='', flush=True)
-    d = sample_rate * 75e-6  # number of samples to hit -3dB point
-    x = np.exp(-1 / d)  # decay between each sample
+    with timing.Stage('apply_de_emphasis_filter', "Applying de-emphasis filter", demodulated_samples,
+                      sample_rate) as stage:
+        d = sample_rate * 75e-6  # number of samples to hit -3dB point
+        x = np.exp(-1 / d)  # decay between each sample
 
-    # filter coefficients
-    b = [1 - x]
-    a = [1, -x]
+        # filter coefficients, in the precision of the samples
+        dtype = np.result_type(demodulated_samples, np.float32)
+        b = np.array([1 - x], dtype=dtype)
+        a = np.array([1, -x], dtype=dtype)
 
-    output = signal.lfilter(b, a, demodulated_samples)
-    print("done")
+        output = stage.output(signal.lfilter(b, a, demodulated_samples))
 
     return output
 
 
-# decimate again to focus on mono part of broadcast
-def get_mono(demodulated_samples, sample_rate):
-    print("Focusing on mono audio...", end='', flush=True)
-    dec_audio = int(sample_rate / TRANSMISSION_AUDIO_SAMPLE_RATE)
-    audio_sample_rate = sample_rate / dec_audio
-    output = signal.decimate(demodulated_samples, dec_audio)
-    output *= 10000 / np.max(np.abs(output))  # scale audio to adjust volume
-    print("done")
-
-    return output, audio_sample_rate
+# resample to the transmission sample rate to focus on mono part of broadcast
+# the low-pass filter of the polyphase resampler removes the stereo and RDS subcarriers
+def get_mono(demodulated_samples, sample_rate, resampler=None):
+    with timing.Stage('get_mono', "Focusing on mono audio", demodulated_samples, sample_rate) as stage:
+        if resampler is None:
+            resampler = PolyphaseResampler(MODEM.sample_rate, int(sample_rate))
+        output = stage.output(resampler.process(demodulated_samples))
+        output *= 10000 / np.max(np.abs(output))  # scale audio to adjust volume
+
+    return output, MODEM.sample_rate
+
+
+# captures radio samples into a preallocated complex64 ring buffer, using a persistent device handle
+# the ring is stored twice back to back, so any run of up to capacity samples is contiguous and
+# readers always get views of the ring instead of copies
+class RadioCapture:
+    def __init__(self, capacity, sdr=None, read_size=RADIO_READ_SIZE):
+        self.read_size = read_size
+        self.capacity = ceil(capacity / read_size) * read_size  # reads never wrap around the ring
+        self.ring = np.zeros(2 * self.capacity, dtype=np.complex64)
+        self.sdr = sdr if sdr is not None else setup()
+        self.written = 0  # total samples written
+        self.consumed = 0  # total samples handed to readers
+        self.overruns = 0  # samples overwritten before they were read
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    # read one chunk from the device, converting it straight into the ring
+    def read_chunk(self):
+        raw = np.frombuffer(self.sdr.read_bytes(2 * self.read_size), dtype=np.uint8).reshape(-1, 2)
+        pos = self.written % self.capacity
+        chunk = self.ring[pos:pos + len(raw)].view(np.float32).reshape(-1, 2)
+        np.subtract(raw, 127.5, out=chunk, casting='unsafe')
+        chunk /= 127.5
+        self.ring[pos + self.capacity:pos + self.capacity + len(raw)] = self.ring[pos:pos + len(raw)]
+
+        with self.lock:
+            self.written += len(raw)
+            if self.written - self.consumed > self.capacity:
+                self.overruns += self.written - self.consumed - self.capacity
+                self.consumed = self.written - self.capacity
+            self.lock.notify_all()
+
+    # read from the device until at least n unread samples are available (without a background thread)
+    def fill(self, n):
+        while self.available() < n:
+            self.read_chunk()
+
+    # number of samples waiting to be read
+    def available(self):
+        with self.lock:
+            return self.written - self.consumed
+
+    # get a view of the next n samples (or fewer if fewer are available) and mark them as read
+    # the view stays valid until the ring wraps around onto it
+    def read(self, n):
+        with self.lock:
+            n = min(n, self.written - self.consumed, self.capacity)
+            pos = self.consumed % self.capacity
+            self.consumed += n
+        return self.ring[pos:pos + n]
+
+    # wait until n samples are available (with the background thread running), then read them
+    def read_blocking(self, n):
+        with self.lock:
+            self.lock.wait_for(lambda: self.written - self.consumed >= n or not self.running)
+        return self.read(n)
+
+    # drop all unread samples
+    def discard(self):
+        with self.lock:
+            self.consumed = self.written
+
+    # start reading from the device on a background thread
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.read_chunk()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.sdr.close()
+
+
+# capture used by get_radio_samples, kept open between calls
+_capture = None
+
+
+# get a capture holding at least capacity samples, reusing the open device
+def get_capture(capacity):
+    global _capture
+    if _capture is None or _capture.capacity < capacity:
+        sdr = _capture.sdr if _capture is not None else None
+        _capture = RadioCapture(capacity, sdr=sdr)
+    return _capture
 
 
 # read in the given number of radio samples
+# returns a view of the capture's ring buffer, which is valid until the next call
 def get_radio_samples(n):
-    # setup sdr
-    sdr = setup()
+    capture = get_capture(n)
 
     # get samples from radio
     print("Sampling radio...", end='', flush=True)
-    read_size = 8192  # recommendation from https://github.com/roger-/pyrtlsdr/issues/56
-    num_read = 0
-    radio_samples = None
-    while num_read <= n:
-        sweep = sdr.read_samples(read_size)
-        if radio_samples is None:
-            radio_samples = sweep
-        else:
-            radio_samples = np.concatenate((radio_samples, sweep))
-        num_read += read_size
-        if radio_samples.size > n:
-            radio_samples = radio_samples[:n]
+    capture.discard()
+    capture.fill(n)
+    radio_samples = capture.read(n)
     print("done")
 
-    # cleanup sdr device
-    sdr.close()
-    del sdr
-
     return radio_samples
 
 
-# TODO rework/remove this
 # read the given number of radio samples and produce the corresponding audio samples
+# the samples are only a view of the capture's ring buffer, so they are mixed down in place
 def get_audio_samples(n):
-    # get the radio samples
-    radio_samples = get_radio_samples(n)
+    return get_audio_from_radio(get_radio_samples(n), in_place=True)
 
+
+# produce the audio samples for a capture of radio samples
+# radio_samples are left as they are, unless in_place is set by a caller that owns them (see mix_data_down)
+def get_audio_from_radio(radio_samples, in_place=False):
     # mix the data down
-    samples = np.array(radio_samples).astype('complex64')
-    samples = mix_data_down(samples)
+    samples = np.asarray(radio_samples, dtype=RADIO_DTYPE)
+    samples = mix_data_down(samples, in_place=in_place)
 
     # filter & downsample the signal to focus only the FM signal
     samples, sample_rate = filter_and_downsample(samples)
@@ -153,161 +259,226 @@ def get_audio_samples(n):
     # apply the de-emphasis filter
     demodulated_samples = apply_de_emphasis_filter(demodulated_samples, sample_rate)
 
-    # decimate again to focus on mono part of audio
+    # resample to the transmission sample rate, focusing on mono part of audio
     mono_audio, mono_sample_rate = get_mono(demodulated_samples, sample_rate)
 
-    # downsample the mono audio to match transmission sample rate
-    print("Downsampling audio to " + str(TRANSMISSION_AUDIO_SAMPLE_RATE) + "Hz...", end='', flush=True)
-    seconds = len(mono_audio) / mono_sample_rate
-    num_samples = seconds * TRANSMISSION_AUDIO_SAMPLE_RATE
-    mono_audio = signal.resample(mono_audio, int(num_samples))
-    print("done")
-
-    # return mono_audio, TRANSMISSION_AUDIO_SAMPLE_RATE
     return mono_audio, mono_sample_rate
 
 
-# save mono audio to a file
+# save mono audio to a file as raw int16 samples, which can be read back with recordings.open_raw_audio
 def save_to_file(filename, mono_audio, sample_rate):
     mono_audio.astype('int16').tofile(filename)
     print("Sample rate for " + filename + ": " + str(sample_rate))
 
 
 # load a wav file into a numpy.ndarray object
+# the array is a read-only view of the memory mapped file, so samples are only read from disk when they are used
 def load_wav(filename):
-    rate, data = read(filename)
-    if rate != AUDIO_SAMPLE_RATE:
-        print("WARNING: " + filename + " does not have sample rate of " + str(AUDIO_SAMPLE_RATE) + "Hz")
-    return data
+    recording = open_wav(filename)
+    check_sample_rate(filename, recording)
+    return recording.view()
 
 
-# take audio data and build a list of tones
-def get_tones_from_audio(audio_data):
-    print("Building tone list...", end='', flush=True)
+# warn when an audio recording was not made at the transmission sample rate
+def check_sample_rate(filename, recording):
+    if recording.sample_rate != MODEM.sample_rate:
+        print("WARNING: " + filename + " does not have sample rate of " + str(MODEM.sample_rate) + "Hz")
 
-    # build list of tones
-    # TODO programmatically determine AUDIO_SAMPLES_PER_TONE?
-    tones = list(chunks(audio_data[1:], AUDIO_SAMPLES_PER_TONE))
 
-    # pad last tone with extra 0s if necessary
-    while len(tones[-1]) < 8:
-        tones[-1].append(0)
+# get a (tones x samples) view of the whole tones in the audio data, starting offset samples in
+# the view shares memory with the audio data, so the audio can be re-framed at any sample offset
+# (e.g. for timing recovery) without copying it
+def frame_tones(audio_data, offset=0, num_tones=None):
+    audio = np.asarray(audio_data)[offset:]
+    n = len(audio) // MODEM.samples_per_symbol
+    if num_tones is not None:
+        n = min(n, num_tones)
+
+    step = audio.strides[0]
+    return as_strided(audio, shape=(n, MODEM.samples_per_symbol), strides=(step * MODEM.samples_per_symbol, step),
+                      writeable=False)
 
-    print("done")
-    return tones
 
+# iterate over the tones in the audio data as (tones x samples) views of TONE_BLOCK_SAMPLES samples or less
+# a partial tone at the end of the audio data is padded with 0s; it is the only tone that is copied
+def iter_tones(audio_data, offset=0):
+    audio = np.asarray(audio_data)[offset:]
+    tones = frame_tones(audio)
+    block_tones = max(1, TONE_BLOCK_SAMPLES // MODEM.samples_per_symbol)
+    for start in range(0, len(tones), block_tones):
+        yield tones[start:start + block_tones]
 
-# see https://stackoverflow.com/a/312464
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
+    tail = audio[len(tones) * MODEM.samples_per_symbol:]
+    if len(tail) > 0:
+        padded = np.zeros((1, MODEM.samples_per_symbol), dtype=audio.dtype)
+        padded[0, :len(tail)] = tail
+        yield padded
 
 
-# determine the average value of a tone, only considering the absolute value of its components
-def average_tone(tone):
-    avg = 0
-    for val in tone:
-        avg += abs(val)
-    avg /= len(tone)
-    return avg
+# take audio data and get the tones it contains, starting offset samples in
+def get_tones_from_audio(audio_data, offset=0):
+    return iter_tones(audio_data, offset)
 
 
-# demodulate tones
+# apply func to a (tones x samples) array, or to each block of tones from iter_tones, and join the results
+def map_tone_blocks(func, tones):
+    if isinstance(tones, np.ndarray):
+        return func(tones)
+
+    results = [func(block) for block in tones]
+    if not results:
+        return func(np.zeros((0, MODEM.samples_per_symbol), dtype=np.float32))
+    return np.concatenate(results)
+
+
+# get the energy of every tone as the average absolute value of its samples
+def get_symbol_energies(tones):
+    return map_tone_blocks(lambda block: np.abs(block).mean(axis=1), tones)
+
+
+# find the threshold separating the energies of LOW and HIGH symbols
+# the energies are split into two clusters iteratively, so the threshold follows the level of the
+# signal (which depends on the gain of the radio) instead of being a fixed value
+def get_threshold(energies):
+    threshold = (energies.min() + energies.max()) / 2
+    for i in range(32):
+        high = energies >= threshold
+        if high.all() or not high.any():
+            break
+
+        new_threshold = (energies[high].mean() + energies[~high].mean()) / 2
+        if new_threshold == threshold:
+            break
+        threshold = new_threshold
+
+    return threshold
+
+
+# turn the energies of on/off keyed symbols into soft bits between 0 and 1
+# the LOW and HIGH clusters found by get_threshold map to 0 and 1, so soft bits of 0.5 and above are the
+# symbols the threshold would call HIGH
+def get_soft_bits(energies):
+    threshold = get_threshold(energies)
+    high = energies >= threshold
+    if high.all() or not high.any():
+        return high.astype(np.float32)
+
+    low_energy = energies[~high].mean()
+    high_energy = energies[high].mean()
+    return np.clip((energies - low_energy) / (high_energy - low_energy), 0, 1).astype(np.float32)
+
+
+# demodulate on/off keyed tones (a (tones x samples) array or blocks from iter_tones) into an array of bits
 def demodulate(tones):
-    data = []
-
-    print("Demodulating audio data...", end='', flush=True)
-    for tone in tones:
-        avg = average_tone(tone)
-        # TODO get this working properly
-        if avg < 0.1:
-            data.append(0)
-        else:
-            data.append(1)
-    print("done")
+    with timing.Stage('demodulate', "Demodulating audio data", sample_rate=MODEM.sample_rate) as stage:
+        energies = get_symbol_energies(tones)
+        stage.input(len(energies) * MODEM.samples_per_symbol)
+        data = stage.output((energies >= get_threshold(energies)).astype(np.uint8))
 
     return data
 
 
-# rebuild the packet from the data
-def rebuild_packet(data):
-    # preamble
-    preamble = BitArray(data[:32]).bytes
+# get the energy of each frequency (in Hz) within every tone
+def get_tone_energies(tones, frequencies):
+    t = np.arange(MODEM.samples_per_symbol) / MODEM.sample_rate
+    bank = np.exp(-2j * np.pi * np.outer(t, frequencies))  # one DFT bin per frequency
+    return map_tone_blocks(lambda block: np.abs(block @ bank) ** 2, tones)
 
-    # source ip
-    source_ip = BitArray(data[32:64]).bytes
 
-    # transmitter ip
-    trans_ip = BitArray(data[64:96]).bytes
+# determine the modulation mode (bits per symbol) from the pilot tone keying the preamble
+def detect_modulation(audio_data):
+    preamble = frame_tones(audio_data, 0, PREAMBLE_LENGTH * 8)
+    modes = list(MODEM.pilot_tones)
+    energies = get_tone_energies(preamble, [MODEM.pilot_tones[mode] for mode in modes]).sum(axis=0)
+    return modes[int(np.argmax(energies))]
 
-    # sequence number
-    sequence_number = BitArray(data[96:104]).bytes
 
-    # data length
-    b = BitArray(data[104:120])
-    length = b.int
-    data_length = b.bytes
+# demodulate an M-FSK packet: the preamble is on/off keyed, every other tone carries bits_per_symbol bits
+def demodulate_mfsk(audio_data, bits_per_symbol):
+    message = "Demodulating " + str(2 ** bits_per_symbol) + "-FSK audio data"
+    with timing.Stage('demodulate_mfsk', message, audio_data, MODEM.sample_rate) as stage:
+        preamble_samples = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
 
-    # reserved
-    reserved = BitArray(data[120:128]).bytes
+        # the preamble is keyed on and off, so its bits come from the tones' energy
+        energies = get_symbol_energies(frame_tones(audio_data, 0, PREAMBLE_LENGTH * 8))
+        preamble = (energies >= get_threshold(energies)).astype(np.uint8)
 
-    # checksum
-    checksum = BitArray(data[128:256]).bytes
+        # pick the strongest tone of the bank for every symbol and unpack its value into bits
+        energies = get_tone_energies(iter_tones(audio_data, preamble_samples), get_mfsk_tones(bits_per_symbol))
+        values = np.argmax(energies, axis=1)
+        shifts = np.arange(bits_per_symbol - 1, -1, -1)
+        bits = ((values[:, None] >> shifts) & 1).astype(np.uint8).reshape(-1)
 
-    # data
-    packet_data = BitArray(data[256:256 + (length * 8)]).bytes
+        return stage.output(np.concatenate([preamble, bits]))
 
-    return preamble + source_ip + trans_ip + sequence_number + data_length + reserved + checksum + packet_data
 
+# demodulate an M-FSK packet into soft bits between 0 and 1
+# the soft value of each bit of a symbol is the share of the symbol's energy in the tones whose value has
+# that bit set
+def demodulate_mfsk_soft(audio_data, bits_per_symbol):
+    preamble_samples = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    preamble = get_soft_bits(get_symbol_energies(frame_tones(audio_data, 0, PREAMBLE_LENGTH * 8)))
 
-# get information from packet
-def get_packet_info(packet):
-    info = {}
+    energies = get_tone_energies(iter_tones(audio_data, preamble_samples), get_mfsk_tones(bits_per_symbol))
+    shifts = np.arange(bits_per_symbol - 1, -1, -1)
+    tone_bits = (np.arange(2 ** bits_per_symbol)[:, None] >> shifts) & 1  # (tones x bits)
+    total = np.maximum(energies.sum(axis=1, keepdims=True), 1e-12)
+    bits = (energies @ tone_bits / total).astype(np.float32).reshape(-1)
 
-    # preamble is 32 bits (4 bytes)
-    # source ip (32 bits)
-    source_ip_bytes = packet[4:8]
+    return np.concatenate([preamble, bits])
 
-    ip = []
-    for byte in source_ip_bytes:
-        ip.append(str(int(byte)))
-    info['source_ip'] = '.'.join(ip)
 
-    # transmitter ip (32 bits)
-    transmitter_ip_bytes = packet[8:12]
+# undo the forward error correction applied by the transmitter, returns the bits of the packet (only those of the
+# preamble and header with header_only)
+# data can hold hard bits or soft decisions between 0 and 1
+# raises ValueError if the header gives a data length over MAX_DATA_LENGTH, before decoding any data
+def decode_fec(data, rate, header_only=False):
+    data = np.asarray(data, dtype=np.float32)
+    preamble = np.round(data[:PREAMBLE_LENGTH * 8]).astype(np.uint8)
+    start = PREAMBLE_LENGTH * 8
 
-    ip = []
-    for byte in transmitter_ip_bytes:
-        ip.append(str(int(byte)))
-    info['transmitter_ip'] = '.'.join(ip)
+    # the header is coded on its own so the data length is known before decoding the data
+    header_bits = (HEADER_LENGTH - PREAMBLE_LENGTH) * 8
+    header_coded = fec.get_coded_length(header_bits, rate)
+    header = fec.decode_block(data[start:start + header_coded], header_bits, rate)
+    start += header_coded
+    if header_only:
+        return np.concatenate([preamble, header])
 
-    # sequence number (8 bits)
-    info['sn'] = str(BitArray(packet[12:13]).int)
+    # data length is the 16 bits following the source ip, transmitter ip & sequence number
+    length = int.from_bytes(np.packbits(header[72:88]).tobytes(), byteorder='big')
+    if length > MAX_DATA_LENGTH:
+        raise ValueError("data length " + str(length) + " is over " + str(MAX_DATA_LENGTH) + " bytes")
+    packet_data = fec.decode_block(data[start:], length * 8, rate)
 
-    # data length (16 bits)
-    info['data_length'] = str(BitArray(packet[13:15]).int)
+    return np.concatenate([preamble, header, packet_data])
 
-    # reserved is 8 bits (1 byte)
-    # checksum (32 bits)
-    info['checksum'] = get_checksum_hex_from_bytes(packet[16:32])
 
-    # data
-    info['data'] = packet[32:]
+# rebuild the packet from the data (one bit per element)
+def rebuild_packet(data):
+    return Packet.unpack(np.packbits(np.asarray(data, dtype=np.uint8)))
 
-    return info
+
+# get information from packet
+def get_packet_info(packet):
+    return {
+        'source_ip': packet.source_ip,
+        'transmitter_ip': packet.transmitter_ip,
+        'sn': str(packet.sequence_number),
+        'data_length': str(len(packet.data)),
+        'checksum': get_checksum_hex_from_bytes(packet.checksum),
+        'data': packet.data,
+    }
 
 
 # get the hex representation of the checksum from the bytes of the checksum
 def get_checksum_hex_from_bytes(checksum_bytes):
-    checksum = []
-    for byte in checksum_bytes:
-        checksum.append(chr(byte))
-    return BitArray(bytes(''.join(checksum), 'utf-8')).hex
+    return bytes(checksum_bytes).hex()
 
 
 # display packet information
-# if data is not None, use data instead of info_dict['data']
+# if data is not None, use data instead of info_dict['data'], which is shown as the bytes received since corrupted
+# data need not be text
 def display_packet_info(info_dict, calc_checksum, data=None):
     print("Received packet: ")
     print("Source: " + info_dict['source_ip'] + "\tTransmitter: " + info_dict['transmitter_ip'])
@@ -317,44 +488,642 @@ def display_packet_info(info_dict, calc_checksum, data=None):
     if data is not None:
         show_data = data
     else:
-        show_data = info_dict['data']
+        show_data = repr(info_dict['data'])
     print("Message: " + show_data)
 
 
-if __name__ == "__main__":
-    if FILE_MODE:
-        #  load audio data from a wav file
-        audio_samples = load_wav(WAV_FILENAME)
-    # else:
-        # TODO get this working
-        # stream audio samples from the radio
-        # loop = asyncio.get_event_loop()
-        # loop.run_until_complete(streaming())
-
-    # TODO properly implement carry sense
-    # use carry sense to determine when to start processing audio samples
-    i = 0
-    started = False
-    while not started and i < len(audio_samples):
-        if abs(audio_samples[i]) > THRESHOLD:
-            started = True
-        else:
-            i += 1
+# matched filters for the preamble, keyed by (bits per symbol, samples per symbol)
+_preamble_templates = {}
+
+# spectra of the matched filters of every modulation mode, keyed by (samples per symbol, FFT length)
+_preamble_spectra = {}
+
+
+# get the matched filter for the preamble sent in the given modulation mode
+# the template is the analytic signal of the modulated preamble, so the magnitude of the correlation
+# does not depend on the phase of the received tones
+def get_preamble_template(bits_per_symbol):
+    key = (bits_per_symbol, MODEM.waveform_key)
+    if key not in _preamble_templates:
+        bits = np.unpackbits(np.frombuffer(PREAMBLE, dtype=np.uint8))
+        template = signal.hilbert(get_symbol_table(bits_per_symbol)[bits].reshape(-1))
+        _preamble_templates[key] = np.conj(template[::-1]).astype(np.complex64)
+    return _preamble_templates[key]
+
+
+# get the factor by which the correlation can be decimated
+# the matched filters only pass the pilot tones and their keying sidebands, and the magnitude of a complex
+# signal of bandwidth B is fully described by B samples per second; analytic signals never need more than
+# half the sample rate
+def get_sync_decimation():
+    bandwidth = max(MODEM.pilot_tones.values()) + 4 * MODEM.symbol_rate
+    decimation = 2
+    while 2 * decimation * bandwidth <= MODEM.sample_rate:
+        decimation *= 2
+    return decimation
+
+
+# get the spectra of the matched filters of every mode (in the order of MODEM.pilot_tones) for FFTs of the given
+# length, keeping only the frequencies below sample_rate / decimation (the filters are analytic, so
+# negative frequencies are 0)
+def get_preamble_spectra(fft_length):
+    key = (MODEM.waveform_key, fft_length)
+    if key not in _preamble_spectra:
+        bins = fft_length // get_sync_decimation()
+        spectra = [np.fft.fft(get_preamble_template(mode), fft_length)[:bins] for mode in MODEM.pilot_tones]
+        _preamble_spectra[key] = np.stack(spectra).astype(np.complex64)
+    return _preamble_spectra[key]
+
+
+# get the length of the FFT used to correlate n audio samples against the preamble
+# lengths are powers of two, so buffers of similar lengths share the same matched filter spectra
+def get_sync_fft_length(n):
+    preamble_samples = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    return max(1 << (n + preamble_samples - 2).bit_length(), get_sync_decimation())
+
+
+# get the energy of the audio under preambles starting at the given offsets
+# windows 60dB quieter than average are silence, and are kept from matching through rounding errors
+def get_preamble_window_energy(audio_samples, offsets):
+    n = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    energy = np.concatenate([[0], np.cumsum(np.square(audio_samples, dtype=np.float64))])
+    silence = max(1e-6 * energy[-1] * n / len(audio_samples), 1e-12)
+    return np.maximum(energy[offsets + n] - energy[offsets], silence)
+
+
+# get the energy of the audio under preambles within the band of the pilot tones and their keying sidebands,
+# so noise at other frequencies does not lower the scores of preambles
+# spectrum holds the low frequencies of the audio, as in correlate_preambles, and positions are the
+# (decimated) samples at which the preambles end
+def get_preamble_band_energy(spectrum, fft_length, positions):
+    n = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    decimation = get_sync_decimation()
+    sidebands = 4 * MODEM.symbol_rate
+    frequencies = np.arange(len(spectrum)) * MODEM.sample_rate / fft_length
+    pilot_tones = MODEM.pilot_tones.values()
+    band = (frequencies >= min(pilot_tones) - sidebands) & (frequencies <= max(pilot_tones) + sidebands)
+
+    # the analytic signal of the band, every decimation-th sample; each sample stands for decimation
+    # samples of audio, and a real signal has half the energy of its analytic signal
+    analytic = ifft(2 * spectrum * band) / decimation
+    energy = np.concatenate([[0], np.cumsum(np.abs(analytic) ** 2) * decimation / 2])
+    window = energy[positions + 1] - energy[np.maximum(positions + 1 - n // decimation, 0)]
+
+    # windows 60dB quieter than average are silence, and are kept from matching through rounding errors
+    silence = max(1e-6 * energy[-1] * n / fft_length, 1e-12)
+    return np.maximum(window, silence)
+
+
+# turn the magnitude of the matched filter output into a score between 0 and 1, 1 meaning the audio is
+# exactly a (scaled) preamble
+# the output is normalized by the energy of the template and of the audio under it; a real tone only
+# matches the analytic template with half its energy, hence the factor of 2
+def get_preamble_scores(correlation, window_energy, bits_per_symbol):
+    template_energy = np.sum(np.abs(get_preamble_template(bits_per_symbol)) ** 2)
+    return correlation / np.sqrt(template_energy * window_energy / 2)
+
+
+# correlate the audio against the preamble of every modulation mode
+# returns the offsets (every decimation-th sample at which a whole preamble fits in the audio) and a
+# (modes x offsets) array of their scores
+# the spectrum of the audio is computed once and shared by the matched filters of all modes
+def correlate_preambles(audio_samples):
+    n = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    audio_samples = np.asarray(audio_samples, dtype=np.float32)
+    decimation = get_sync_decimation()
+
+    # the filter output at sample n - 1 + decimation * j belongs to the preamble starting at that sample
+    fft_length = get_sync_fft_length(len(audio_samples))
+    positions = np.arange(-(-(n - 1) // decimation), (len(audio_samples) - 1) // decimation + 1) * decimation
+    offsets = positions - (n - 1)
+    if len(offsets) == 0:
+        return offsets, np.zeros((len(MODEM.pilot_tones), 0))
+
+    # only the low frequencies are kept, so the inverse FFT directly gives every decimation-th output
+    spectrum = rfft(audio_samples, fft_length)[:fft_length // decimation]
+    window_energy = get_preamble_band_energy(spectrum, fft_length, positions // decimation)
+    scores = np.empty((len(MODEM.pilot_tones), len(offsets)))
+    for i, mode in enumerate(MODEM.pilot_tones):
+        output = ifft(spectrum * get_preamble_spectra(fft_length)[i])[positions // decimation]
+        scores[i] = get_preamble_scores(np.abs(output) / decimation, window_energy, mode)
+    return offsets, scores
+
+
+# get the offset of the strongest preamble of the given mode among the consecutive offsets first to last
+def refine_packet_start(audio_samples, first, last, bits_per_symbol):
+    template = get_preamble_template(bits_per_symbol)
+    audio_samples = audio_samples[first:last + len(template)]
+    offsets = np.arange(last - first + 1)
+
+    correlation = np.abs(sliding_window_view(audio_samples, len(template)) @ template[::-1])
+    scores = get_preamble_scores(correlation, get_preamble_window_energy(audio_samples, offsets), bits_per_symbol)
+    return int(first + np.argmax(scores))
+
+
+# find the preambles in a block of audio, returns a list of (start sample, bits per symbol)
+def find_packets_in_block(audio_samples):
+    with timing.Stage('find_packets_in_block', None, audio_samples, MODEM.sample_rate) as stage:
+        return stage.output(find_block_preambles(audio_samples))
+
+
+# find the preambles in a block of audio (see find_packets_in_block)
+def find_block_preambles(audio_samples):
+    audio_samples = np.asarray(audio_samples, dtype=np.float32)
+    offsets, scores = correlate_preambles(audio_samples)
+    best = scores.max(axis=0)
+    modes = np.array(list(MODEM.pilot_tones))[np.argmax(scores, axis=0)]
+
+    # the shifted preamble still matches well two symbols either side of a packet, so only the
+    # strongest match within a preamble length is kept (padded so a match at either end counts too)
+    decimation = get_sync_decimation()
+    distance = max(PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol // decimation, 1)
+    peaks, _ = signal.find_peaks(np.concatenate([[0], best, [0]]), height=SYNC_THRESHOLD, distance=distance)
+
+    # find the exact start of each preamble between the neighbouring decimated offsets
+    packets = []
+    last_offset = len(audio_samples) - PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    for peak in peaks - 1:
+        first = max(offsets[peak] - decimation + 1, 0)
+        last = min(offsets[peak] + decimation - 1, last_offset)
+        packets.append((refine_packet_start(audio_samples, first, last, modes[peak]), int(modes[peak])))
+    return packets
+
+
+# find the preamble of every packet in the audio with a matched filter for each modulation mode
+# yields (start sample, bits per symbol) in order of arrival; matches still need to be checked against the
+# header, since data can resemble a noisy preamble
+# the audio is correlated in overlapping blocks as the matches are consumed, so long recordings are
+# searched in bounded memory, and only as far as needed
+def iter_packets(audio_samples):
+    # blocks fill the FFT, and are long enough to hold a packet and the matches either side of it
+    preamble_samples = PREAMBLE_LENGTH * 8 * MODEM.samples_per_symbol
+    fft_length = max(SYNC_FFT_LENGTH, get_sync_fft_length(5 * preamble_samples))
+    block_samples = fft_length - preamble_samples + 1
+
+    start = 0
+    cutoff = 0  # matches before the cutoff were found by the previous block
+    while True:
+        end = min(start + block_samples, len(audio_samples))
+        last = end == len(audio_samples)
+
+        # a match is only final once the audio a preamble length past it has been correlated too, so
+        # later matches are left to the next block; that block starts a preamble length before them, so
+        # the matches it leaves to this one still suppress their own shifted matches
+        limit = end if last else end - 2 * preamble_samples
+        for i, bits_per_symbol in find_packets_in_block(audio_samples[start:end]):
+            if start + i >= limit:
+                break
+            if start + i >= cutoff:
+                yield start + i, bits_per_symbol
+
+        if last:
+            break
+        cutoff = limit
+        start = limit - preamble_samples
+
+
+# find the preamble of every packet in the audio, returns a list of (start sample, bits per symbol)
+def find_packets(audio_samples):
+    return list(iter_packets(audio_samples))
+
+
+# get the number of symbols (including the preamble) in a packet carrying data_length bytes of data
+def count_packet_symbols(data_length, bits_per_symbol):
+    header_bits = (HEADER_LENGTH - PREAMBLE_LENGTH) * 8
+    if MODEM.fec_rate is None:
+        coded_bits = header_bits + data_length * 8
+    else:
+        coded_bits = (fec.get_coded_length(header_bits, MODEM.fec_rate) +
+                      fec.get_coded_length(data_length * 8, MODEM.fec_rate))
+
+    return PREAMBLE_LENGTH * 8 + ceil(coded_bits / bits_per_symbol)
+
 
-    # get tones from the audio data
-    tones = get_tones_from_audio(audio_samples[i:])
+# demodulate the packet starting at the beginning of the audio data, returns the bits of the packet (only those of
+# the preamble and header with header_only, see decode_fec)
+def demodulate_packet(audio_samples, bits_per_symbol, header_only=False):
+    if bits_per_symbol == 1:
+        # get the tones from the audio data
+        tones = get_tones_from_audio(audio_samples)
 
-    # demodulate data
-    demodulated_data = demodulate(tones)
+        # demodulate data
+        demodulated_data = demodulate(tones)
+    else:
+        demodulated_data = demodulate_mfsk(audio_samples, bits_per_symbol)
+
+    # correct errors in the demodulated data
+    if MODEM.fec_rate is not None:
+        demodulated_data = decode_fec(demodulated_data, MODEM.fec_rate, header_only)
+
+    return demodulated_data
+
+
+# demodulate the packet starting at the beginning of the audio data into soft bits between 0 and 1
+# forward error correction is not undone, so soft bits from several receptions can be combined first
+def demodulate_packet_soft(audio_samples, bits_per_symbol):
+    with timing.Stage('demodulate_packet_soft', None, audio_samples, MODEM.sample_rate) as stage:
+        if bits_per_symbol == 1:
+            return stage.output(get_soft_bits(get_symbol_energies(get_tones_from_audio(audio_samples))))
+        return stage.output(demodulate_mfsk_soft(audio_samples, bits_per_symbol))
+
+
+# demodulate the header of the packet starting at the beginning of the audio data
+# returns the length of the packet's data, or None if the header is not a valid packet header
+def read_data_length(audio_samples, bits_per_symbol):
+    header_samples = count_packet_symbols(0, bits_per_symbol) * MODEM.samples_per_symbol
+    data = demodulate_packet(audio_samples[:header_samples], bits_per_symbol, header_only=True)
+    errors = np.count_nonzero(data[:PREAMBLE_LENGTH * 8] != np.unpackbits(np.frombuffer(PREAMBLE, dtype=np.uint8)))
+    length = int.from_bytes(np.packbits(data[104:120]).tobytes(), byteorder='big')
+    if errors > MAX_PREAMBLE_ERRORS or length > MAX_DATA_LENGTH:
+        return None
+    return length
+
+
+# find the packet in the audio data, demodulate it and get the packet info
+def decode_audio(audio_samples):
+    # the first match with a valid header is the packet; the matched filter also tells which pilot tone
+    # keyed the preamble, selecting the modulation mode
+    for i, bits_per_symbol in iter_packets(audio_samples):
+        length = read_data_length(audio_samples[i:], bits_per_symbol)
+        if length is not None:
+            end = i + count_packet_symbols(length, bits_per_symbol) * MODEM.samples_per_symbol
+            break
+    else:
+        i = 0
+        end = len(audio_samples)
+        bits_per_symbol = detect_modulation(audio_samples)
+
+    demodulated_data = demodulate_packet(audio_samples[i:end], bits_per_symbol)
 
     # build packet from demodulated data)
     packet = rebuild_packet(demodulated_data)
 
     # get packet info
-    info_dict = get_packet_info(packet)
+    return get_packet_info(packet)
+
+
+# check that the checksum of a received packet matches its data
+def is_checksum_valid(info_dict):
+    return get_checksum_hex_from_bytes(get_hash(info_dict['data'])) == info_dict['checksum']
 
-    # validate message checksum & display packet info
+
+# get the packet info from (combined) soft bits of a packet
+def get_packet_info_from_soft_bits(soft_bits):
+    if MODEM.fec_rate is not None:
+        data = decode_fec(soft_bits, MODEM.fec_rate)
+    else:
+        data = (soft_bits >= 0.5).astype(np.uint8)
+    return get_packet_info(rebuild_packet(data))
+
+
+# combine the soft bits of several receptions of the same packet
+# 'soft' averages the soft bits, 'majority' takes a vote of the sliced bits (ties are broken by the
+# average of the soft bits)
+def combine_soft_bits(receptions, method=COMBINING):
+    receptions = np.stack(receptions)
+    average = receptions.mean(axis=0)
+    if method == 'soft':
+        return average
+
+    votes = (receptions >= 0.5).mean(axis=0)
+    return np.where(votes == 0.5, average, votes)
+
+
+# find and demodulate every packet in the audio data
+# returns a list of (start sample, packet info, soft bits) in order of arrival; the info comes from each
+# packet's own bits
+def demodulate_all_packets(audio_samples):
+    receptions = []
+    end = 0
+    for start, bits_per_symbol in iter_packets(audio_samples):
+        if start < end:
+            continue  # the match is within the last packet
+        length = read_data_length(audio_samples[start:], bits_per_symbol)
+        if length is None:
+            continue  # not a packet, or the header is corrupted
+
+        packet_samples = count_packet_symbols(length, bits_per_symbol) * MODEM.samples_per_symbol
+        if start + packet_samples > len(audio_samples):
+            continue  # the recording ends before the packet does
+        end = start + packet_samples
+        soft_bits = demodulate_packet_soft(audio_samples[start:start + packet_samples], bits_per_symbol)
+        try:
+            receptions.append((start, get_packet_info_from_soft_bits(soft_bits), soft_bits))
+        except ValueError:
+            continue  # the data length was corrupted
+    return receptions
+
+
+# check whether a received packet repeats the message of an earlier one from the same source
+# repetitions of a message only differ in their errors and carry increasing sequence numbers, while the
+# checksums of different messages disagree on about half their bits however alike the messages are
+# (the data is not compared: messages that differ in a single character would look like repetitions)
+def is_same_message(info_dict, other_info_dict):
+    if (info_dict['source_ip'] != other_info_dict['source_ip'] or
+            info_dict['data_length'] != other_info_dict['data_length'] or
+            int(other_info_dict['sn']) <= int(info_dict['sn'])):
+        return False
+
+    bits = [np.unpackbits(np.frombuffer(bytes.fromhex(info['checksum']), dtype=np.uint8))
+            for info in (info_dict, other_info_dict)]
+    return np.mean(bits[0] != bits[1]) < SAME_MESSAGE_DISAGREEMENT
+
+
+# decode every packet in the audio data, combining the repetitions of each message
+def decode_repetitions(audio_samples, method=COMBINING):
+    return combine_repetitions(demodulate_all_packets(audio_samples), method)
+
+
+# combine the repetitions of each message among packets from demodulate_all_packets
+# a packet repeats the last message heard from its source if it continues the run of sequence numbers and
+# its checksum agrees (see is_same_message), otherwise it starts a new message; the repetitions of each
+# message are combined one by one until the checksum matches
+# returns a list with the packet info of each message, with the sequence numbers that were heard
+# ('heard') and the number of repetitions that were combined to decode it ('combined')
+def combine_repetitions(packets, method=COMBINING):
+    messages = []
+    for _, info_dict, soft_bits in packets:
+        for receptions in reversed(messages):
+            last_info_dict, last_soft_bits = receptions[-1]
+            if last_info_dict['source_ip'] != info_dict['source_ip']:
+                continue
+            if len(last_soft_bits) == len(soft_bits) and is_same_message(last_info_dict, info_dict):
+                receptions.append((info_dict, soft_bits))
+                break
+            messages.append([(info_dict, soft_bits)])
+            break
+        else:
+            messages.append([(info_dict, soft_bits)])
+
+    results = []
+    for receptions in messages:
+        info_dict = dict(receptions[0][0])
+        for count in range(1, len(receptions) + 1):
+            if count > 1:
+                soft_bits = combine_soft_bits([soft_bits for _, soft_bits in receptions[:count]], method)
+                try:
+                    info_dict = get_packet_info_from_soft_bits(soft_bits)
+                except ValueError:
+                    continue  # the combined data length is corrupted, wait for more repetitions
+            if is_checksum_valid(info_dict):
+                break
+
+        # the combined sequence number is meaningless, so keep the first one heard
+        info_dict['sn'] = receptions[0][0]['sn']
+        info_dict['heard'] = [received['sn'] for received, _ in receptions]
+        info_dict['combined'] = count
+        results.append(info_dict)
+    return results
+
+
+# finds packets in a stream of audio and decodes each one as soon as its last symbol arrives
+# only the audio of the packet being received is buffered
+class PacketDecoder:
+    def __init__(self):
+        self.buffer = SampleBuffer()
+        self.bits_per_symbol = None  # mode of the packet being received, once its preamble is found
+        self.packet_samples = None  # length of the packet being received, once its header is decoded
+
+    # add the next chunk of audio, returns the info of every packet completed by it
+    def process(self, audio):
+        self.buffer.append(audio)
+        packets = []
+        while self.step(packets):
+            pass
+        return packets
+
+    # make progress on the buffered audio, returns False when more audio is needed
+    def step(self, packets):
+        audio = self.buffer.view()
+        samples_per_symbol = MODEM.samples_per_symbol
+        preamble_samples = PREAMBLE_LENGTH * 8 * samples_per_symbol
+
+        if self.bits_per_symbol is None:
+            # a match is only final once the audio a preamble length past it has been correlated too,
+            # so search in blocks of at least two preambles
+            if len(audio) < 2 * preamble_samples:
+                return False
+            found = next(iter_packets(audio), None)
+            if found is None:
+                # keep the end of the audio, where a preamble could have arrived in part
+                self.buffer.consume(len(audio) - preamble_samples + 1)
+                return False
+
+            start, bits_per_symbol = found
+            self.buffer.consume(start)
+            if start + 2 * preamble_samples > len(audio):
+                return False
+            self.bits_per_symbol = bits_per_symbol
+            return True
+
+        if self.packet_samples is None:
+            # wait for the header to find out the length
+            header_samples = count_packet_symbols(0, self.bits_per_symbol) * samples_per_symbol
+            if len(audio) < header_samples:
+                return False
+
+            length = read_data_length(audio, self.bits_per_symbol)
+            if length is None:
+                # not a packet, keep looking after this symbol
+                self.buffer.consume(samples_per_symbol)
+                self.bits_per_symbol = None
+                return True
+
+            self.packet_samples = count_packet_symbols(length, self.bits_per_symbol) * samples_per_symbol
+
+        if len(audio) < self.packet_samples:
+            return False
+
+        data = demodulate_packet(audio[:self.packet_samples], self.bits_per_symbol)
+        try:
+            packets.append(get_packet_info(rebuild_packet(data)))
+        except ValueError:
+            pass  # the data length was corrupted
+        self.buffer.consume(self.packet_samples)
+        self.bits_per_symbol = None
+        self.packet_samples = None
+        return True
+
+
+# reads chunks of samples from the radio
+# the device is read on a background thread, so samples keep arriving while chunks are processed
+class RtlSdrSource:
+    def __init__(self, chunk_size=RADIO_CHUNK_SIZE, buffer_seconds=4):
+        self.capture = RadioCapture(buffer_seconds * RADIO_SAMPLE_RATE)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        self.capture.start()
+        while self.capture.running:
+            yield self.capture.read_blocking(self.chunk_size)
+
+    def close(self):
+        if self.capture.overruns:
+            print("WARNING: " + str(self.capture.overruns) + " radio samples were dropped")
+        self.capture.close()
+
+
+# replays IQ samples recorded to a file in chunks
+# dtype is 'complex64' for samples saved with ndarray.tofile, or 'uint8' for interleaved I/Q bytes
+# as recorded by rtl_sdr; the file is memory mapped, so memory use does not grow with its size
+class IQFileSource:
+    def __init__(self, filename, dtype='complex64', chunk_size=RADIO_CHUNK_SIZE):
+        self.filename = filename
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return open_iq(self.filename, self.dtype).chunks(self.chunk_size)
+
+    def close(self):
+        pass
+
+
+# replays the audio of a wav file in chunks, e.g. a file saved by the transmitter in file mode
+# raw audio saved by save_to_file (with a .raw extension) is replayed too; the file is memory mapped, so memory
+# use does not grow with its size
+class WavFileSource:
+    def __init__(self, filename, chunk_size=AUDIO_CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        recording = open_recording(self.filename)
+        check_sample_rate(self.filename, recording)
+        return recording.chunks(self.chunk_size)
+
+    def close(self):
+        pass
+
+
+# a chain of stateful stages; every chunk of samples is passed through each stage in turn
+class ReceivePipeline:
+    def __init__(self, stages, sample_rate=RADIO_SAMPLE_RATE):
+        self.stages = stages
+        self.sample_rate = sample_rate  # of the samples fed to the pipeline
+        self.names = timing.get_stage_names(stages)
+
+    def process(self, samples):
+        if timing.is_enabled():
+            return self.process_timed(samples)
+
+        for stage in self.stages:
+            samples = stage.process(samples)
+        return samples
+
+    # process samples, recording the time spent in every stage
+    # every stage handles the stretch of signal the input samples cover, whatever its own sample rate
+    def process_timed(self, samples):
+        signal_seconds = len(samples) / self.sample_rate
+        for name, stage in zip(self.names, self.stages):
+            start = time.perf_counter()
+            output = stage.process(samples)
+            timing.record(name, time.perf_counter() - start, len(samples), len(output), signal_seconds)
+            samples = output
+        return samples
+
+
+# build the stages turning radio samples into audio at the transmission sample rate
+# chunks are mixed down in place if in_place is set, for callers that own the chunks they process
+def build_radio_stages(in_place=False):
+    dec_rate, sample_rate = get_fm_sample_rate()
+
+    return [
+        NCO(-OFFSET_FREQ, RADIO_SAMPLE_RATE, in_place=in_place, dtype=RADIO_DTYPE),
+        PolyphaseResampler(1, dec_rate),
+    ] + build_fm_stages()
+
+
+# build the stages turning an FM channel, centred at 0Hz, into audio at the transmission sample rate
+def build_fm_stages():
+    _, sample_rate = get_fm_sample_rate()
+
+    return [
+        Discriminator(),
+        DeEmphasis(sample_rate),
+        PolyphaseResampler(MODEM.sample_rate, sample_rate),
+    ]
+
+
+# turns radio samples into decoded packets from several stations at once
+# a channelizer splits the capture into the FM channel of every station, and each channel has its own pipeline
+# from the discriminator on; packets are tagged with the frequency of the station they were heard on
+class MultiChannelPipeline:
+    def __init__(self, frequencies):
+        dec_rate, sample_rate = get_fm_sample_rate()
+        self.frequencies = frequencies
+        self.channelizer = Channelizer([frequency - CENTER_FREQ for frequency in frequencies], RADIO_SAMPLE_RATE,
+                                       dec_rate, CHANNEL_SPACING)
+        self.pipelines = [ReceivePipeline(build_fm_stages() + [AutomaticGain(in_place=True), PacketDecoder()],
+                                          sample_rate)
+                          for _ in frequencies]
+
+    def process(self, samples):
+        if timing.is_enabled():
+            start = time.perf_counter()
+            channels = self.channelizer.process(samples)
+            timing.record('Channelizer', time.perf_counter() - start, len(samples), channels.size,
+                          len(samples) / RADIO_SAMPLE_RATE)
+        else:
+            channels = self.channelizer.process(samples)
+
+        packets = []
+        for frequency, pipeline, channel in zip(self.frequencies, self.pipelines, channels):
+            for info_dict in pipeline.process(channel):
+                info_dict['frequency'] = frequency
+                packets.append(info_dict)
+        return packets
+
+
+# build the pipeline turning radio samples into decoded packets
+# the sources hand over chunks that nothing else reads (views of the capture's ring buffer, or samples
+# converted from a file), so they are mixed down in place
+def build_radio_pipeline():
+    return ReceivePipeline(build_radio_stages(in_place=True) + [AutomaticGain(in_place=True), PacketDecoder()])
+
+
+# build the pipeline turning radio samples into decoded packets from every station in STATION_FREQS
+def build_multi_channel_pipeline():
+    return MultiChannelPipeline(STATION_FREQS)
+
+
+# build the pipeline turning audio samples into decoded packets
+def build_audio_pipeline():
+    return ReceivePipeline([PacketDecoder()], MODEM.sample_rate)
+
+
+# decode packets from a source of radio samples (or audio samples, for a WavFileSource) as they arrive
+# on_packet is called with the info of each packet; memory use does not grow with the length of the stream
+# radio samples are decoded for every station in STATION_FREQS when there are several
+# a packet on_packet fails on is reported and skipped, so one bad packet does not stop the receiver
+def streaming(source, on_packet):
+    if isinstance(source, WavFileSource):
+        pipeline = build_audio_pipeline()
+    elif len(STATION_FREQS) > 1:
+        pipeline = build_multi_channel_pipeline()
+    else:
+        pipeline = build_radio_pipeline()
+
+    try:
+        for chunk in source:
+            for info_dict in pipeline.process(chunk):
+                try:
+                    on_packet(info_dict)
+                except Exception as e:
+                    print("WARNING: could not show a packet: " + repr(e), flush=True)
+    finally:
+        source.close()
+
+
+# validate the checksum of a received packet and display it, decrypting the message if it is intact
+def show_packet(info_dict):
     checksum = get_checksum_hex_from_bytes(get_hash(info_dict['data']))
+    if 'frequency' in info_dict:
+        print("Station: " + str(info_dict['frequency'] / 1e6) + " MHz")
+    if 'heard' in info_dict:
+        print("Heard sequence numbers " + ', '.join(info_dict['heard']) + " (combined " +
+              str(info_dict['combined']) + ")")
+
     if checksum != info_dict['checksum']:
         print("WARNING: message checksum does not match calculated value; data is corrupted")
         # display the raw data
@@ -367,3 +1136,24 @@ if __name__ == "__main__":
         # display the decrypted message
         display_packet_info(info_dict, checksum, data=message)
 
+
+if __name__ == "__main__":
+    recorder = timing.configure(STAGE_TIMING)
+    try:
+        if FILE_MODE:
+            #  load audio data from a wav file
+            audio_samples = load_wav(WAV_FILENAME)
+
+            # find & demodulate every repetition, combining them into the best available message
+            for info_dict in decode_repetitions(audio_samples):
+                # validate message checksum & display packet info
+                show_packet(info_dict)
+        else:
+            # decode packets from the radio until ^C is pressed
+            try:
+                streaming(RtlSdrSource(), show_packet)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if isinstance(recorder, timing.StageSummary):
+            recorder.show()
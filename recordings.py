@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# readers for recordings on disk: wav files, raw audio (as written by receiver.save_to_file) and raw IQ samples
+# recordings are memory mapped, so samples are only read from disk when they are used and views of them are
+# never copied; iterating over a recording in chunks releases the memory behind each chunk once the next one is
+# requested, so the memory used does not grow with the size of the file
+import mmap
+import os
+import struct
+import numpy as np
+from shared import *
+
+IQ_EXTENSIONS = {'.cf32': 'complex64', '.iq': 'complex64', '.cu8': 'uint8', '.bin': 'uint8'}  # and sample types
+RAW_AUDIO_EXTENSIONS = {'.raw': 'int16', '.s16': 'int16', '.f32': 'float32'}  # and sample types
+
+# wav sample formats
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+WAV_DTYPES = {
+    (WAVE_FORMAT_PCM, 8): 'uint8',
+    (WAVE_FORMAT_PCM, 16): '<i2',
+    (WAVE_FORMAT_PCM, 32): '<i4',
+    (WAVE_FORMAT_IEEE_FLOAT, 32): '<f4',
+    (WAVE_FORMAT_IEEE_FLOAT, 64): '<f8',
+}
+
+
+# the samples of a recording, memory mapped from a file
+# count samples of dtype start offset bytes into the file; only the first of several interleaved channels is
+# used, and convert (if given) turns samples into the form the receiver processes
+class MappedRecording:
+    def __init__(self, filename, dtype, offset=0, count=None, sample_rate=None, channels=1, convert=None):
+        self.sample_rate = sample_rate
+        self.convert = convert
+        self.offset = offset
+        self.frame_size = np.dtype(dtype).itemsize * channels  # bytes per sample of every channel
+
+        available = max(os.path.getsize(filename) - offset, 0) // self.frame_size
+        count = available if count is None else min(count, available)
+        if count == 0:
+            self.map = None  # empty files cannot be mapped
+            data = np.zeros((0, channels), dtype=dtype)
+        else:
+            with open(filename, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = np.frombuffer(self.map, dtype=dtype, count=count * channels, offset=offset).reshape(count, -1)
+        self.samples = data[:, 0] if channels > 1 else data.reshape((count,) + np.dtype(dtype).shape)
+
+    def __len__(self):
+        return len(self.samples)
+
+    # get a read-only view of samples start to end as they are stored in the file, without copying them
+    def view(self, start=0, end=None):
+        return self.samples[start:end]
+
+    # get samples start to end in the form the receiver processes them; only samples that need to be converted
+    # are copied
+    def read(self, start=0, end=None):
+        samples = self.view(start, end)
+        return samples if self.convert is None else self.convert(samples)
+
+    # iterate over samples start to end in chunks of chunk_size samples (see read)
+    # the memory behind each chunk is released when the next chunk is requested (its samples are read from the
+    # file again if they are used later), so the memory used stays the same however long the recording is
+    def chunks(self, chunk_size, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        for i in range(start, end, chunk_size):
+            yield self.read(i, min(i + chunk_size, end))
+            self.release(i, min(i + chunk_size, end))
+
+    # drop the pages of the file holding samples start to end from memory
+    def release(self, start, end):
+        if self.map is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        first = (self.offset + start * self.frame_size) // mmap.PAGESIZE * mmap.PAGESIZE
+        last = (self.offset + end * self.frame_size) // mmap.PAGESIZE * mmap.PAGESIZE
+        if last > first:
+            self.map.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+
+# read the format of a wav file, returns (dtype, channels, sample rate, offset of the samples, size of the samples)
+def read_wav_format(filename):
+    with open(filename, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(filename + " is not a wav file")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(filename + " has no data chunk")
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                break
+            chunk = f.read(size + size % 2)  # chunks are padded to an even size
+            if chunk_id == b'fmt ':
+                fmt = chunk
+        offset = f.tell()
+
+    if fmt is None:
+        raise ValueError(filename + " has no format chunk")
+    tag, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE:
+        tag = struct.unpack('<H', fmt[24:26])[0]  # the sub-format starts with the format tag
+    if (tag, bits) not in WAV_DTYPES:
+        raise ValueError(filename + " has unsupported samples (format " + str(tag) + ", " + str(bits) + " bits)")
+    return WAV_DTYPES[(tag, bits)], channels, sample_rate, offset, size
+
+
+# open a wav file, e.g. one saved by the transmitter in file mode
+def open_wav(filename):
+    dtype, channels, sample_rate, offset, size = read_wav_format(filename)
+    count = size // (np.dtype(dtype).itemsize * channels)
+    return MappedRecording(filename, dtype, offset, count, sample_rate, channels)
+
+
+# open raw audio samples without a header, e.g. written by receiver.save_to_file (int16 at the transmission
+# sample rate)
+def open_raw_audio(filename, dtype='int16', sample_rate=MODEM.sample_rate):
+    return MappedRecording(filename, dtype, sample_rate=sample_rate)
+
+
+# turn interleaved I/Q bytes, as recorded by rtl_sdr, into complex samples
+def convert_iq_bytes(raw):
+    samples = raw.astype(np.float32)
+    samples -= 127.5
+    samples /= 127.5
+    return samples.view(np.complex64).reshape(-1)  # each I/Q pair is one complex64 sample
+
+
+# open raw IQ samples from the radio
+# dtype is 'complex64' for samples saved with ndarray.tofile, or 'uint8' for interleaved I/Q bytes as recorded
+# by rtl_sdr, which are converted to complex samples chunk by chunk
+def open_iq(filename, dtype='complex64', sample_rate=None):
+    if dtype == 'uint8':
+        return MappedRecording(filename, np.dtype((np.uint8, 2)), sample_rate=sample_rate, convert=convert_iq_bytes)
+    return MappedRecording(filename, dtype, sample_rate=sample_rate)
+
+
+# check whether a file is a recording that open_recording can open, going by its extension
+def is_recording(filename):
+    extension = os.path.splitext(filename)[1]
+    return extension == '.wav' or extension in IQ_EXTENSIONS or extension in RAW_AUDIO_EXTENSIONS
+
+
+# open a recording of audio or IQ samples, going by its extension
+def open_recording(filename):
+    extension = os.path.splitext(filename)[1]
+    if extension == '.wav':
+        return open_wav(filename)
+    if extension in IQ_EXTENSIONS:
+        return open_iq(filename, IQ_EXTENSIONS[extension])
+    if extension in RAW_AUDIO_EXTENSIONS:
+        return open_raw_audio(filename, RAW_AUDIO_EXTENSIONS[extension])
+    raise ValueError(filename + " is not a known kind of recording")
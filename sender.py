@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import sys
 from socket import *
 from shared import *
 
@@ -14,18 +15,44 @@ def connect():
     return sock
 
 
-if __name__ == "__main__":
-    # establish connection
-    sock = connect()
+# receive exactly size bytes, as recv may return fewer
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("the transmitter closed the connection")
+        data += chunk
+    return data
 
+
+if __name__ == "__main__":
     # encrypt message
     message = input("Message to send: ")
     key = gen_key(message)
-    save_key(key)
     encrypted_message = encrypt(message, key)
 
+    # the transmitter refuses longer messages, and receivers take longer packets for noise
+    data = bytes(encrypted_message, 'utf-8')
+    if len(data) > MAX_DATA_LENGTH:
+        print("Message is " + str(len(data)) + " bytes, longer than " + str(MAX_DATA_LENGTH) + "; message was not sent")
+        sys.exit(1)
+    save_key(key)
+
+    # establish connection
+    sock = connect()
+
     # send message
-    sock.send(bytes(encrypted_message, 'utf-8'))
+    sock.sendall(MESSAGE_HEADER.pack(DEFAULT_PRIORITY, len(data)) + data)
+
+    # wait for the transmitter to queue the message
+    status, queue_depth = MESSAGE_ACK.unpack(recv_exactly(sock, MESSAGE_ACK.size))
+    if status == ACK_QUEUED:
+        print("Message queued for transmission (" + str(queue_depth) + " job(s) in queue)")
+    elif status == ACK_TOO_LONG:
+        print("Message is longer than the transmitter accepts; message was not sent")
+    else:
+        print("Transmitter queue is full; message was not sent")
 
     # close connection
     sock.close()
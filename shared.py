@@ -3,34 +3,183 @@
 from random import choice
 import string
 import hashlib
+import struct
+from math import ceil
 
 # machine addresses
 DNS_ADDR = '127.0.0.1'
+DNS_PORT = 53
 HTTP_ADDR = '127.0.0.1'
 TRANSMITTER_ADDR = '127.0.0.1'
 TRANSMITTER_PORT = 4000
 WAV_FILENAME = "transmission.wav"
 FILE_MODE = True
 
+# modem timing
+AUDIO_SAMPLE_RATE = 44100  # Hz
+SYMBOL_RATE = 20 / 3  # symbols per second (150ms symbols)
+
+# modulation mode: bits carried by each symbol
+# 1 is on/off keying of TONE_HIGH; 2, 3 and 4 select 4-, 8- and 16-FSK
+MODULATION_BITS = 1
+TONE_HIGH = 5000  # Hz
+MFSK_BASE_TONE = 1000  # Hz, frequency of M-FSK symbol 0
+MFSK_MIN_TONE_SPACING = 500  # Hz, adjacent M-FSK tones are at least this far apart
+
+# tone that keys the preamble in each mode, which tells the receiver which mode is in use
+PILOT_TONES = {1: TONE_HIGH, 2: 6000, 3: 7000, 4: 8000}  # Hz
+
+FEC_RATE = None  # forward error correction code rate ('1/2', '2/3' or '3/4'), None to send packets uncoded
+
+
+# modem settings shared by the transmitter and the receiver, which must agree on all of them
+# the number of samples in a symbol is derived from the sample rate and the requested symbol rate;
+# the symbol rate actually used is the one that gives a whole number of samples per symbol
+# settings are read from MODEM whenever they are used, so changing them at run time changes both ends
+# the symbol rate and the modulation mode are checked whenever they change, so every tone of the mode stays below
+# half the sample rate
+class ModemConfig:
+    def __init__(self, sample_rate, symbol_rate, modulation_bits=MODULATION_BITS, fec_rate=FEC_RATE,
+                 pilot_tones=PILOT_TONES, mfsk_base_tone=MFSK_BASE_TONE, mfsk_min_tone_spacing=MFSK_MIN_TONE_SPACING):
+        self.sample_rate = sample_rate
+        self._modulation_bits = modulation_bits
+        self.fec_rate = fec_rate
+        self.pilot_tones = dict(pilot_tones)
+        self.mfsk_base_tone = mfsk_base_tone
+        self.mfsk_min_tone_spacing = mfsk_min_tone_spacing
+        self.set_symbol_rate(symbol_rate)
+        self.modulation_bits = modulation_bits
+
+    # take on every setting of another config, e.g. in a worker process; MODEM is changed in place because
+    # every module refers to the same object
+    def update(self, other):
+        self.__dict__.update(vars(other))
+
+    # bits carried by each symbol: 1 for on/off keying, 2, 3 or 4 for 4-, 8- or 16-FSK
+    @property
+    def modulation_bits(self):
+        return self._modulation_bits
+
+    # change the modulation mode; raises ValueError if there is no such mode, or its tones do not fit below half
+    # the sample rate at the current symbol rate
+    @modulation_bits.setter
+    def modulation_bits(self, bits_per_symbol):
+        if bits_per_symbol not in self.pilot_tones:
+            raise ValueError("there is no modulation mode with " + str(bits_per_symbol) + " bits per symbol")
+        self.check_tones(bits_per_symbol, self.symbol_rate)
+        self._modulation_bits = bits_per_symbol
+
+    # change the symbol rate (both ends must use the same rate)
+    # raises ValueError if the tones of the modulation mode would not fit below half the sample rate
+    def set_symbol_rate(self, symbol_rate):
+        samples_per_symbol = max(1, round(self.sample_rate / symbol_rate))
+        self.check_tones(self.modulation_bits, self.sample_rate / samples_per_symbol)
+        self.samples_per_symbol = samples_per_symbol
+        self.symbol_rate = self.sample_rate / samples_per_symbol
+
+    # get the highest tone (in Hz) a modulation mode uses at the given symbol rate (the current one by default)
+    def get_highest_tone(self, bits_per_symbol, symbol_rate=None):
+        highest = self.pilot_tones[bits_per_symbol]
+        if bits_per_symbol > 1:
+            highest = max(highest, self.get_mfsk_tones(bits_per_symbol, symbol_rate)[-1])
+        return highest
+
+    # raise ValueError if the highest tone of a modulation mode at a symbol rate is not below half the sample rate
+    def check_tones(self, bits_per_symbol, symbol_rate):
+        highest = self.get_highest_tone(bits_per_symbol, symbol_rate)
+        if highest >= self.sample_rate / 2:
+            mode = 'on/off keying' if bits_per_symbol == 1 else str(2 ** bits_per_symbol) + '-FSK'
+            raise ValueError(mode + " at " + str(round(symbol_rate, 2)) + " symbols/s needs a " + str(round(highest)) +
+                             " Hz tone, which is not below half the sample rate (" + str(self.sample_rate / 2) +
+                             " Hz); lower the symbol rate or use fewer bits per symbol")
+
+    # duration of a symbol in seconds
+    @property
+    def symbol_duration(self):
+        return self.samples_per_symbol / self.sample_rate
+
+    # get the spacing of M-FSK tones: the smallest multiple of the symbol rate (the current one by default) that
+    # is at least min_spacing, which keeps the tones orthogonal over a symbol
+    def get_tone_spacing(self, min_spacing, symbol_rate=None):
+        symbol_rate = self.symbol_rate if symbol_rate is None else symbol_rate
+        return ceil(min_spacing / symbol_rate) * symbol_rate
+
+    # get the frequencies (in Hz) of the tones used for M-FSK symbols at the given symbol rate (the current one by
+    # default)
+    def get_mfsk_tones(self, bits_per_symbol, symbol_rate=None):
+        spacing = self.get_tone_spacing(self.mfsk_min_tone_spacing, symbol_rate)
+        return [self.mfsk_base_tone + spacing * i for i in range(2 ** bits_per_symbol)]
+
+    # everything that decides the waveforms of symbols, for keying caches of them
+    @property
+    def waveform_key(self):
+        return (self.samples_per_symbol, tuple(sorted(self.pilot_tones.items())), self.mfsk_base_tone,
+                self.mfsk_min_tone_spacing)
+
+
+MODEM = ModemConfig(AUDIO_SAMPLE_RATE, SYMBOL_RATE)
+
+# messages sent to the transmitter are framed by a header holding the priority (lower is
+# transmitted sooner) and the length of the message in bytes
+MESSAGE_HEADER = struct.Struct('!BH')
+DEFAULT_PRIORITY = 8
+MAX_DATA_LENGTH = 4096  # bytes, longer messages are refused by the transmitter and taken for noise by the receiver
+
+# the transmitter acknowledges each message with its status and the number of jobs queued
+MESSAGE_ACK = struct.Struct('!BH')
+ACK_QUEUED = 1
+ACK_QUEUE_FULL = 0
+ACK_TOO_LONG = 2  # the message is longer than MAX_DATA_LENGTH
+
+# packets sent over the air start with a preamble and a header holding the source ip, the transmitter ip,
+# the sequence number, the data length, a reserved byte and the MD5 checksum of the data
+# (see docs/packet-structure/info.pdf)
+PREAMBLE_LENGTH = 4  # bytes
+PREAMBLE = b'\xaa' * (PREAMBLE_LENGTH - 1) + b'\xab'  # 101010...101011
+PACKET_HEADER = struct.Struct('!4s4s4sBHx16s')
+HEADER_LENGTH = PACKET_HEADER.size  # bytes, including the preamble
+
 
 # return a string of bytes representing the given ip address
 def bytes_from_ip(ip_addr):
-    addr_bytes = b''
-
-    for octet in ip_addr.split('.'):
-        addr_bytes += bytes([int(octet)])
-
-    return addr_bytes
+    return bytes(map(int, ip_addr.split('.')))
 
 
 # return a string representing an ip address given a string of bytes
 def ip_from_bytes(ip_bytes):
-    ip = []
-
-    for byte in ip_bytes:
-        ip.append(str(int(byte)))
-
-    return '.'.join(ip)
+    return '.'.join(map(str, ip_bytes))
+
+
+# a packet sent by the transmitter
+# ip addresses are strings, the checksum is the 16 byte MD5 hash of the data and the data is bytes
+class Packet:
+    __slots__ = ('source_ip', 'transmitter_ip', 'sequence_number', 'checksum', 'data')
+
+    def __init__(self, source_ip, transmitter_ip, sequence_number, checksum, data):
+        self.source_ip = source_ip
+        self.transmitter_ip = transmitter_ip
+        self.sequence_number = sequence_number
+        self.checksum = checksum
+        self.data = data
+
+    # get the bytes of the packet, starting with the preamble
+    def pack(self):
+        header = PACKET_HEADER.pack(PREAMBLE, bytes_from_ip(self.source_ip), bytes_from_ip(self.transmitter_ip),
+                                    self.sequence_number, len(self.data), self.checksum)
+        return header + self.data
+
+    # read a packet from the start of a bytes-like object (e.g. a numpy array of packed bits), without copying
+    # the header; anything after the data is ignored, and the preamble is not checked
+    @classmethod
+    def unpack(cls, buffer):
+        view = memoryview(buffer).cast('B')
+        if len(view) < HEADER_LENGTH:
+            raise ValueError("packet is shorter than its header")
+        _, source_ip, transmitter_ip, sequence_number, length, checksum = PACKET_HEADER.unpack_from(view)
+        if len(view) < HEADER_LENGTH + length:
+            raise ValueError("packet is shorter than its data length")
+        return cls(ip_from_bytes(source_ip), ip_from_bytes(transmitter_ip), sequence_number, checksum,
+                   bytes(view[HEADER_LENGTH:HEADER_LENGTH + length]))
 
 
 # encrypt the message (see https://codereview.stackexchange.com/a/116070)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# timing of the stages of the receive chain
+# every stage runs inside a Stage, which prints the stage's progress as the receiver always has; once a recorder
+# is enabled, stages record their wall time and the samples they take in and put out instead, so the chain can
+# be profiled without changing what it does; while no recorder is enabled, the only cost is the progress message
+# the real-time factor of a stage is its wall time over the time the signal it processed lasts (the samples it
+# took in over their sample rate); below 1, the stage keeps up with the radio
+import json
+import sys
+import time
+
+_recorder = None  # recorder the stages report to, None to print progress
+
+
+# start reporting stage timings to the recorder (a StageSummary or JsonLinesRecorder), returns the recorder
+def enable(recorder):
+    global _recorder
+    _recorder = recorder
+    return recorder
+
+
+# stop reporting stage timings, going back to printing progress
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+# enable a recorder by name: None prints progress, 'summary' collects a StageSummary to show once the chain has
+# run, and 'json' writes a JSON line per stage run to stderr; returns the recorder
+def configure(setting):
+    if setting is None:
+        disable()
+        return None
+    if setting == 'summary':
+        return enable(StageSummary())
+    if setting == 'json':
+        return enable(JsonLinesRecorder(sys.stderr))
+    raise ValueError("unknown stage timing " + repr(setting))
+
+
+# report a run of a stage that was timed by its caller (see Stage.__exit__ for the arguments)
+def record(name, seconds, samples_in, samples_out, signal_seconds):
+    if _recorder is not None:
+        _recorder.record(name, seconds, samples_in, samples_out, signal_seconds)
+
+
+# name the stages of a pipeline after their classes, numbering repeated classes from the second one on
+def get_stage_names(stages):
+    names = []
+    for stage in stages:
+        name = type(stage).__name__
+        count = sum(existing.split(' ')[0] == name for existing in names)
+        names.append(name if count == 0 else name + ' ' + str(count + 1))
+    return names
+
+
+# get the statistics of the runs of a stage as a dict
+def get_stats(name, calls, seconds, samples_in, samples_out, signal_seconds):
+    return {
+        'stage': name,
+        'calls': calls,
+        'seconds': seconds,
+        'samples_in': samples_in,
+        'samples_out': samples_out,
+        'samples_per_second': samples_in / seconds if seconds > 0 else None,
+        'signal_seconds': signal_seconds,
+        'rtf': seconds / signal_seconds if signal_seconds > 0 else None,
+    }
+
+
+# a run of a stage over a block of samples, used as a context manager around the stage's work
+# samples is the input of the stage (or is given later with input()) at sample_rate, and the output is given with
+# output() before the stage finishes; message is the progress printed while no recorder is enabled
+class Stage:
+    __slots__ = ('name', 'message', 'sample_rate', 'samples_in', 'samples_out', 'recorder', 'start')
+
+    def __init__(self, name, message=None, samples=None, sample_rate=None):
+        self.name = name
+        self.message = message
+        self.sample_rate = sample_rate
+        self.samples_in = 0 if samples is None else len(samples)
+        self.samples_out = 0
+
+    # set the input of the stage, as samples or a number of samples
+    def input(self, samples):
+        self.samples_in = samples if isinstance(samples, int) else len(samples)
+
+    # set the output of the stage, returns the samples
+    def output(self, samples):
+        self.samples_out = len(samples)
+        return samples
+
+    def __enter__(self):
+        self.recorder = _recorder
+        if self.recorder is None:
+            if self.message is not None:
+                print(self.message + "...", end='', flush=True)
+        else:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            return False
+
+        if self.recorder is None:
+            if self.message is not None:
+                print("done")
+        else:
+            seconds = time.perf_counter() - self.start
+            signal_seconds = self.samples_in / self.sample_rate if self.sample_rate else 0.0
+            self.recorder.record(self.name, seconds, self.samples_in, self.samples_out, signal_seconds)
+        return False
+
+
+# adds up the runs of every stage, for a summary once the chain has run
+class StageSummary:
+    def __init__(self):
+        self.totals = {}  # [calls, seconds, samples in, samples out, signal seconds] by stage, in order of first run
+
+    def record(self, name, seconds, samples_in, samples_out, signal_seconds):
+        totals = self.totals.setdefault(name, [0, 0.0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += samples_in
+        totals[3] += samples_out
+        totals[4] += signal_seconds
+
+    # get the statistics of every stage (see get_stats), in the order the stages first ran
+    def summary(self):
+        return [get_stats(name, *totals) for name, totals in self.totals.items()]
+
+    # print the summary as a table
+    def show(self, file=sys.stdout):
+        header = ['stage', 'calls', 'time (s)', 'samples in', 'samples out', 'Msamples/s', 'signal (s)', 'RTF']
+        rows = [header]
+        for stats in self.summary():
+            rows.append([stats['stage'], stats['calls'], round(stats['seconds'], 4), stats['samples_in'],
+                         stats['samples_out'], format_number(stats['samples_per_second'], 1e-6, 2),
+                         round(stats['signal_seconds'], 3), format_number(stats['rtf'], 1, 4)])
+        widths = [max(len(str(row[i])) for row in rows) for i in range(len(header))]
+        for row in rows:
+            print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)), file=file)
+        print("total time: " + str(round(sum(totals[1] for totals in self.totals.values()), 4)) + " s", file=file)
+
+
+# round a statistic for display, which may be None
+def format_number(value, scale, digits):
+    return '-' if value is None else round(value * scale, digits)
+
+
+# writes every run of a stage to a file as a line of JSON (see get_stats), as it happens
+class JsonLinesRecorder:
+    def __init__(self, file):
+        self.file = file
+
+    def record(self, name, seconds, samples_in, samples_out, signal_seconds):
+        self.file.write(json.dumps(get_stats(name, 1, seconds, samples_in, samples_out, signal_seconds)) + '\n')
+        self.file.flush()
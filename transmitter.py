@@ -1,193 +1,501 @@
 #!/usr/bin/env python3
 
 # TODO cleanup imports
-import sounddevice as sd
 import numpy as np
-from socket import *
 import hashlib
-from time import sleep
-from bitstring import BitArray
-from scipy.io.wavfile import write
-from math import ceil
+from time import sleep, monotonic
+import struct
+import fec
+import threading
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from shared import *
 
+try:
+    import sounddevice as sd
+except ImportError:  # only needed to play audio on a sound card
+    sd = None
+
 # TODO cleanup global variables
-TONE_DURATION = 0.05  # seconds (if this is changed, make sure to modify SAMPLES_PER_TONE)
-AUDIO_SAMPLES_PER_TONE = 6616  # TODO find a way to programmatically determine this
-TONE_HIGH = 5000  # Hz
 TONE_LOW = 0  # Hz
-AUDIO_SAMPLE_RATE = 44100  # Hz
 INTER_TRANSMISSION_PAUSE = 5  # seconds
 PACKET_REPETITIONS = 5  # number of times each packet will be transmitted
+FEC_PACKET_REPETITIONS = 1  # number of times each packet will be transmitted with error correction (MODEM.fec_rate)
+MAX_QUEUED_JOBS = 16  # messages waiting for the radio before new ones are refused
+STREAM_CHECK_INTERVAL = 0.5  # seconds between checks that the output stream is still running while playing
+
+# the modulation mode, forward error correction and tones are set on MODEM (see shared.py)
+
+# tables of symbol waveforms, keyed by bits per symbol and the modem's waveform settings (built on first use)
+_symbol_tables = {}
+
+
+# get the table of symbol waveforms for a modulation mode, generating each tone only once
+# on/off keying uses [LOW, HIGH]; M-FSK uses [LOW, pilot, tone 0, ..., tone M-1]
+def get_symbol_table(bits_per_symbol=1):
+    key = (bits_per_symbol, MODEM.waveform_key)
+    if key not in _symbol_tables:
+        n = MODEM.samples_per_symbol
+        tones = [gen_tone(n, TONE_LOW), gen_tone(n, MODEM.pilot_tones[bits_per_symbol])]
+        if bits_per_symbol > 1:
+            for frequency in get_mfsk_tones(bits_per_symbol):
+                tones.append(gen_tone(n, frequency))
+        _symbol_tables[key] = np.stack(tones)
+    return _symbol_tables[key]
+
+
+# get the frequencies (in Hz) of the tones used for M-FSK symbols
+def get_mfsk_tones(bits_per_symbol):
+    return np.array(MODEM.get_mfsk_tones(bits_per_symbol))
+
+
+# get the bits to transmit for a packet
+# with forward error correction the header and the data are coded as separate blocks, so the
+# receiver can decode the data length before decoding the data; the preamble is never coded
+def get_packet_bits(packet):
+    bits = np.unpackbits(np.frombuffer(packet, dtype=np.uint8))
+    if MODEM.fec_rate is None:
+        return bits
+
+    preamble = bits[:PREAMBLE_LENGTH * 8]
+    header = fec.encode_block(bits[PREAMBLE_LENGTH * 8:HEADER_LENGTH * 8], MODEM.fec_rate)
+    data = fec.encode_block(bits[HEADER_LENGTH * 8:], MODEM.fec_rate)
+    return np.concatenate([preamble, header, data])
 
 
-# setup tcp server
-def setup():
-    addr = '127.0.0.1'
-    port = 4000
-    sock = socket(AF_INET, SOCK_STREAM)
-    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    sock.bind((addr, port))
-    sock.listen(1)
+# get the symbol table indices representing a packet
+# the preamble is always on/off keyed (on the mode's pilot tone) so the receiver can find the
+# packet and detect the mode; in M-FSK mode the rest of the packet carries bits_per_symbol bits
+# per tone, padded with 0 bits to fill the last symbol
+def get_packet_symbols(packet, bits_per_symbol):
+    bits = get_packet_bits(packet).astype(np.intp)
+    if bits_per_symbol == 1:
+        return bits
 
-    return sock
+    preamble = bits[:PREAMBLE_LENGTH * 8]
+    rest = bits[PREAMBLE_LENGTH * 8:]
+    rest = np.concatenate([rest, np.zeros(-len(rest) % bits_per_symbol, dtype=np.intp)])
+    values = rest.reshape(-1, bits_per_symbol) @ (1 << np.arange(bits_per_symbol - 1, -1, -1))
 
+    return np.concatenate([preamble, 2 + values])
 
-# build the list of tones representing a modulated packet
+
+# modulate a packet into one contiguous float32 array of audio samples
+def modulate_packet(packet, bits_per_symbol=1):
+    return get_symbol_table(bits_per_symbol)[get_packet_symbols(packet, bits_per_symbol)].reshape(-1)
+
+
+# build the audio data representing a modulated packet
+# the transmission is a list of contiguous audio segments that are played back to back
 def build_transmission(packet):
-    # initialize list
-    transmission_data = []
+    return [modulate_packet(packet, MODEM.modulation_bits)]
 
-    # get array of bits to transmit
-    b = BitArray(packet)
 
-    # modulate the packet data
-    for bit in b.bin:
-        if bit == '1':
-            transmission_data.append(gen_tone(TONE_DURATION, TONE_HIGH))
-        else:
-            transmission_data.append(gen_tone(TONE_DURATION, TONE_LOW))
+# build a transmission for a packet that differs from an already modulated base packet
+# in a few bytes (e.g. the sequence number); the unchanged audio is shared with the base
+def build_transmission_from_base(packet, base_packet, base_audio):
+    if len(packet) != len(base_packet):
+        return build_transmission(packet)
+
+    symbols = get_packet_symbols(packet, MODEM.modulation_bits)
+    diff = np.flatnonzero(symbols != get_packet_symbols(base_packet, MODEM.modulation_bits))
+    if diff.size == 0:
+        return [base_audio]
 
-    return transmission_data
+    table = get_symbol_table(MODEM.modulation_bits)
+    samples_per_symbol = table.shape[1]
+    start = diff[0]
+    end = diff[-1] + 1
+
+    return [base_audio[:start * samples_per_symbol],
+            table[symbols[start:end]].reshape(-1),
+            base_audio[end * samples_per_symbol:]]
 
 
 # build the transmission data for all packets
 def build_multiple_transmissions(packets):
     full_transmission_data = []
     print("Building transmission data...", end='', flush=True)
+    base_packet = packets[0]
+    base_audio = modulate_packet(base_packet, MODEM.modulation_bits)
     for packet in packets:
-        # build data for single packet
-        full_transmission_data.append(build_transmission(packet))
+        # build data for single packet, reusing the audio shared with the first packet
+        full_transmission_data.append(build_transmission_from_base(packet, base_packet, base_audio))
     print("done")
     return full_transmission_data
 
 
-# play the transmission data
-def send_transmission(transmission_data):
-    i = 1
-    for transmission in transmission_data:
-        # play all tones in the transmission
-        print("Transmission " + str(i) + " of " + str(PACKET_REPETITIONS) + "...", end='', flush=True)
-        for tone in transmission:
-            sd.play(tone, AUDIO_SAMPLE_RATE)
-            sd.wait()
+# reads blocks of frames from an iterator of audio segments
+class FrameReader:
+    def __init__(self, segments):
+        self.segments = iter(segments)
+        self.segment = np.zeros(0, dtype=np.float32)
+        self.pos = 0
+        self.frames_read = 0
+
+    # fill out with the next frames, returns the number of frames written
+    # (less than len(out) once the segments are exhausted)
+    def read_into(self, out):
+        n = 0
+        while n < len(out):
+            if self.pos == len(self.segment):
+                self.segment = next(self.segments, None)
+                self.pos = 0
+                if self.segment is None:
+                    self.segment = np.zeros(0, dtype=np.float32)
+                    break
+                continue
+
+            count = min(len(out) - n, len(self.segment) - self.pos)
+            out[n:n + count] = self.segment[self.pos:self.pos + count]
+            n += count
+            self.pos += count
+
+        self.frames_read += n
+        return n
+
+
+# plays audio through a single long-lived output stream on the sound card
+# the stream callback pulls frames from the segments being played and outputs silence when idle
+class SoundDeviceSink:
+    def __init__(self, sample_rate=AUDIO_SAMPLE_RATE, block_size=1024):
+        if sd is None:
+            raise RuntimeError("sounddevice is required to play audio; use NullSink or FileSink instead")
+
+        self.reader = None
+        self.error = None  # raised by the callback while playing, re-raised by play
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.stream = sd.OutputStream(samplerate=sample_rate, blocksize=block_size, channels=1,
+                                      dtype='float32', callback=self.callback)
+        self.stream.start()
+
+    # called by the audio thread whenever the stream needs more frames
+    def callback(self, outdata, frames, time, status):
+        out = outdata[:, 0]
+        n = 0
+        with self.lock:
+            if self.reader is not None:
+                try:
+                    n = self.reader.read_into(out)
+                except Exception as e:  # hand the error to play rather than stopping the stream
+                    self.error = e
+                    n = 0
+                if n < frames:
+                    self.reader = None
+                    self.done.set()
+        out[n:] = 0
+
+    # play the audio segments, blocking until they have all been handed to the sound card
+    # raises the error if reading the segments failed, or RuntimeError if the stream stopped before they were played
+    def play(self, segments):
+        with self.lock:
+            self.done.clear()
+            self.error = None
+            self.reader = FrameReader(segments)
+        while not self.done.wait(STREAM_CHECK_INTERVAL):
+            if not self.stream.active:
+                with self.lock:
+                    self.reader = None
+                raise RuntimeError("the output stream stopped while playing")
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+# consumes audio in the same blocks as the sound card would, without playing it
+# useful for testing and benchmarking the real-time path on machines without a sound card
+class NullSink:
+    def __init__(self, sample_rate=AUDIO_SAMPLE_RATE, block_size=1024, realtime=False):
+        self.sample_rate = sample_rate
+        self.block = np.zeros(block_size, dtype=np.float32)
+        self.realtime = realtime
+        self.frames_played = 0
+
+    def play(self, segments):
+        reader = FrameReader(segments)
+        while True:
+            n = reader.read_into(self.block)
+            self.consume(self.block[:n])
+            if n < len(self.block):
+                break
+            if self.realtime:
+                sleep(n / self.sample_rate)
+
+    # handle a block of frames that would have been played
+    def consume(self, frames):
+        self.frames_played += len(frames)
+
+    def close(self):
+        pass
+
+
+# writes the audio that would have been played to a wave file
+class FileSink(NullSink):
+    def __init__(self, filename, sample_rate=AUDIO_SAMPLE_RATE, block_size=1024):
+        super().__init__(sample_rate, block_size)
+        self.file = open(filename, 'wb')
+        write_wav_header(self.file, 0, sample_rate)  # sizes are filled in on close
+
+    def consume(self, frames):
+        super().consume(frames)
+        frames.tofile(self.file)
+
+    def close(self):
+        self.file.seek(0)
+        write_wav_header(self.file, self.frames_played, self.sample_rate)
+        self.file.close()
+
+
+# play the transmission data through the given sink (the sound card by default)
+def send_transmission(transmission_data, sink=None):
+    close_sink = sink is None
+    if sink is None:
+        sink = SoundDeviceSink()
+
+    pause = np.zeros(get_pause_samples(), dtype=np.float32)
+    for i, transmission in enumerate(transmission_data, 1):
+        # play all segments in the transmission
+        print("Transmission " + str(i) + " of " + str(len(transmission_data)) + "...", end='', flush=True)
+        sink.play(transmission)
         print("done", flush=True)
 
-        if i != PACKET_REPETITIONS:
-            sleep(INTER_TRANSMISSION_PAUSE)
-            i += 1
+        # the pause is played as silence so the stream stays open between transmissions
+        if i != len(transmission_data):
+            sink.play([pause])
 
+    if close_sink:
+        sink.close()
 
-# generate a tone of the given duration (in seconds) at the given frequency
-def gen_tone(tone_duration, frequency):
-    duration = tone_duration * 3  # this makes a duration of 1 approx. equal to 1 second
-    tone = (np.sin(2 * np.pi * np.arange(AUDIO_SAMPLE_RATE * duration) * frequency / AUDIO_SAMPLE_RATE)).astype(np.float32)
+
+# generate a tone of the given number of samples at the given frequency
+def gen_tone(num_samples, frequency):
+    tone = (np.sin(2 * np.pi * np.arange(num_samples) * frequency / MODEM.sample_rate)).astype(np.float32)
     return tone
 
 
 # build a packet containing the message
 # for more information, see docs/packet-structure/info.pdf
 def build_packet(source_ip, transmitter_ip, sequence_number, checksum, data):
-    packet = b''
-
-    # preamble (101010...101011)
-    packet += b'\xaa' * 3 + b'\xab'
+    return Packet(source_ip, transmitter_ip, sequence_number, checksum, data).pack()
 
-    # source ip
-    packet += bytes_from_ip(source_ip)
 
-    # transmitter_ip
-    packet += bytes_from_ip(transmitter_ip)
+# get the number of silent samples played between repetitions
+def get_pause_samples():
+    return round(INTER_TRANSMISSION_PAUSE * MODEM.sample_rate)
 
-    # sequence number
-    packet += sequence_number.to_bytes(1, byteorder='big')
 
-    # data length
-    packet += len(data).to_bytes(2, byteorder='big')
-
-    # reserved
-    packet += b'\x00'
-
-    # checksum
-    packet += checksum  # 16 bytes
+# yield the audio segments of all transmissions, with a block of silence after each one
+def iter_transmission_audio(transmission_data):
+    pause = np.zeros(get_pause_samples(), dtype=np.float32)
+    for transmission in transmission_data:
+        for segment in transmission:
+            yield segment
+        yield pause
 
-    # data (comes in as bytes)
-    packet += data
 
-    return packet
+# write the header of a mono 32-bit float wave file holding the given number of samples at sample_rate (the
+# transmission sample rate by default)
+def write_wav_header(f, num_samples, sample_rate=None):
+    sample_rate = MODEM.sample_rate if sample_rate is None else sample_rate
+    data_size = num_samples * 4
+    f.write(b'RIFF' + struct.pack('<I', 4 + (8 + 18) + (8 + 4) + (8 + data_size)) + b'WAVE')
 
+    # format chunk: IEEE float, 1 channel, 4 bytes per sample
+    f.write(b'fmt ' + struct.pack('<IHHIIHHH', 18, 3, 1, sample_rate, sample_rate * 4, 4, 32, 0))
 
-# save a numpy array as a wave file
-def save_wav(filename, audio_data):
-    write(filename, AUDIO_SAMPLE_RATE, audio_data)
-    print("Saved file " + filename + " successfully.")
+    # non-PCM data requires a fact chunk with the number of samples
+    f.write(b'fact' + struct.pack('<II', 4, num_samples))
+    f.write(b'data' + struct.pack('<I', data_size))
 
 
 # save transmission data into a wave file
+# the audio is streamed to disk segment by segment, so only one packet's worth is ever in memory
 def save_transmission_data(transmission_data):
-    print("Building data for wav file...", end='', flush=True)
+    print("Writing wav file...", end='', flush=True)
 
-    # generate tone data for pauses between repetitions
-    num_tones = ceil(INTER_TRANSMISSION_PAUSE / TONE_DURATION)
-    pause_tones = []
-    for i in range(0, num_tones):
-        pause_tones.append(gen_tone(TONE_DURATION, TONE_LOW))
-
-    # build numpy array to store tones to be saved
-    wav_data = np.array(0, ndmin=1)  # need initial value for array
-    i = 0
+    # determine the size of the file up front so the header can be written first
+    num_samples = 0
     for transmission in transmission_data:
-        # store all tones for transmission
-        for tone in transmission:
-            wav_data = np.concatenate([wav_data, tone])
-
-            # # remove leading 0 of wav_data
-            # if i == 0:
-            #     wav_data = wav_data[1:]
+        num_samples += sum(len(segment) for segment in transmission)
+    num_samples += len(transmission_data) * get_pause_samples()
 
-        # store empty tones between transmission
-        for tone in pause_tones:
-            wav_data = np.concatenate([wav_data, tone])
-
-        i += 1
+    with open(WAV_FILENAME, 'wb') as f:
+        write_wav_header(f, num_samples)
+        for segment in iter_transmission_audio(transmission_data):
+            segment.astype(np.float32, copy=False).tofile(f)
 
     print("done")
-
-    # save the generated audio to a file
-    save_wav(WAV_FILENAME, wav_data)
+    print("Saved file " + WAV_FILENAME + " successfully.")
+
+
+# get the number of times each packet is transmitted: with error correction, the code corrects the errors the
+# repetitions were there for, so it takes the place of most of them
+def get_packet_repetitions():
+    return PACKET_REPETITIONS if MODEM.fec_rate is None else FEC_PACKET_REPETITIONS
+
+
+# build the packets for every repetition of a message
+def build_message_packets(source_ip, message):
+    packets = []
+    for i in range(0, get_packet_repetitions()):
+        packets.append(build_packet(source_ip, TRANSMITTER_ADDR, i + 1, get_hash(message), message))
+    return packets
+
+
+# a message waiting to be transmitted
+class TransmissionJob:
+    def __init__(self, job_id, priority, source_ip, message):
+        self.job_id = job_id
+        self.priority = priority
+        self.source_ip = source_ip
+        self.message = message
+        self.queued_at = monotonic()
+
+    # jobs with the same priority are transmitted in the order they arrived
+    def __lt__(self, other):
+        return (self.priority, self.job_id) < (other.priority, other.job_id)
+
+
+# asyncio tcp server that queues messages from any number of senders for a single radio
+# a job is modulated in an executor while the previous job is still being played
+class TransmitterService:
+    def __init__(self, sink=None, max_queued=MAX_QUEUED_JOBS):
+        self.sink = sink
+        self.queue = asyncio.PriorityQueue(max_queued)
+        self.modulator = ThreadPoolExecutor(max_workers=1)
+        self.radio = ThreadPoolExecutor(max_workers=1)
+        self.next_job_id = 1
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.last_error = None  # (job id, error) of the last job that failed
+        self.latencies = deque(maxlen=100)  # seconds from queueing to the end of the transmission
+
+    # receive framed messages from a sender and acknowledge each as soon as it is queued
+    async def handle_client(self, reader, writer):
+        source_ip = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                priority, length = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+                message = await reader.readexactly(length)
+
+                if length > MAX_DATA_LENGTH:
+                    print("Refused message of " + str(length) + " bytes from " + source_ip + ", longer than " +
+                          str(MAX_DATA_LENGTH) + " bytes")
+                    writer.write(MESSAGE_ACK.pack(ACK_TOO_LONG, self.queue.qsize()))
+                    await writer.drain()
+                    continue
+
+                job = TransmissionJob(self.next_job_id, priority, source_ip, message)
+                self.next_job_id += 1
+                try:
+                    self.queue.put_nowait(job)
+                    print("Queued job " + str(job.job_id) + " from " + source_ip + ": " + str(message))
+                    status = ACK_QUEUED
+                except asyncio.QueueFull:
+                    print("Queue full, refused message from " + source_ip)
+                    status = ACK_QUEUE_FULL
+
+                writer.write(MESSAGE_ACK.pack(status, self.queue.qsize()))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # sender disconnected
+        finally:
+            writer.close()
+
+    # build the transmission data for a job (runs in the modulator executor)
+    def modulate(self, job):
+        return build_multiple_transmissions(build_message_packets(job.source_ip, job.message))
+
+    # play or save the transmission data for a job (runs in the radio executor)
+    def transmit(self, transmission_data):
+        if FILE_MODE:
+            save_transmission_data(transmission_data)
+        else:
+            send_transmission(transmission_data, self.sink)
+
+    # start modulating the next queued job
+    def start_job(self, job):
+        loop = asyncio.get_running_loop()
+        return job, loop.run_in_executor(self.modulator, self.modulate, job)
+
+    # record a job that could not be modulated or transmitted
+    def fail_job(self, job, error):
+        self.jobs_failed += 1
+        self.last_error = (job.job_id, error)
+        print("Job " + str(job.job_id) + " failed: " + repr(error) + ", " + str(self.queue.qsize()) +
+              " job(s) in queue")
+
+    # the only task that uses the radio; it drains the queue one job at a time
+    # a job that fails is recorded and dropped, and the worker carries on with the next one
+    async def radio_worker(self):
+        loop = asyncio.get_running_loop()
+        pending = None
+        while True:
+            if pending is None:
+                pending = self.start_job(await self.queue.get())
+
+            job, modulation = pending
+            pending = None
+            try:
+                transmission_data = await modulation
+            except Exception as e:
+                self.fail_job(job, e)
+                continue
+
+            # modulate the next job while this one is on the air
+            if not self.queue.empty():
+                pending = self.start_job(self.queue.get_nowait())
+
+            try:
+                await loop.run_in_executor(self.radio, self.transmit, transmission_data)
+            except Exception as e:
+                self.fail_job(job, e)
+                continue
+
+            latency = monotonic() - job.queued_at
+            self.latencies.append(latency)
+            self.jobs_done += 1
+            print("Job " + str(job.job_id) + " done in " + str(round(latency, 2)) + "s, " +
+                  str(self.queue.qsize()) + " job(s) in queue")
+
+    # get the current queue depth, job counts and latencies
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'jobs_done': self.jobs_done,
+            'jobs_failed': self.jobs_failed,
+            'last_error': self.last_error,
+            'last_latency': self.latencies[-1] if self.latencies else None,
+            'mean_latency': sum(self.latencies) / len(self.latencies) if self.latencies else None,
+        }
+
+    # accept senders on the given address until cancelled
+    async def serve(self, addr, port):
+        server = await asyncio.start_server(self.handle_client, addr, port, reuse_address=True)
+        worker = asyncio.create_task(self.radio_worker())
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                worker.cancel()
 
 
 if __name__ == "__main__":
-    sock = setup()
+    # open the output stream once and keep it open for all transmissions
+    sink = None
+    if not FILE_MODE:
+        sink = SoundDeviceSink()
 
     # listen for connections until SIGTERM is received
     print("Transmitter started. Use ^C to exit")
 
-    while True:
-        # establish connection with client
-        connection, source_addr = sock.accept()
-
-        # get the message
-        message = connection.recv(4096)
-        print("Processing message: ", end='')
-        print(message)
-
-        # build the packets
-        packets = []
-        print("Building packets...", end='', flush=True)
-        for i in range(0, PACKET_REPETITIONS):
-            packets.append(build_packet(source_addr[0], TRANSMITTER_ADDR, i + 1, get_hash(message), message))
-        print("done")
-
-        # build transmission data for packets
-        transmission_data = build_multiple_transmissions(packets)
-
-        if FILE_MODE:
-            # save the audio data to a wave file
-            save_transmission_data(transmission_data)
-        else:
-            # transmit all data
-            send_transmission(transmission_data)
-
-        # close the connection
-        connection.close()
+    service = TransmitterService(sink)
+    try:
+        asyncio.run(service.serve('127.0.0.1', TRANSMITTER_PORT))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# zones of DNS records for the DNS server to answer from, loaded from zone files
+# zone files are in the master file format, one record per line: [<name>] [<ttl>] [IN] <type> <data>, with $ORIGIN
+# and $TTL lines, comments after ';', records spread over several lines in parentheses, names relative to the
+# origin unless they end with '.', '@' for the origin and no name (a line starting with a space) for the name of
+# the record before; A, AAAA, CNAME, NS and TXT records are served, names starting with '*.' are wildcards, and
+# records of other types (e.g. SOA) are skipped
+# records are indexed by their name in wire format (lowercased) followed by their type, and kept already encoded
+# as they are in the answer section of a response, so finding the records answering a question takes a dictionary
+# lookup per label of its name at most, and answering it is a matter of joining bytes
+import re
+import struct
+from socket import inet_pton, AF_INET, AF_INET6
+
+DEFAULT_TTL = 3600  # seconds, for records without a TTL in zone files without $TTL
+CNAME_CHAIN_LIMIT = 8  # CNAMEs followed within the zone when answering, so loops of them end
+
+# record types, and the class of every record
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_TXT = 16
+TYPE_AAAA = 28
+RECORD_TYPES = {'A': TYPE_A, 'NS': TYPE_NS, 'CNAME': TYPE_CNAME, 'TXT': TYPE_TXT, 'AAAA': TYPE_AAAA}
+CLASS_IN = 1
+
+# response codes
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+ROOT = b'\x00'  # the root name in wire format
+CNAME = TYPE_CNAME.to_bytes(2, byteorder='big')
+RRSET_HEADER = struct.Struct('!HI')  # number of records and their smallest TTL, before the records of a name and type
+RECORD_HEADER = struct.Struct('!HHHIH')  # owner (a pointer to a name in the message), type, class, TTL, data length
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|;.*|[^\s"]+')  # a quoted string, a comment or a word
+TTL = re.compile(r'(?:\d+[smhdw]?)+$', re.IGNORECASE)  # seconds, or e.g. 1h30m
+TTL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+# read a TTL from a zone file, in seconds or with units (e.g. 1h30m)
+def parse_ttl(text):
+    if text.isdigit():
+        return int(text)
+    if not TTL.match(text):
+        raise ValueError("invalid TTL " + repr(text))
+    return sum(int(value) * TTL_UNITS[unit.lower()] for value, unit in re.findall(r'(\d+)([a-z]?)', text, re.I))
+
+
+# turn a name from a zone file into wire format, relative to origin (in wire format) unless it ends with '.'
+def encode_name(name, origin=ROOT):
+    if name == '@':
+        return origin
+    if name == '.':
+        return ROOT
+
+    absolute = name.endswith('.')
+    wire = b''
+    for label in (name[:-1] if absolute else name).split('.'):
+        label = label.encode()
+        if not 0 < len(label) <= 63:
+            raise ValueError("invalid label in name " + repr(name))
+        wire += bytes([len(label)]) + label
+    wire += ROOT if absolute else origin
+    if len(wire) > 255:
+        raise ValueError("name " + repr(name) + " is too long")
+    return wire
+
+
+# turn a name in wire format back into text, e.g. for messages
+def decode_name(wire):
+    labels = []
+    while wire[0]:
+        labels.append(wire[1:wire[0] + 1].decode(errors='replace'))
+        wire = wire[wire[0] + 1:]
+    return '.'.join(labels) + '.'
+
+
+# get the name a name in wire format is under, e.g. example.com. for www.example.com.
+def get_parent(wire):
+    return wire[wire[0] + 1:]
+
+
+# turn the data of a record of the given type from a zone file into wire format
+def encode_rdata(record_type, fields, origin):
+    if record_type == TYPE_A:
+        return inet_pton(AF_INET, fields[0])
+    if record_type == TYPE_AAAA:
+        return inet_pton(AF_INET6, fields[0])
+    if record_type in (TYPE_CNAME, TYPE_NS):
+        return encode_name(fields[0], origin)
+
+    # TXT: one or more character strings, quoted or not
+    rdata = b''
+    for field in fields:
+        if field.startswith('"'):
+            field = re.sub(r'\\(.)', r'\1', field[1:-1])
+        string = field.encode()
+        if len(string) > 255:
+            raise ValueError("TXT string is longer than 255 bytes")
+        rdata += bytes([len(string)]) + string
+    return rdata
+
+
+# the records of a zone, indexed for answering questions
+class Zone:
+    def __init__(self):
+        self.records = {}  # name in wire format + type -> RRSET_HEADER + the records, encoded for the answer section
+        # names that exist: owners of records, and the names between them and their origin
+        # kept as the keys of a dict rather than in a set, as a dict of bytes is not tracked by the garbage collector,
+        # which would otherwise go through every name of the zone in its collections
+        self.names = {}
+        self.count = 0  # records
+        self.skipped = {}  # records of unsupported types that were skipped, by type
+        self.negative_ttl = DEFAULT_TTL  # seconds a missing name or type stays missing for
+
+    def __len__(self):
+        return self.count
+
+    # add a record, name and origin being in wire format and rdata the record's data in wire format
+    # the names between name and origin exist from then on, so wildcards above them no longer match them
+    def add(self, name, record_type, ttl, rdata, origin=ROOT):
+        name = name.lower()
+        key = name + record_type.to_bytes(2, byteorder='big')
+        record = RECORD_HEADER.pack(0xC00C, record_type, CLASS_IN, ttl, len(rdata)) + rdata
+        rrset = self.records.get(key)
+        if rrset is None:
+            self.records[key] = RRSET_HEADER.pack(1, ttl) + record
+        else:
+            count, smallest_ttl = RRSET_HEADER.unpack_from(rrset)
+            header = RRSET_HEADER.pack(count + 1, min(ttl, smallest_ttl))
+            self.records[key] = header + rrset[RRSET_HEADER.size:] + record
+        self.count += 1
+
+        if name not in self.names:
+            ancestors = [name]
+            while ancestors[-1] != origin and ancestors[-1] != ROOT:
+                ancestors.append(get_parent(ancestors[-1]))
+            self.names.update(dict.fromkeys(ancestors if ancestors[-1] == origin else ancestors[:1]))
+
+    # find the name whose records answer for a name in wire format (lowercased): the name itself if it exists,
+    # otherwise the wildcard below its closest existing ancestor
+    # returns (response code, owner), owner being None if no records answer for the name
+    def find_owner(self, name):
+        if name in self.names:
+            return RCODE_NOERROR, name
+        encloser = name
+        while encloser != ROOT:
+            encloser = get_parent(encloser)
+            if encloser in self.names:
+                wildcard = b'\x01*' + encloser
+                if wildcard in self.names:
+                    return RCODE_NOERROR, wildcard
+                return RCODE_NXDOMAIN, None
+        return RCODE_REFUSED, None  # not in the zone
+
+    # find the records answering a question for a name in wire format and a type (2 bytes), following CNAMEs
+    # within the zone
+    # returns (response code, number of answers, the answer section, seconds the answers stay valid), the answer
+    # section being encoded for a response that has the question (with the name as long as this one) right after
+    # its header
+    def lookup(self, name, record_type):
+        rcode, owner = self.find_owner(name.lower())
+        count = 0
+        answers = b''
+        ttl = self.negative_ttl
+        pointer = 12  # offset in the response of the name the records of owner answer for
+        visited = []
+
+        for _ in range(CNAME_CHAIN_LIMIT + 1):
+            if owner is None or owner in visited:
+                break
+            visited.append(owner)
+            rrset = self.records.get(owner + record_type)
+            is_cname = False
+            if rrset is None and record_type != CNAME:
+                rrset = self.records.get(owner + CNAME)
+                is_cname = True
+            if rrset is None:
+                break
+
+            rrset_count, rrset_ttl = RRSET_HEADER.unpack_from(rrset)
+            records = rrset[RRSET_HEADER.size:]
+            if pointer != 12:
+                records = set_owner(records, rrset_count, pointer)
+            ttl = rrset_ttl if count == 0 else min(ttl, rrset_ttl)
+            start = 12 + len(name) + 4 + len(answers)
+            count += rrset_count
+            answers += records
+            if not is_cname:
+                break
+
+            # answer for the name the first CNAME points to as well, if it is in the zone and can be pointed at
+            if start + RECORD_HEADER.size > 0x3FFF:
+                break
+            target_length = RECORD_HEADER.unpack_from(records)[4]
+            target = records[RECORD_HEADER.size:RECORD_HEADER.size + target_length]
+            _, owner = self.find_owner(target.lower())
+            pointer = start + RECORD_HEADER.size
+
+        return rcode, count, answers, ttl
+
+
+# point the owners of count encoded records at the given offset in the response
+def set_owner(records, count, pointer):
+    owner = (0xC000 | pointer).to_bytes(2, byteorder='big')
+    result = b''
+    start = 0
+    for _ in range(count):
+        end = start + RECORD_HEADER.size + RECORD_HEADER.unpack_from(records, start)[4]
+        result += owner + records[start + 2:end]
+        start = end
+    return result
+
+
+# split the lines of a zone file into records: yields (line number, whether the record has a name, its fields),
+# joining records spread over several lines in parentheses and dropping comments
+def get_entries(lines):
+    fields = []
+    has_name = False
+    first = 0
+    depth = 0
+    for number, line in enumerate(lines, 1):
+        if '"' in line or '(' in line or ')' in line or depth:
+            tokens = [token for token in TOKEN.findall(line) if not token.startswith(';')]
+            words = []
+            for token in tokens:
+                if token.startswith('"'):
+                    words.append(token)
+                    continue
+                depth += token.count('(') - token.count(')')
+                words.extend(token.replace('(', ' ').replace(')', ' ').split())
+        else:
+            words = line.split(';', 1)[0].split()
+
+        if not fields:
+            if not words:
+                continue
+            has_name = not line[:1].isspace()
+            first = number
+        fields.extend(words)
+        if depth == 0:
+            yield first, has_name, fields
+            fields = []
+    if fields:
+        yield first, has_name, fields
+
+
+# load the records of a zone file into a Zone, names being relative to origin (text) until a $ORIGIN line
+# raises ValueError for lines that cannot be read, giving the file and line
+def parse_zone(lines, origin='.', filename='zone'):
+    zone = Zone()
+    origin = encode_name(origin)
+    default_ttl = DEFAULT_TTL
+    last_name = None
+    last_owner = None
+
+    for number, has_name, fields in get_entries(lines):
+        try:
+            if fields[0] == '$ORIGIN':
+                origin = encode_name(fields[1], origin)
+                last_name = None  # the same relative name is another owner under the new origin
+                continue
+            if fields[0] == '$TTL':
+                default_ttl = parse_ttl(fields[1])
+                zone.negative_ttl = default_ttl
+                continue
+            if fields[0].startswith('$'):
+                raise ValueError("unsupported directive " + fields[0])
+
+            if has_name:
+                if fields[0] != last_name:
+                    last_name = fields[0]
+                    last_owner = encode_name(last_name, origin)
+                fields = fields[1:]
+            elif last_owner is None:
+                raise ValueError("the first record has no name")
+
+            # the TTL and class come in either order, and may be left out
+            ttl = default_ttl
+            index = 0
+            while index < 2 and index < len(fields) and (TTL.match(fields[index]) or fields[index].upper() == 'IN'):
+                if fields[index].upper() != 'IN':
+                    ttl = parse_ttl(fields[index])
+                index += 1
+            type_name = fields[index].upper()
+            if type_name not in RECORD_TYPES:
+                zone.skipped[type_name] = zone.skipped.get(type_name, 0) + 1
+                continue
+            record_type = RECORD_TYPES[type_name]
+            data = fields[index + 1:]
+            if not data:
+                raise ValueError(type_name + " record has no data")
+            zone.add(last_owner, record_type, ttl, encode_rdata(record_type, data, origin), origin)
+        except (ValueError, IndexError, OSError) as e:
+            raise ValueError(filename + ":" + str(number) + ": " + (str(e) or "incomplete record")) from None
+
+    return zone
+
+
+# load a zone file (see parse_zone)
+def load_zone(filename, origin='.'):
+    with open(filename) as f:
+        return parse_zone(f, origin, filename)